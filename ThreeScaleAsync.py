@@ -0,0 +1,534 @@
+"""asyncio support for the Python API for 3scale Service Management API.
+
+Requires Python 3.5 or newer. The classes in this module extend the ones in
+ThreeScalePY with coroutines that do not block the event loop:
+ - authrep_async()
+ - authorize_async()
+ - report_async()
+
+The calls go through a ThreeScaleAsyncConnectionPool that keeps the
+connections to the backend alive, so a single event loop can have many
+calls in flight. Unlike their blocking counterparts, the coroutines do not
+store the result in the instance: they return the response object, so one
+instance can be shared by all the tasks.
+
+ AuthRep usage:
+---------------------
+    authrep = ThreeScaleAsync.ThreeScaleAsyncAuthRep(app_id = 'your_app_id', app_key = 'your_app_key',
+                              service_id = 'your_service_id', service_token = 'your_service_token')
+    resp = await authrep.authrep_async()
+    if resp.is_authorized():
+        # all was ok, proceed normally
+    else: # something was wrong
+        sys.stdout.write(" reason = %s \\n" % resp.get_reason())
+
+ Authorize usage:
+---------------------
+    auth = ThreeScaleAsync.ThreeScaleAsyncAuthorizeUserKey(user_key = 'your_user_key',
+                          service_id = 'your_service_id', service_token = 'your_service_token')
+    resp = await auth.authorize_async()
+    if resp.is_authorized():
+        usage_reports = resp.get_usage_reports()
+
+Report usage:
+-------------------------
+    report = ThreeScaleAsync.ThreeScaleAsyncReport(service_id = 'your_service_id', service_token = 'your_service_token')
+    await report.report_async([{'app_id': 'your_app_id', 'usage': {'hits': 1}}])
+"""
+
+import asyncio
+import ssl
+import time
+import weakref
+from collections import deque
+from urllib.parse import urlparse
+
+from ThreeScalePY import (ThreeScaleAuthRep, ThreeScaleAuthRepUserKey,
+                          ThreeScaleAuthorize, ThreeScaleAuthorizeUserKey,
+                          ThreeScaleReport, ThreeScaleHTTPResponse, ThreeScaleResult, ThreeScaleCallMetrics,
+                          ThreeScaleMiddleware,
+                          ThreeScaleException, ThreeScaleConnectionError,
+                          ThreeScaleCircuitOpenError)
+
+__all__ = ['ThreeScaleAsyncConnectionPool', 'ThreeScaleAsyncMixin',
+           'ThreeScaleAsyncAuthRep', 'ThreeScaleAsyncAuthRepUserKey',
+           'ThreeScaleAsyncAuthorize', 'ThreeScaleAsyncAuthorizeUserKey',
+           'ThreeScaleAsyncReport', 'ThreeScaleASGIMiddleware'
+          ]
+
+
+class ThreeScaleAsyncConnectionPool(object):
+    """Pool of persistent HTTP/1.1 connections for asyncio.
+
+    Connections belong to the event loop that opened them, so they are kept
+    per event loop and per (scheme, host, port). At most max_size idle
+    connections are kept for each of them, and connections that stayed idle
+    for longer than idle_timeout seconds are closed instead of being reused.
+    max_size does not limit the connections in use.
+
+    Like ThreeScaleConnectionPool, a request which fails on a reused
+    connection is sent again once on a new connection only if it was not
+    written yet, or if it is idempotent.
+    """
+
+    DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+    def __init__(self, max_size=100, idle_timeout=30, ssl_context=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.ssl_context = ssl_context
+        self.connections = weakref.WeakKeyDictionary()
+
+    def get_idle(self, key):
+        loop = asyncio.get_event_loop()
+        return self.connections.setdefault(loop, {}).setdefault(key, deque())
+
+    async def new_connection(self, key):
+        """open a new (reader, writer) stream pair for the key"""
+        scheme, host, port = key
+        context = None
+        if scheme == 'https':
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+            context = self.ssl_context
+        return await asyncio.open_connection(host, port, ssl=context)
+
+    async def get_connection(self, key, metrics=None):
+        """return a tuple (reader, writer, reused)"""
+        idle = self.get_idle(key)
+        deadline = time.time() - self.idle_timeout
+        while idle:
+            reader, writer, last_used = idle.pop()
+            # StreamWriter.is_closing() is only there from python 3.7
+            if last_used >= deadline and not writer.transport.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self.open_connection(key, metrics)
+        return reader, writer, False
+
+    async def open_connection(self, key, metrics=None):
+        """new_connection(), recording the time it took, TLS included, as
+        the connect phase of metrics"""
+        start = time.time()
+        reader, writer = await self.new_connection(key)
+        if metrics is not None:
+            metrics.phases['connect'] = time.time() - start
+        return reader, writer
+
+    def release(self, key, reader, writer):
+        idle = self.get_idle(key)
+        if len(idle) < self.max_size:
+            idle.append((reader, writer, time.time()))
+        else:
+            writer.close()
+
+    def clear(self):
+        """close the idle connections of the running event loop"""
+        loop = asyncio.get_event_loop()
+        for idle in self.connections.pop(loop, {}).values():
+            for _, writer, _ in idle:
+                writer.close()
+
+    async def read_body(self, reader, headers):
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    # skip the trailers
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(chunks)
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+        if 'content-length' in headers:
+            return await reader.readexactly(int(headers['content-length']))
+        return await reader.read()
+
+    async def send(self, writer, request):
+        writer.write(request)
+        await writer.drain()
+
+    async def perform(self, key, reader, writer, method, metrics=None):
+        start = time.time()
+        status_line = await reader.readline()
+        first_byte = time.time()
+        if not status_line:
+            raise ConnectionResetError("Remote end closed connection without response")
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        body = b'' if method == 'HEAD' else await self.read_body(reader, headers)
+        if metrics is not None:
+            metrics.phases['ttfb'] = first_byte - start
+            metrics.phases['body'] = time.time() - first_byte
+            metrics.status = int(status)
+            metrics.response_bytes = len(body)
+        keep_alive = (version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                      and ('content-length' in headers or 'transfer-encoding' in headers))
+        if keep_alive:
+            self.release(key, reader, writer)
+        else:
+            writer.close()
+        return ThreeScaleHTTPResponse(int(status), reason, headers, body)
+
+    async def request(self, method, url, body=None, headers={}, timeout=10, idempotent=False, metrics=None):
+        """send the request over a pooled connection. Only an idempotent
+        request is sent again once it has been written. The phases of the
+        request are recorded in metrics, a ThreeScaleCallMetrics, if it is
+        given: connect, which includes TLS, ttfb, counted from the end of
+        the write, and body.
+
+        @returns ThreeScaleHTTPResponse object, whatever the HTTP status is.
+        @throws ThreeScaleConnectionError error, if the connection can not
+        be established, is lost or times out before the response is read.
+        """
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.hostname,
+               parsed.port or self.DEFAULT_PORTS.get(parsed.scheme))
+        path = parsed.path or '/'
+        if parsed.query:
+            path = "%s?%s" % (path, parsed.query)
+
+        lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s" % parsed.netloc]
+        lines.extend("%s: %s" % header for header in headers.items())
+        if body is not None:
+            lines.append("Content-Length: %d" % len(body))
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + (body or b'')
+
+        writer = None
+        try:
+            reader, writer, reused = await asyncio.wait_for(self.get_connection(key, metrics), timeout)
+            if metrics is not None:
+                metrics.reused = reused
+                metrics.request_bytes = len(body) if body else 0
+            sent = False
+            try:
+                await asyncio.wait_for(self.send(writer, request), timeout)
+                sent = True
+                return await asyncio.wait_for(self.perform(key, reader, writer, method, metrics), timeout)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused or (sent and not idempotent):
+                    raise
+                # the backend may have closed the idle connection, retry
+                # once on a fresh one
+                if metrics is not None:
+                    metrics.retries += 1
+                    metrics.reused = False
+                reader, writer = await asyncio.wait_for(self.open_connection(key, metrics), timeout)
+                await asyncio.wait_for(self.send(writer, request), timeout)
+                return await asyncio.wait_for(self.perform(key, reader, writer, method, metrics), timeout)
+        except asyncio.CancelledError:
+            if writer is not None:
+                writer.close()
+            raise
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as err:
+            if writer is not None:
+                writer.close()
+            raise ThreeScaleConnectionError("Connection error %s: "
+                                            "%s" % (url.split('?', 1)[0], str(err) or type(err).__name__))
+
+
+class ThreeScaleAsyncMixin(object):
+    """Adds the non-blocking transport to a ThreeScale class."""
+
+    # shared by all the instances, see set_async_connection_pool()
+    async_connection_pool = ThreeScaleAsyncConnectionPool()
+
+    def set_async_connection_pool(self, pool):
+        """use a dedicated ThreeScaleAsyncConnectionPool for this instance"""
+        self.async_connection_pool = pool
+
+    async def measure_async(self, call, func, *args):
+        """coroutine version of ThreeScale.measure(): await func(*args,
+        metrics), which returns a ThreeScaleResult, and report the
+        ThreeScaleCallMetrics of the call to the collector."""
+        metrics = ThreeScaleCallMetrics(call)
+        result = error = None
+        try:
+            result = await func(*args + (metrics,))
+            return result
+        except Exception as err:
+            error = err
+            raise
+        finally:
+            metrics.finish(result, error)
+            try:
+                self.collector.collect(metrics)
+            except Exception:
+                pass
+
+    async def send_request_async(self, method, url, body=None, headers=None, timeout=10, idempotent=False,
+                                 metrics=None):
+        """coroutine version of ThreeScale.send_request()"""
+        req_headers = self.get_request_headers()
+        if headers:
+            req_headers.update(headers)
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            raise ThreeScaleCircuitOpenError("Circuit open for %s" % url.split('?', 1)[0])
+        balancer = self.backend_balancer
+        endpoint = None
+        if balancer is not None and url.startswith(self.backend_uri):
+            endpoint = balancer.acquire()
+            url = endpoint.uri + url[len(self.backend_uri):]
+        start = time.time()
+        success = False
+        try:
+            resp = await self.async_connection_pool.request(method, url, body,
+                                                            req_headers, timeout, idempotent, metrics)
+            success = resp.status < 500
+            return resp
+        except ThreeScaleException:
+            raise
+        except Exception as err:
+            # handle all other exceptions
+            raise ThreeScaleException("Unknown error %s: "
+                                      "%s" % (url.split('?', 1)[0], err))
+        finally:
+            if breaker is not None or endpoint is not None:
+                elapsed = time.time() - start
+                if breaker is not None:
+                    breaker.record(success, elapsed)
+                if endpoint is not None:
+                    balancer.release(endpoint, success, elapsed)
+
+    async def send_or_fail_open(self, call, query_url, timeout, credentials={}, metrics=None):
+        """send the GET request of an authrep or authorize call. If the
+        backend can not be reached or answers with a 5xx, and the circuit
+        breaker fails open, return its ThreeScaleResult instead."""
+        breaker = self.circuit_breaker
+        fail_open = breaker is not None and breaker.fail_open
+        try:
+            resp = await self.send_request_async('GET', query_url, timeout=timeout,
+                                                 idempotent=call == 'authorize', metrics=metrics)
+        except ThreeScaleConnectionError:
+            if not fail_open:
+                raise
+            return breaker.fallback(call, self.get_query_string(credentials=credentials))
+        if fail_open and resp.status >= 500:
+            return breaker.fallback(call, self.get_query_string(credentials=credentials))
+        return resp
+
+    async def call_authorize_async(self, app_id=None, app_key=None, user_key=None, usage = { 'hits': 1 },
+                                   other_params = {}, timeout = 10):
+        """coroutine version of ThreeScale.call_authorize(). The
+        authorization cache is used if it is set.
+
+        @returns ThreeScaleResult object.
+        @throws ThreeScaleServerError error, if invalid response is
+        received.
+        @throws ThreeScaleConnectionError error, if connection can not be
+        established.
+        @throws ThreeScaleException error, if any other unknown error is
+        occurred while receiving response for authorize GET api.
+        """
+        credentials = {'app_id': app_id, 'app_key': app_key, 'user_key': user_key}
+        if self.collector is not None:
+            return await self.measure_async('authorize', self.make_authorize_call_async, credentials,
+                                            usage, other_params, timeout)
+        return await self.make_authorize_call_async(credentials, usage, other_params, timeout)
+
+    async def make_authorize_call_async(self, credentials, usage, other_params, timeout, metrics=None):
+        """the authorize call itself, see call_authorize_async()"""
+        self.validate_call(credentials)
+        auth_url = self.get_auth_url()
+        query_url = "%s?%s" % (auth_url, self.get_query_string(other_params, usage, {}, credentials))
+
+        if self.auth_cache is not None:
+            cached = self.auth_cache.get(query_url)
+            if metrics is not None:
+                metrics.cache = 'miss' if cached is None else 'hit'
+            if cached is not None:
+                return ThreeScaleResult('authorize', 200, cached[0], cached[2], True, cached[1])
+
+        resp = await self.send_or_fail_open('authorize', query_url, timeout, credentials, metrics)
+        if isinstance(resp, ThreeScaleResult):
+            return resp
+        result = ThreeScaleResult('authorize', resp.status, resp.body, resp.headers,
+                                  self.check_response(auth_url, resp))
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.remember(self.get_query_string(credentials=credentials), result)
+        if result.success and self.auth_cache is not None:
+            self.auth_cache.set(query_url, result.body, result.get_response(), result.headers)
+        return result
+
+
+class ThreeScaleAsyncAuthRep(ThreeScaleAsyncMixin, ThreeScaleAuthRep):
+    """ThreeScaleAsyncAuthRep(): ThreeScaleAuthRep with a non-blocking
+    authrep_async() call."""
+
+    async def authrep_async(self, usage = { 'hits': 1 }, other_params = {}, log = {}, timeout = 10):
+        """coroutine version of authrep().
+
+        @returns ThreeScaleAuthRepResponse object, see is_authorized() and
+        get_reason().
+        @throws ThreeScaleServerError error, if invalid response is
+        received.
+        @throws ThreeScaleConnectionError error, if connection can not be
+        established.
+        @throws ThreeScaleException error, if any other unknown error is
+        occurred while receiving response for authrep GET api.
+        """
+        self.validate()
+        if self.collector is not None:
+            result = await self.measure_async('authrep', self.make_authrep_call_async,
+                                              usage, other_params, log, timeout)
+        else:
+            result = await self.make_authrep_call_async(usage, other_params, log, timeout)
+        return result.get_response()
+
+    async def make_authrep_call_async(self, usage, other_params, log, timeout, metrics=None):
+        """the authrep call itself, see authrep_async()"""
+        authrep_url = self.get_authrep_url()
+        query_url = "%s?%s" % (authrep_url, self.get_query_string(other_params, usage, log))
+
+        resp = await self.send_or_fail_open('authrep', query_url, timeout, metrics=metrics)
+        if isinstance(resp, ThreeScaleResult):
+            return resp
+        result = ThreeScaleResult('authrep', resp.status, resp.body, resp.headers,
+                                  self.check_response(authrep_url, resp))
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.remember(self.get_query_string(), result)
+        return result
+
+
+class ThreeScaleAsyncAuthRepUserKey(ThreeScaleAuthRepUserKey, ThreeScaleAsyncAuthRep):
+    """ThreeScaleAsyncAuthRepUserKey(): ThreeScaleAuthRepUserKey with a
+    non-blocking authrep_async() call."""
+
+
+class ThreeScaleAsyncAuthorize(ThreeScaleAsyncMixin, ThreeScaleAuthorize):
+    """ThreeScaleAsyncAuthorize(): ThreeScaleAuthorize with a non-blocking
+    authorize_async() call."""
+
+    async def authorize_async(self, timeout = 10, usage = { 'hits': 1 }, other_params = {}):
+        """coroutine version of authorize(). The authorization cache, if
+        set, is used as well.
+
+        @returns ThreeScaleAuthorizeResponse object, see is_authorized().
+        @throws ThreeScaleServerError error, if invalid response is
+        received.
+        @throws ThreeScaleConnectionError error, if connection can not be
+        established.
+        @throws ThreeScaleException error, if any other unknown error is
+        occurred while receiving response for authorize GET api.
+        """
+        self.validate()
+        result = await self.call_authorize_async(self.app_id, self.app_key, self.user_key,
+                                                 usage, other_params, timeout)
+        return result.get_response()
+
+
+class ThreeScaleAsyncAuthorizeUserKey(ThreeScaleAuthorizeUserKey, ThreeScaleAsyncAuthorize):
+    """ThreeScaleAsyncAuthorizeUserKey(): ThreeScaleAuthorizeUserKey with a
+    non-blocking authorize_async() call."""
+
+
+class ThreeScaleAsyncReport(ThreeScaleAsyncMixin, ThreeScaleReport):
+    """ThreeScaleAsyncReport(): ThreeScaleReport with a non-blocking
+    report_async() call."""
+
+    async def report_async(self, transactions, timeout = 10):
+        """coroutine version of report().
+
+        @returns True, if request is sent successfully.
+        @throws ThreeScaleServerError error, if invalid response is
+        received.
+        @throws ThreeScaleConnectionError error, if connection can not be
+        established.
+        @throws ThreeScaleException error, if any other unknown error is
+        occurred while receiving response for report POST api.
+        """
+        if self.collector is not None:
+            result = await self.measure_async('report', self.make_report_call_async, transactions, timeout)
+        else:
+            result = await self.make_report_call_async(transactions, timeout)
+        return result.success
+
+    async def make_report_call_async(self, transactions, timeout, metrics=None):
+        """the report call itself, see report_async()"""
+        report_url = self.get_report_url()
+        data = self.build_post_data(transactions)
+
+        resp = await self.send_request_async('POST', report_url, data, self.POST_HEADERS,
+                                             timeout=timeout, metrics=metrics)
+        return ThreeScaleResult('report', resp.status, resp.body, resp.headers,
+                                self.check_response(report_url, resp, rejected_codes=()))
+
+
+class ThreeScaleASGIMiddleware(ThreeScaleMiddleware):
+    """ThreeScaleASGIMiddleware(app, client, ...)
+    ASGI middleware that authorizes the http requests before they reach
+    app, see ThreeScaleMiddleware. client must have the
+    call_authorize_async() coroutine of ThreeScaleAsyncMixin. The default
+    reporter never blocks the event loop: it drops the usage when its
+    queue is full.
+
+    Usage:
+        client = ThreeScaleAsync.ThreeScaleAsyncAuthorize(service_id = 'your_service_id',
+                                                          service_token = 'your_service_token')
+        app = ThreeScaleAsync.ThreeScaleASGIMiddleware(app, client)
+    """
+
+    def __init__(self, app, client, **kwargs):
+        ThreeScaleMiddleware.__init__(self, client, **kwargs)
+        self.app = app
+
+    def get_credentials(self, scope):
+        if self.extract_credentials is not None:
+            return self.extract_credentials(scope)
+        headers = dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+                       for name, value in scope.get('headers', ()))
+        return self.parse_credentials(scope.get('query_string', b'').decode('latin-1'), headers)
+
+    async def authorize_async(self, credentials, usage):
+        """coroutine version of ThreeScaleMiddleware.authorize()"""
+        rejection = self.check_credentials(credentials)
+        if rejection is not None:
+            return rejection, None
+        try:
+            result = await self.client.call_authorize_async(usage=usage, timeout=self.timeout, **credentials)
+        except ThreeScaleException:
+            return (503, "authorization unavailable"), None
+        return self.check_result(result), result
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        start = time.time()
+        credentials = self.get_credentials(scope)
+        usage = self.get_usage(scope)
+        rejection, result = await self.authorize_async(credentials, usage)
+        timing = {'authorize': time.time() - start}
+        scope = dict(scope)
+        scope['threescale.timing'] = timing
+        scope['threescale.result'] = result
+
+        if rejection is not None:
+            if self.on_timing is not None:
+                self.on_timing(scope, timing)
+            status, reason = rejection
+            body = reason.encode('utf-8')
+            await send({'type': 'http.response.start', 'status': status,
+                        'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                                    (b'content-length', str(len(body)).encode('ascii'))]})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        self.report(credentials, usage)
+        start = time.time()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            timing['app'] = time.time() - start
+            if self.on_timing is not None:
+                self.on_timing(scope, timing)
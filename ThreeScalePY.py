@@ -67,33 +67,517 @@ Report POST API usage:
     resp = report.report(transactions)
 """
 
+import os
 import time
-from lxml import etree
+import bisect
+import hashlib
+import importlib
+import mmap
+import socket
+import struct
+import threading
+import zlib
+from collections import deque, OrderedDict
 
 try:
     # Python 3
-    from urllib.parse import urlencode, quote, urlparse
-    from urllib.request import urlopen, Request
-    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode, quote, unquote, urlparse, parse_qs
+    import http.client as httplib
+    import queue as Queue
 except ImportError:
     # Python 2
-    from urllib import urlencode, quote
-    from urllib2 import urlopen, Request, HTTPError, URLError
-    from urlparse import urlparse
+    from urllib import urlencode, quote, unquote
+    from urlparse import urlparse, parse_qs
+    import httplib
+    import Queue
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, the shared cache is then only safe within a process
+    fcntl = None
 
 __version__ = '2.6.0'
 
-__all__ = ['ThreeScale',
+__all__ = ['ThreeScale', 'ThreeScaleConnectionPool', 'ThreeScaleHTTPResponse',
            'ThreeScaleAuthRep', 'ThreeScaleAuthRepUserKey', 'ThreeScaleAuthRepResponse', 
            'ThreeScaleAuthorize', 'ThreeScaleAuthorizeUserKey', 'ThreeScaleAuthorizeResponse',
-           'ThreeScaleReport', 'ThreeScaleAuthorizeResponseUsageReport'
+           'ThreeScaleReport', 'ThreeScaleAuthorizeResponseUsageReport',
+           'ThreeScaleAuthorizeCache', 'ThreeScaleSharedAuthorizeCache',
+           'ThreeScaleBatchReporter', 'ThreeScaleResult',
+           'ThreeScaleQuotaLimiter', 'ThreeScaleSingleFlight',
+           'ThreeScaleCircuitBreaker', 'ThreeScaleCircuitOpenError',
+           'ThreeScaleHedger', 'ThreeScaleBackendBalancer', 'ThreeScaleSpoolReporter',
+           'ThreeScaleUsageAggregator', 'ThreeScaleMultiServiceReporter', 'ThreeScaleBatchResult',
+           'ThreeScaleMiddleware', 'ThreeScaleWSGIMiddleware',
+           'ThreeScaleCallMetrics', 'ThreeScaleCollector', 'ThreeScaleLoggingCollector',
+           'ThreeScalePrometheusCollector', 'ThreeScaleLazyAuthRepResponse',
+           'ThreeScaleLazyAuthorizeResponse', 'set_xml_backend'
           ]
 
+def timegm(timestamp):
+    """convert a struct_time to seconds since the epoch. Its UTC offset is
+    taken into account if it has one, i.e. on Python 3, and it is taken as
+    UTC otherwise."""
+    # imported here to keep the module quick to import
+    import calendar
+    return calendar.timegm(timestamp) - (getattr(timestamp, 'tm_gmtoff', None) or 0)
+
+def parse_period(value):
+    """convert a usage report period bound, e.g. '2010-04-26 00:00:00 +0000',
+    to seconds since the epoch."""
+    import calendar
+    # the format is fixed, slicing it is several times faster than strptime
+    seconds = calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                               int(value[11:13]), int(value[14:16]), int(value[17:19])))
+    offset = value[19:].strip()
+    if offset:
+        delta = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+        seconds += delta if offset[0] == '-' else -delta
+    return seconds
+
+# (name, module) of the xml backends, in the order they are tried
+XML_BACKENDS = (('lxml', 'lxml.etree'), ('etree', 'xml.etree.ElementTree'))
+
+# fromstring() of the xml backend, loaded on first use, see set_xml_backend()
+xml_fromstring = None
+
+def set_xml_backend(backend=None):
+    """parse the responses with backend: 'lxml', 'etree' for the
+    xml.etree.ElementTree module of the standard library, or a function
+    returning the root element of a body, with the ElementTree API. By
+    default lxml is used if it is installed, and etree otherwise.
+
+    @throws ThreeScaleException error, if the backend is unknown or not
+    installed.
+    """
+    global xml_fromstring
+    if callable(backend):
+        xml_fromstring = backend
+        return
+    for name, module in XML_BACKENDS:
+        if backend in (None, name):
+            try:
+                xml_fromstring = importlib.import_module(module).fromstring
+                return
+            except ImportError:
+                if backend is not None:
+                    raise ThreeScaleException("XML backend %s is not installed" % backend)
+    raise ThreeScaleException("Unknown XML backend %s" % backend)
+
+def parse_xml(body):
+    """parse a response body, returning its root element.
+
+    @throws ThreeScaleException error, if the xml is not valid.
+    """
+    if xml_fromstring is None:
+        set_xml_backend()
+    try:
+        return xml_fromstring(body)
+    except Exception as err:
+        raise ThreeScaleException("Invalid xml %s" % err)
+
+def escape(text):
+    """escape the text of an xml element"""
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def find_reason(xml):
+    """return the rejection reason of a <status> or <error> document"""
+    if xml.tag == 'error':
+        return xml.text
+    for child in xml:
+        if child.tag == 'reason':
+            return child.text
+    return None
+
+# value of the lazy response parts not parsed yet
+UNPARSED = object()
+
+def read_extension_headers(resp, headers):
+    """set the rejection reason and the limits a response got in the
+    headers asked for with ThreeScale.set_backend_options()"""
+    reason = headers.get('3scale-rejection-reason')
+    if reason is not None:
+        resp.set_reason(reason)
+    for name in ('remaining', 'reset', 'max_value'):
+        value = headers.get('3scale-limit-%s' % name.replace('_', '-'))
+        if value is not None:
+            try:
+                setattr(resp, 'limit_%s' % name, int(value))
+            except ValueError:
+                pass
+
+def get_extension_headers(headers):
+    """return the 3scale-* headers of a response, the ones read by
+    read_extension_headers()"""
+    return dict((name, value) for name, value in headers.items() if name.startswith('3scale-'))
+
+def run_parallel(func, items, max_workers):
+    """call func(item) for every item of an iterable from up to max_workers
+    threads, and yield (item, result, exception) as the calls complete.
+    The items are taken from the iterable as the threads become free, so
+    it can be a generator.
+    """
+    items = iter(items)
+    lock = threading.Lock()
+    stop = threading.Event()
+    outcomes = Queue.Queue(max_workers)
+    errors = []
+    done = object()
+
+    def put(outcome):
+        while not stop.is_set():
+            try:
+                outcomes.put(outcome, True, 0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def work():
+        while not stop.is_set():
+            with lock:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                except Exception as err:
+                    errors.append(err)
+                    break
+            try:
+                put((item, func(item), None))
+            except Exception as err:
+                put((item, None, err))
+        put(done)
+
+    for i in range(max_workers):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        running = max_workers
+        while running:
+            outcome = outcomes.get()
+            if outcome is done:
+                running -= 1
+            else:
+                yield outcome
+    finally:
+        stop.set()
+    if errors:
+        raise errors[0]
+
+class ThreeScaleHTTPResponse(object):
+    """Status line, headers and body of a response read from the backend."""
+    __slots__ = ('status', 'reason', 'headers', 'body')
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+def connect_time(phases):
+    """time spent opening the connection, in the phases of a call"""
+    return phases.get('dns', 0) + phases.get('connect', 0) + phases.get('tls', 0)
+
+class ThreeScaleHTTPConnection(httplib.HTTPConnection):
+    """HTTPConnection which, while its phases dict is set, records the time
+    spent resolving the host in 'dns' and opening the TCP connection in
+    'connect'. sent tells whether the last request was fully written.
+    Through an http proxy, proxy_prefix is the scheme and host put in
+    front of the paths, and proxy_headers are sent with every request."""
+    phases = None
+    sent = False
+    proxy_prefix = None
+    proxy_headers = None
+
+    def connect(self):
+        phases = self.phases
+        if phases is None:
+            return httplib.HTTPConnection.connect(self)
+        start = time.time()
+        addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        resolved = time.time()
+        phases['dns'] = resolved - start
+        error = None
+        for address in addresses:
+            try:
+                self.sock = socket.create_connection(address[4][:2], self.timeout,
+                                                     self.source_address)
+                break
+            except socket.error as err:
+                error = err
+        else:
+            raise error or socket.error("getaddrinfo returned no address")
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if getattr(self, '_tunnel_host', None):
+            # through a proxy, the CONNECT is part of the connection
+            self._tunnel()
+        phases['connect'] = time.time() - resolved
+
+if hasattr(httplib, 'HTTPSConnection'):
+    class ThreeScaleHTTPSConnection(httplib.HTTPSConnection, ThreeScaleHTTPConnection):
+        """HTTPSConnection which also records the time spent in the TLS
+        handshake in 'tls'. On Python 2 the whole handshake is recorded
+        in 'connect'."""
+
+        def connect(self):
+            phases = self.phases
+            if phases is None:
+                return httplib.HTTPSConnection.connect(self)
+            start = time.time()
+            httplib.HTTPSConnection.connect(self)
+            elapsed = time.time() - start
+            if 'connect' in phases:
+                phases['tls'] = max(0, elapsed - phases.get('dns', 0) - phases['connect'])
+            else:
+                phases['connect'] = elapsed
+else:
+    ThreeScaleHTTPSConnection = None
+
+
+class ThreeScaleConnectionPool(object):
+    """Pool of persistent (keep-alive) HTTP connections to the backend.
+
+    Connections are kept per (scheme, host, port) and reused across calls
+    and threads, so the TCP and TLS handshakes are paid once per connection
+    instead of once per call. At most max_size idle connections are kept for
+    each host, and connections that stayed idle for longer than idle_timeout
+    seconds are closed instead of being reused. max_size does not limit the
+    connections in use: a call which finds no idle connection opens a new
+    one.
+
+    A request which fails on a reused connection, e.g. because the backend
+    closed it while it was idle, is sent again once on a new connection if
+    it was not written yet, or if it is idempotent. A report or an authrep
+    is never sent twice.
+
+    The idle connections inherited from the parent of a forked process,
+    e.g. a pre-fork server master, are dropped instead of being shared
+    with it.
+
+    Like urllib, the connections go through the proxies of the
+    environment, e.g. HTTPS_PROXY, except for the hosts in NO_PROXY: https
+    requests through a CONNECT tunnel, http ones with the absolute URI. The
+    proxy of a host is looked up on its first connection, and again after
+    clear().
+    """
+
+    DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+    def __init__(self, max_size=10, idle_timeout=30):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.proxies = {}
+        self.pid = os.getpid()
+
+    def check_fork(self):
+        """drop the idle connections of the parent process after a fork.
+        Closing them only closes the file descriptors of this process."""
+        if self.pid == os.getpid():
+            return
+        # the lock may have been held by another thread of the parent
+        self.lock = threading.Lock()
+        connections, self.connections = self.connections, {}
+        self.pid = os.getpid()
+        for idle in connections.values():
+            for conn, _ in idle:
+                conn.close()
+
+    def find_proxy(self, key):
+        """return the (host, port, headers) of the proxy of the environment
+        for the (scheme, host, port) key, or None to connect directly."""
+        scheme, host, port = key
+        # imported here to keep the module quick to import
+        try:
+            from urllib.request import getproxies, proxy_bypass
+        except ImportError:
+            from urllib import getproxies, proxy_bypass
+        proxy = getproxies().get(scheme)
+        if not proxy or proxy_bypass(host):
+            return None
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parsed = urlparse(proxy)
+        headers = {}
+        if parsed.username:
+            import base64
+            credentials = "%s:%s" % (unquote(parsed.username), unquote(parsed.password or ''))
+            headers['Proxy-Authorization'] = "Basic %s" % base64.b64encode(
+                credentials.encode(ThreeScale.ENCODING)).decode('ascii')
+        return parsed.hostname, parsed.port or 80, headers
+
+    def new_connection(self, key, timeout):
+        """open a new connection for the (scheme, host, port) key"""
+        scheme, host, port = key
+        if key not in self.proxies:
+            self.proxies[key] = self.find_proxy(key)
+        proxy = self.proxies[key]
+        if proxy is None:
+            if scheme == 'https':
+                return ThreeScaleHTTPSConnection(host, port, timeout=timeout)
+            return ThreeScaleHTTPConnection(host, port, timeout=timeout)
+
+        proxy_host, proxy_port, proxy_headers = proxy
+        if scheme == 'https':
+            conn = ThreeScaleHTTPSConnection(proxy_host, proxy_port, timeout=timeout)
+            conn.set_tunnel(host, port, proxy_headers)
+        else:
+            conn = ThreeScaleHTTPConnection(proxy_host, proxy_port, timeout=timeout)
+            conn.proxy_prefix = "http://%s" % host if port == 80 else "http://%s:%d" % (host, port)
+            conn.proxy_headers = proxy_headers
+        return conn
+
+    def get_connection(self, key, timeout):
+        """return a tuple (connection, reused), taking the most recently
+        used idle connection for the key if there is one."""
+        self.check_fork()
+        expired = []
+        conn = None
+        with self.lock:
+            idle = self.connections.get(key)
+            if idle:
+                deadline = time.time() - self.idle_timeout
+                while idle and idle[0][1] < deadline:
+                    expired.append(idle.popleft()[0])
+                if idle:
+                    conn = idle.pop()[0]
+        for old in expired:
+            old.close()
+
+        if conn is None:
+            return self.new_connection(key, timeout), False
+
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def release(self, key, conn):
+        """give a connection back to the pool, closing it if the pool for
+        the key is already full."""
+        with self.lock:
+            idle = self.connections.setdefault(key, deque())
+            if len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def clear(self):
+        """close all the idle connections, and forget the proxies"""
+        with self.lock:
+            connections, self.connections = self.connections, {}
+            self.proxies = {}
+        for idle in connections.values():
+            for conn, _ in idle:
+                conn.close()
+
+    def perform(self, key, conn, method, path, body, headers, metrics=None):
+        if metrics is not None:
+            phases = conn.phases = metrics.phases
+            connected = connect_time(phases)
+            start = time.time()
+        if conn.proxy_prefix is not None:
+            path = conn.proxy_prefix + path
+            if conn.proxy_headers:
+                headers = dict(headers, **conn.proxy_headers)
+        conn.sent = False
+        conn.request(method, path, body, headers)
+        conn.sent = True
+        resp = conn.getresponse()
+        if metrics is not None:
+            first_byte = time.time()
+        data = resp.read()
+        if metrics is not None:
+            conn.phases = None
+            phases['ttfb'] = first_byte - start - (connect_time(phases) - connected)
+            phases['body'] = time.time() - first_byte
+            metrics.status = resp.status
+            metrics.request_bytes = len(body) if body else 0
+            metrics.response_bytes = len(data)
+        response = ThreeScaleHTTPResponse(resp.status, resp.reason,
+                                          dict((k.lower(), v) for k, v in resp.getheaders()),
+                                          data)
+        if resp.will_close:
+            conn.close()
+        else:
+            self.release(key, conn)
+        return response
+
+    def request(self, method, url, body=None, headers={}, timeout=10, metrics=None, idempotent=False):
+        """send the request over a pooled connection. The phases of the
+        request are recorded in metrics, a ThreeScaleCallMetrics, if it is
+        given. Only an idempotent request is sent again once it has been
+        written.
+
+        @returns ThreeScaleHTTPResponse object, whatever the HTTP status is.
+        @throws ThreeScaleConnectionError error, if the connection can not
+        be established or is lost before the response is read.
+        """
+        parsed = urlparse(url)
+        key = (parsed.scheme, parsed.hostname,
+               parsed.port or self.DEFAULT_PORTS.get(parsed.scheme))
+        path = parsed.path or '/'
+        if parsed.query:
+            path = "%s?%s" % (path, parsed.query)
+
+        conn, reused = self.get_connection(key, timeout)
+        if metrics is not None:
+            metrics.reused = reused
+        try:
+            try:
+                return self.perform(key, conn, method, path, body, headers, metrics)
+            except (httplib.HTTPException, socket.error) as err:
+                conn.close()
+                if not reused or isinstance(err, socket.timeout) or (conn.sent and not idempotent):
+                    raise
+                # the backend may have closed the idle connection, retry
+                # once on a fresh one
+                if metrics is not None:
+                    metrics.retries += 1
+                    metrics.reused = False
+                conn = self.new_connection(key, timeout)
+                return self.perform(key, conn, method, path, body, headers, metrics)
+        except (httplib.HTTPException, socket.error) as err:
+            conn.close()
+            raise ThreeScaleConnectionError("Connection error %s: "
+                                            "%s" % (url.split('?', 1)[0], err))
+
+
 class ThreeScale:
 
     DEFAULT_BACKEND_URI = 'https://su1.3scale.net:443'
     ENCODING = 'utf-8'
 
+    # shared by all the instances, see set_connection_pool()
+    connection_pool = ThreeScaleConnectionPool()
+    auth_cache = None
+    quota_limiter = None
+    single_flight = None
+    circuit_breaker = None
+    hedger = None
+    backend_balancer = None
+    collector = None
+    # value of the 3scale-options header, see set_backend_options()
+    backend_options = None
+
+    # shared by the instances with the same backend URIs
+    BACKEND_BALANCERS = {}
+
+    POST_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    # application credentials first, then the service ones
+    CREDENTIAL_KEYS = ('app_id', 'app_key', 'user_key', 'provider_key', 'service_id', 'service_token')
+    encoded_credentials = None
+
+    # shared by all the instances, see encode_usage()
+    ENCODED_USAGES = {}
+    MAX_ENCODED_USAGES = 1024
+
     def validate_backend_uri(self, uri):
         parsed = urlparse(uri)
         valid = True if parsed.scheme in ['http','https'] and parsed.netloc else False
@@ -109,6 +593,9 @@ class ThreeScale:
         - service_id
         - service_token
 
+        backend_uri can be a list of the URIs of several backend replicas,
+        the calls are then spread over them by a ThreeScaleBackendBalancer.
+
         The application id and key are optional. If it is omitted, the
         provider key alone is set. This is useful when the class is
         inherited by ThreeScaleReport class, for which application id
@@ -120,10 +607,22 @@ class ThreeScale:
 
         """
 
-        if backend_uri and not self.validate_backend_uri(backend_uri):
-            raise ThreeScaleException("The backend URI '%s' is invalid" % backend_uri)
+        if isinstance(backend_uri, (list, tuple)):
+            uris = tuple(backend_uri)
+            backend_uri = uris[0] if uris else ""
+        else:
+            uris = (backend_uri,)
+
+        for uri in uris:
+            if uri and not self.validate_backend_uri(uri):
+                raise ThreeScaleException("The backend URI '%s' is invalid" % uri)
 
         self.backend_uri = backend_uri or ThreeScale.DEFAULT_BACKEND_URI
+        if len(uris) > 1:
+            balancer = ThreeScale.BACKEND_BALANCERS.get(uris)
+            if balancer is None:
+                balancer = ThreeScale.BACKEND_BALANCERS.setdefault(uris, ThreeScaleBackendBalancer(uris))
+            self.backend_balancer = balancer
 
         self.app_id = app_id
         self.app_key = app_key
@@ -137,9 +636,12 @@ class ThreeScale:
             err.append("Provider key or service token and service ID must be defined")
             raise ThreeScaleException(': '.join(err))
 
+        self.get_encoded_credentials()
+
     def get_base_url(self):
         """return the base url for using with authorize and report
-        APIs"""
+        APIs. With several backend URIs this is the first one, the
+        requests are sent to the one picked by the balancer."""
         return self.backend_uri
 
     def get_authrep_url(self):
@@ -166,30 +668,593 @@ class ThreeScale:
           dict_params[k] = dict[key]
         return dict_params
 
-    def get_query_string(self, other_params = {}, usage = {}, log = {}):
-        """get the url encoded query string"""
-
-        params = {}
-        keys = ['app_id', 'app_key', 'user_key', 'provider_key', 'service_id', 'service_token']
+    def get_encoded_credentials(self):
+        """return the url encoded (application, service) credentials of
+        the instance. They are encoded once, and again only if one of the
+        credentials attributes is changed."""
+        values = (self.app_id, self.app_key, self.user_key,
+                  self.provider_key, self.service_id, self.service_token)
+        cached = self.encoded_credentials
+        if cached is None or cached[0] != values:
+            params = [(key, value) for key, value in zip(self.CREDENTIAL_KEYS, values)]
+            cached = (values,
+                      urlencode([param for param in params[:3] if param[1]]),
+                      urlencode([param for param in params[3:] if param[1]]))
+            self.encoded_credentials = cached
+        return cached[1], cached[2]
+
+    def encode_usage(self, usage):
+        """url encode the usage, e.g. {'hits': 1} to 'usage%5Bhits%5D=1'.
+        The encoding of the most common usages is remembered, by value and
+        type, since True, 1.0 and 1 are equal but are encoded differently."""
+        try:
+            key = tuple(usage.items()) + tuple(map(type, usage.values()))
+            return self.ENCODED_USAGES[key]
+        except KeyError:
+            encoded = urlencode(self.dict_to_params(usage, "usage"))
+            if len(self.ENCODED_USAGES) < self.MAX_ENCODED_USAGES:
+                self.ENCODED_USAGES[key] = encoded
+            return encoded
+        except TypeError:
+            return urlencode(self.dict_to_params(usage, "usage"))
+
+    def get_app_credentials(self, credentials = {}):
+        """return the (key, value) application credentials of a call: the
+        ones in credentials if any is set there, the ones of the instance
+        otherwise. They are never mixed, so that the app_id of a call is
+        not sent with the app_key of the instance."""
+        keys = self.CREDENTIAL_KEYS[:3]
+        if credentials and any(credentials.get(key) for key in keys):
+            return [(key, credentials[key]) for key in keys if credentials.get(key)]
+        return [(key, self.__dict__[key]) for key in keys if self.__dict__[key]]
+
+    def get_query_string(self, other_params = {}, usage = {}, log = {}, credentials = {}):
+        """get the url encoded query string. The application credentials
+        in credentials, if any, replace the ones of the instance."""
+
+        if other_params and any(key in other_params for key in self.CREDENTIAL_KEYS):
+            # other_params override the credentials, merge everything
+            params = dict(self.get_app_credentials(credentials))
+            for key in self.CREDENTIAL_KEYS[3:]:
+                if self.__dict__[key]:
+                    params[key] = self.__dict__[key]
+            params.update(other_params)
+            if usage:
+                params.update(self.dict_to_params(usage, "usage"))
+            if log:
+                params.update(self.dict_to_params(log, "log"))
+            return urlencode(params)
 
-        for key in keys:
-            value = self.__dict__[key]
-            if value:
-                params[key] = value
+        app_query, service_query = self.get_encoded_credentials()
+        if credentials and any(credentials.values()):
+            app_query = urlencode(self.get_app_credentials(credentials))
 
+        parts = [app_query, service_query]
         if other_params:
-            params.update(other_params)
+            parts.append(urlencode(other_params))
         if usage:
-            params.update(self.dict_to_params(usage, "usage"))
+            parts.append(self.encode_usage(usage))
         if log:
-            params.update(self.dict_to_params(log, "log"))
+            parts.append(urlencode(self.dict_to_params(log, "log")))
+        return '&'.join([part for part in parts if part])
+
+    def build_post_data(self, transactions):
+        if self.service_token:
+            body_params = "service_token=%s" % (self.service_token)
+        else:
+            body_params = "provider_key=%s" % (self.provider_key)
+        if self.service_id:
+            body_params = "%s&service_id=%s" % (body_params, self.service_id)
+        chunks = [body_params]
+        chunks.extend(self.iter_encoded_transactions(transactions))
+        return ''.join(chunks).encode(ThreeScale.ENCODING)
+
+    def encode_transactions(self, transactions):
+        """url encode the transactions, e.g.
+        '&transactions[0][app_id]=foo&transactions[0][usage][hits]=1'.
+        The chunks are joined once, so the cost is linear in the number of
+        transactions, see benchmarks/bench_encode.py.
+
+        @throws ThreeScaleException error, if transaction is invalid.
+        """
+        return ''.join(self.iter_encoded_transactions(transactions))
+
+    def iter_encoded_transactions(self, transactions):
+        """generator version of encode_transactions(), yielding the url
+        encoded fields one at a time. transactions can be any iterable of
+        dicts, including a generator.
 
-        return urlencode(params)
+        @throws ThreeScaleException error, if transaction is invalid.
+        """
+        if isinstance(transactions, (dict, str, bytes, type(u''))):
+            raise ThreeScaleException("Invalid transaction type")
+        try:
+            transactions = iter(transactions)
+        except TypeError:
+            raise ThreeScaleException("Invalid transaction type")
+
+        # transactions tend to repeat the same values, quote them only once
+        quoted = {}
+        i = 0
+        for trans in transactions:
+            for field in self.iter_encoded_fields("&transactions[%d]" % i, trans, quoted):
+                yield field
+            i += 1
+
+    def iter_encoded_fields(self, prefix, trans, quoted):
+        """yield the url encoded fields of a transaction, nested dicts
+        such as usage and log included.
+
+        @throws ThreeScaleException error, if the transaction or its
+        timestamp are invalid.
+        """
+        try:
+            items = trans.items()
+        except AttributeError:
+            raise ThreeScaleException("Invalid transaction %r" % (trans,))
+
+        for key, value in items:
+            if isinstance(value, dict):
+                for field in self.iter_encoded_fields("%s[%s]" % (prefix, key), value, quoted):
+                    yield field
+                continue
+
+            if key == 'timestamp': # specially encode the timestamp
+                try:
+                    encoded = quoted.get(('timestamp', value))
+                    if encoded is None:
+                        encoded = quote(time.strftime('%Y-%m-%d %H:%M:%S %z', value))
+                        quoted[('timestamp', value)] = encoded
+                except Exception:
+                    raise ThreeScaleException("Invalid timestamp "
+                                              "'%s' specified in "
+                                              "transaction" % (value,))
+            elif type(value) is int:
+                encoded = str(value)
+            else:
+                # keyed by type too, True and 1.0 are equal but quoted apart
+                memo = (type(value), value)
+                try:
+                    encoded = quoted.get(memo)
+                    if encoded is None:
+                        encoded = quoted[memo] = quote(str(value))
+                except TypeError:
+                    encoded = quote(str(value))
+            yield "%s[%s]=%s" % (prefix, key, encoded)
+
+    def encode_recursive(self, prefix, trans):
+        """encode every value in transactions
+        @throws ThreeScaleException error, if the timestamp specified in
+        transaction is invalid.
+        """
+        return ''.join(self.iter_encoded_fields(prefix, trans, {}))
 
     def add_version_header(self, req):
         version_header = "plugin-python-v%s" % __version__
         req.add_header('X-3scale-User-Agent', version_header)    
 
+    def get_request_headers(self):
+        """return the headers sent with every request to the backend"""
+        headers = {'X-3scale-User-Agent': "plugin-python-v%s" % __version__}
+        if self.backend_options is not None:
+            headers['3scale-options'] = self.backend_options
+        return headers
+
+    def set_backend_options(self, no_body=False, rejection_reason_header=False,
+                            limit_headers=False):
+        """ask the backend for extensions of its responses to the calls of
+        this instance:
+        - no_body: leave the xml body out of authrep and authorize
+          responses, so there is nothing to parse.
+        - rejection_reason_header: give the reason of a rejection, e.g.
+          'limits_exceeded', in the 3scale-rejection-reason header.
+        - limit_headers: give the remaining calls of the most limiting
+          usage limit and the seconds to its reset in the
+          3scale-limit-remaining and 3scale-limit-reset headers.
+        The responses then get them from the headers, see
+        ThreeScaleAuthorizeResponse.get_limit_remaining(). Without a body
+        there are no plan and usage reports, and a ThreeScaleQuotaLimiter
+        has nothing to work with.
+        """
+        options = [(name, 1) for name, value in (('limit_headers', limit_headers),
+                                                  ('no_body', no_body),
+                                                  ('rejection_reason_header', rejection_reason_header))
+                   if value]
+        self.backend_options = urlencode(options) if options else None
+
+    def set_connection_pool(self, pool):
+        """use a dedicated ThreeScaleConnectionPool for this instance
+        instead of the one shared by all the ThreeScale instances."""
+        self.connection_pool = pool
+
+    def send_request(self, method, url, body=None, headers=None, timeout=10, metrics=None, idempotent=False):
+        """send a request to the backend through the connection pool,
+        recording its phases in metrics if it is given. An idempotent
+        request may be sent twice, see ThreeScaleConnectionPool.
+
+        @returns ThreeScaleHTTPResponse object.
+        @throws ThreeScaleConnectionError error, if connection can not be
+        established.
+        @throws ThreeScaleException error, if any other unknown error is
+        occurred while sending the request.
+        """
+        req_headers = self.get_request_headers()
+        if headers:
+            req_headers.update(headers)
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            raise ThreeScaleCircuitOpenError("Circuit open for %s" % url.split('?', 1)[0])
+        balancer = self.backend_balancer
+        endpoint = None
+        if balancer is not None and url.startswith(self.backend_uri):
+            endpoint = balancer.acquire()
+            url = endpoint.uri + url[len(self.backend_uri):]
+        start = time.time()
+        success = False
+        try:
+            resp = self.connection_pool.request(method, url, body,
+                                                req_headers, timeout, metrics, idempotent)
+            success = resp.status < 500
+            return resp
+        except ThreeScaleException:
+            raise
+        except Exception as err:
+            # handle all other exceptions
+            raise ThreeScaleException("Unknown error %s: "
+                                      "%s" % (url.split('?', 1)[0], err))
+        finally:
+            if breaker is not None or endpoint is not None:
+                elapsed = time.time() - start
+                if breaker is not None:
+                    breaker.record(success, elapsed)
+                if endpoint is not None:
+                    balancer.release(endpoint, success, elapsed)
+
+    def set_auth_cache(self, cache):
+        """cache the successful authorizations of this instance in a
+        ThreeScaleAuthorizeCache. The same cache can be shared by several
+        instances."""
+        self.auth_cache = cache
+
+    def set_quota_limiter(self, limiter):
+        """enforce the usage limits locally with a ThreeScaleQuotaLimiter.
+        The same limiter can be shared by several instances."""
+        self.quota_limiter = limiter
+
+    def set_single_flight(self, single_flight):
+        """coalesce the concurrent identical authorize calls with a
+        ThreeScaleSingleFlight. authrep calls are never coalesced, since
+        each of them reports usage."""
+        self.single_flight = single_flight
+
+    def set_backend_balancer(self, balancer):
+        """spread the calls of this instance over the backend URIs of a
+        ThreeScaleBackendBalancer. The first URI must be backend_uri."""
+        self.backend_balancer = balancer
+
+    def set_circuit_breaker(self, breaker):
+        """send the calls of this instance through a ThreeScaleCircuitBreaker,
+        which fails them fast while the backend is down. Set it on the
+        ThreeScale class to protect all the instances."""
+        self.circuit_breaker = breaker
+
+    def set_hedger(self, hedger):
+        """hedge the authorize calls of this instance with a
+        ThreeScaleHedger. authrep calls are then split into a hedged
+        authorize and a report of the usage, so that it is never counted
+        twice."""
+        self.hedger = hedger
+
+    def set_collector(self, collector):
+        """report the timings of the calls of this instance to a
+        ThreeScaleCollector. Set it on the ThreeScale class to instrument
+        all the instances."""
+        self.collector = collector
+
+    def measure(self, call, func, *args):
+        """run func(*args, metrics) and report the ThreeScaleCallMetrics
+        of the call to the collector. The response is not part of the call:
+        it is only parsed when the caller asks for a part of it. An
+        exception raised by the collector is ignored, so that it neither
+        fails the call nor hides its error."""
+        metrics = ThreeScaleCallMetrics(call)
+        result = error = None
+        try:
+            result = func(*args + (metrics,))
+            return result
+        except Exception as err:
+            error = err
+            raise
+        finally:
+            metrics.finish(result, error)
+            try:
+                self.collector.collect(metrics)
+            except Exception:
+                pass
+
+    def validate_call(self, credentials):
+        """check that a call has application credentials, either passed
+        to the call or set on the instance.
+
+        @throws ThreeScaleException error, if neither an application id nor
+        a user key is defined.
+        """
+        if not (credentials.get('app_id') or credentials.get('user_key')
+                or self.app_id or self.user_key):
+            raise ThreeScaleException("App Id or user key not defined")
+
+    def call_authrep(self, app_id=None, app_key=None, user_key=None, usage = { 'hits': 1 },
+                     other_params = {}, log = {}, timeout = 10):
+        """invoke the authrep GET request with the credentials of the call,
+        which override the ones of the instance. Nothing is stored in the
+        instance, so it can be shared between threads.
+
+        @returns ThreeScaleResult object.
+        @throws ThreeScaleServerError error, if invalid response is
+        received.
+        @throws ThreeScaleConnectionError error, if connection can not be
+        established.
+        @throws ThreeScaleException error, if any other unknown error is
+        occurred while receiving response for authrep GET api.
+        """
+        credentials = {'app_id': app_id, 'app_key': app_key, 'user_key': user_key}
+        if self.collector is not None:
+            return self.measure('authrep', self.make_authrep_call, credentials, usage,
+                                other_params, log, timeout)
+        return self.make_authrep_call(credentials, usage, other_params, log, timeout)
+
+    def make_authrep_call(self, credentials, usage, other_params, log, timeout, metrics=None):
+        """the authrep call itself, see call_authrep()"""
+        self.validate_call(credentials)
+        authrep_url = self.get_authrep_url()
+        query_url = "%s?%s" % (authrep_url, self.get_query_string(other_params, usage, log, credentials))
+
+        limiter = self.quota_limiter
+        breaker = self.circuit_breaker
+        if limiter is not None or breaker is not None:
+            app = self.get_query_string(credentials=credentials)
+        if limiter is not None:
+            if limiter.check(app, usage) == limiter.REJECT:
+                return limiter.build_rejection('authrep', app)
+
+        try:
+            if self.hedger is not None:
+                result = self.split_authrep(credentials, usage, other_params, log, timeout, metrics)
+            else:
+                resp = self.send_request('GET', query_url, timeout=timeout, metrics=metrics)
+                result = ThreeScaleResult('authrep', resp.status, resp.body, resp.headers,
+                                          self.check_response(authrep_url, resp))
+        except (ThreeScaleConnectionError, ThreeScaleServerError) as err:
+            if not self.fails_open(err):
+                raise
+            return breaker.fallback('authrep', app)
+        if limiter is not None:
+            limiter.update_from_result(app, result)
+        if breaker is not None:
+            breaker.remember(app, result)
+        return result
+
+    def call_authorize(self, app_id=None, app_key=None, user_key=None, usage = { 'hits': 1 },
+                       other_params = {}, timeout = 10):
+        """invoke the authorize GET request with the credentials of the
+        call, which override the ones of the instance. The authorization
+        cache is used if it is set. Nothing is stored in the instance, so
+        it can be shared between threads.
+
+        @returns ThreeScaleResult object.
+        @throws ThreeScaleServerError error, if invalid response is
+        received.
+        @throws ThreeScaleConnectionError error, if connection can not be
+        established.
+        @throws ThreeScaleException error, if any other unknown error is
+        occurred while receiving response for authorize GET api.
+        """
+        credentials = {'app_id': app_id, 'app_key': app_key, 'user_key': user_key}
+        if self.collector is not None:
+            return self.measure('authorize', self.make_authorize_call, credentials, usage,
+                                other_params, timeout)
+        return self.make_authorize_call(credentials, usage, other_params, timeout)
+
+    def make_authorize_call(self, credentials, usage, other_params, timeout, metrics=None):
+        """the authorize call itself, see call_authorize()"""
+        self.validate_call(credentials)
+        auth_url = self.get_auth_url()
+        query_url = "%s?%s" % (auth_url, self.get_query_string(other_params, usage, {}, credentials))
+
+        limiter = self.quota_limiter
+        breaker = self.circuit_breaker
+        decision = None
+        if limiter is not None or breaker is not None:
+            app = self.get_query_string(credentials=credentials)
+        if limiter is not None:
+            decision = limiter.check(app, usage)
+            if decision == limiter.REJECT:
+                return limiter.build_rejection('authorize', app)
+
+        if self.auth_cache is not None and decision != ThreeScaleQuotaLimiter.SYNC:
+            cached = self.auth_cache.get(query_url)
+            if metrics is not None:
+                metrics.cache = 'miss' if cached is None else 'hit'
+            if cached is not None:
+                if limiter is not None:
+                    limiter.consume(app, usage)
+                return ThreeScaleResult('authorize', 200, cached[0], cached[2], True, cached[1])
+
+        try:
+            if self.single_flight is not None:
+                result = self.single_flight.do(
+                    query_url, lambda: self.send_authorize(auth_url, query_url, timeout, metrics),
+                    timeout)
+            else:
+                result = self.send_authorize(auth_url, query_url, timeout, metrics)
+        except (ThreeScaleConnectionError, ThreeScaleServerError) as err:
+            if not self.fails_open(err):
+                raise
+            return breaker.fallback('authorize', app)
+        if result.success and self.auth_cache is not None:
+            self.auth_cache.set(query_url, result.body, result.get_response(), result.headers)
+        if limiter is not None:
+            limiter.update_from_result(app, result)
+        if breaker is not None:
+            breaker.remember(app, result)
+        return result
+
+    def split_authrep(self, credentials, usage, other_params, log, timeout, metrics=None):
+        """authrep as an authorize followed, if it is successful, by a
+        report of the usage, with other_params and log, which does not
+        delay or fail the call, see ThreeScaleHedger. Used when hedging,
+        since a hedged authrep could count the usage twice."""
+        auth_url = self.get_auth_url()
+        query_url = "%s?%s" % (auth_url, self.get_query_string(other_params, usage, {}, credentials))
+        auth = self.send_authorize(auth_url, query_url, timeout, metrics)
+        if auth.success:
+            transaction = dict((key, value) for key, value in self.get_app_credentials(credentials)
+                               if key != 'app_key')
+            for key, value in other_params.items():
+                if key == 'app_key' or key in self.CREDENTIAL_KEYS[3:]:
+                    continue
+                if key == 'timestamp' and not isinstance(value, time.struct_time):
+                    # the authrep format, e.g. '2010-04-26 00:00:00 +0000',
+                    # the backend stamps the report itself if it is invalid
+                    try:
+                        value = time.gmtime(parse_period(value))
+                    except (TypeError, ValueError):
+                        continue
+                transaction[key] = value
+            transaction['usage'] = usage
+            if log:
+                transaction['log'] = log
+            self.hedger.report(self, transaction, timeout)
+        return ThreeScaleResult('authrep', auth.status, auth.body, auth.headers, auth.success)
+
+    def send_authorize(self, auth_url, query_url, timeout, metrics=None):
+        """send the authorize GET request, with no cache involved"""
+        if self.hedger is not None:
+            # the phases of the hedged requests are not recorded, both
+            # of them could be in flight at once
+            resp = self.hedger.do(lambda: self.send_request('GET', query_url, timeout=timeout,
+                                                            idempotent=True))
+        else:
+            resp = self.send_request('GET', query_url, timeout=timeout, metrics=metrics,
+                                     idempotent=True)
+        return ThreeScaleResult('authorize', resp.status, resp.body, resp.headers,
+                                self.check_response(auth_url, resp))
+
+    def bulk_authorize(self, credentials, usage = { 'hits': 1 }, other_params = {},
+                       concurrency = 10, timeout = 10):
+        """authorize many applications with up to concurrency calls in
+        flight. credentials is an iterable, a generator included, of dicts
+        of app_id, app_key and user_key. The authorization cache is used if
+        it is set.
+
+        @returns generator of (credentials, ThreeScaleAuthorizeResponse)
+        tuples, in the order the calls complete. For the calls that raise,
+        the exception takes the place of the response.
+        """
+        def authorize(item):
+            result = self.call_authorize(item.get('app_id'), item.get('app_key'), item.get('user_key'),
+                                         usage, other_params, timeout)
+            return result.get_response()
+
+        for item, response, error in run_parallel(authorize, credentials, concurrency):
+            yield item, response if error is None else error
+
+    def call_report(self, transactions, timeout = 10):
+        """send the report POST request. Nothing is stored in the
+        instance, so it can be shared between threads.
+
+        @returns ThreeScaleResult object.
+        @throws ThreeScaleServerError error, if invalid response is
+        received.
+        @throws ThreeScaleConnectionError error, if connection can not be
+        established.
+        @throws ThreeScaleException error, if any other unknown error is
+        occurred while receiving response for report POST api.
+        """
+        if self.collector is not None:
+            return self.measure('report', self.make_report_call, transactions, timeout)
+        return self.make_report_call(transactions, timeout)
+
+    def make_report_call(self, transactions, timeout, metrics=None):
+        """the report call itself, see call_report()"""
+        report_url = self.get_report_url()
+        data = self.build_post_data(transactions)
+
+        resp = self.send_request('POST', report_url, data, self.POST_HEADERS,
+                                 timeout=timeout, metrics=metrics)
+        return ThreeScaleResult('report', resp.status, resp.body, resp.headers,
+                                self.check_response(report_url, resp, rejected_codes=()))
+
+    def check_response(self, url, response, rejected_codes=(403, 404, 409)):
+        """return True for a successful response and False for one of the
+        rejected_codes, which carry the reason in the body.
+
+        @throws ThreeScaleServerError error, for any other HTTP status,
+        which is kept in its status attribute.
+        """
+        if 200 <= response.status < 300:
+            return True
+        if response.status in rejected_codes:
+            return False
+        error = ThreeScaleServerError("Invalid response for url "
+                                      "%s: HTTP Error %s: %s" % (url, response.status,
+                                                                response.reason))
+        error.status = response.status
+        raise error
+
+    def fails_open(self, error):
+        """return True if an authrep or authorize call that raised error
+        gets the fallback of the circuit breaker: the breaker fails open
+        and the backend could not be reached or answered with a 5xx."""
+        breaker = self.circuit_breaker
+        if breaker is None or not breaker.fail_open:
+            return False
+        return isinstance(error, ThreeScaleConnectionError) or (error.status or 0) >= 500
+
+class ThreeScaleResult(object):
+    """Immutable result of a call made with ThreeScale.call_authrep(),
+    call_authorize() or call_report(). It is true if the call was
+    successful. The response object is only parsed from the body when
+    get_response() is first called."""
+    __slots__ = ('call', 'status', 'body', 'headers', 'success', 'response')
+
+    def __init__(self, call, status, body, headers, success, response=None):
+        for name, value in zip(self.__slots__, (call, status, body, headers, success, response)):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ThreeScaleResult is immutable")
+
+    def __bool__(self):
+        return self.success
+    __nonzero__ = __bool__
+
+    def is_success(self):
+        return self.success
+
+    def get_status(self):
+        return self.status
+
+    def get_body(self):
+        return self.body
+
+    def get_headers(self):
+        return self.headers
+
+    def get_response(self):
+        """return the ThreeScaleAuthRepResponse or ThreeScaleAuthorizeResponse
+        built from the body, or None for report calls.
+
+        @throws ThreeScaleException error, if the body is not valid xml.
+        """
+        if self.response is None and self.call != 'report':
+            cls = ThreeScaleLazyAuthRepResponse if self.call == 'authrep' else ThreeScaleLazyAuthorizeResponse
+            object.__setattr__(self, 'response',
+                               cls.parse(self.body, None if self.success else self.status,
+                                         self.headers))
+        return self.response
+
+
 class ThreeScaleAuthRep(ThreeScale):
     """ThreeScaleAuthRep(): The derived class for ThreeScale. It is
     main class to invoke authrep GET API."""
@@ -230,36 +1295,16 @@ class ThreeScaleAuthRep(ThreeScale):
         """
         self.authrepd = False
         self.authrep_xml = None
+        self.authrep_headers = None
 
         self.validate()
-        authrep_url = self.get_authrep_url()
-        query_str = self.get_query_string(other_params, usage, log)
-
-        query_url = "%s?%s" % (authrep_url, query_str)
-
-        try:
-            req = Request(query_url)
-            self.add_version_header(req)
-            resp = urlopen(req, timeout=timeout).read()
-            self.authrepd = True
-            self.authrep_xml = resp
-            return True
-        except HTTPError as err:
-            if err.code in [403, 404, 409]:
-               self.authrepd    = False
-               self.error_code  = err.code
-               self.authrep_xml = err.read()
-               return False
-
-            raise ThreeScaleServerError("Invalid response for url "
-                                        "%s: %s" % (authrep_url, err))
-        except URLError as err:
-            raise ThreeScaleConnectionError("Connection error %s: "
-                                        "%s" % (authrep_url, err))
-        except Exception as err:
-            # handle all other exceptions
-            raise ThreeScaleException("Unknown error %s: "
-                                        "%s" % (authrep_url, err))
+        result = self.call_authrep(usage=usage, other_params=other_params, log=log, timeout=timeout)
+        self.authrepd = result.success
+        self.authrep_xml = result.body
+        self.authrep_headers = result.headers
+        if not self.authrepd:
+            self.error_code = result.status
+        return self.authrepd
 
     def build_response(self):
         """
@@ -271,21 +1316,8 @@ class ThreeScaleAuthRep(ThreeScale):
         @throws ThreeScaleException error, if xml output received from
         the server is not valid.
         """
-
-        xml = None
-        resp = ThreeScaleAuthRepResponse()
-
-        try:
-            xml = etree.fromstring(self.authrep_xml)
-        except Exception as err:
-            raise ThreeScaleException("Invalid xml %s" % err)
-
-        if not self.authrepd:
-            if self.error_code == 409:
-                resp.set_reason(xml.xpath('/status/reason')[0].text)
-            elif self.error_code == 403 or self.error_code == 404:
-                resp.set_reason(xml.xpath('/error')[0].text)
-        return resp
+        error_code = None if self.authrepd else self.error_code
+        return ThreeScaleLazyAuthRepResponse.parse(self.authrep_xml, error_code, self.authrep_headers)
 
 
 class ThreeScaleAuthRepResponse():
@@ -293,6 +1325,43 @@ class ThreeScaleAuthRepResponse():
     the xml data retrived from authrep GET api."""
     def __init__(self):
         self.reason = None
+        self.authorized = None
+        self.error_code = None
+        self.limit_remaining = None
+        self.limit_reset = None
+        self.limit_max_value = None
+
+    @classmethod
+    def parse(cls, body, error_code=None, headers=None):
+        """
+        build the response from the xml body returned by the authrep GET
+        api. error_code is the HTTP status of a rejected call, or None if
+        the call was successful. The extension headers, if any, are read
+        from headers, and the body can then be empty.
+
+        @throws ThreeScaleException error, if the xml is not valid.
+        """
+        resp = cls()
+        resp.set_authorized(error_code is None, error_code)
+        if headers is not None:
+            read_extension_headers(resp, headers)
+            if not body:
+                return resp
+
+        xml = parse_xml(body)
+        if error_code is not None:
+            resp.set_reason(find_reason(xml))
+        return resp
+
+    def set_authorized(self, authorized, error_code=None):
+        self.authorized = authorized
+        self.error_code = error_code
+
+    def is_authorized(self):
+        return self.authorized
+
+    def get_error_code(self):
+        return self.error_code
 
     def set_reason(self, reason):
         self.reason = reason
@@ -300,6 +1369,19 @@ class ThreeScaleAuthRepResponse():
     def get_reason(self):
         return self.reason
 
+    def get_limit_remaining(self):
+        """remaining calls of the most limiting usage limit, from the
+        3scale-limit-remaining header, -1 if there is no limit"""
+        return self.limit_remaining
+
+    def get_limit_reset(self):
+        """seconds to the reset of the most limiting usage limit, from
+        the 3scale-limit-reset header"""
+        return self.limit_reset
+
+    def get_limit_max_value(self):
+        return self.limit_max_value
+
 
 class ThreeScaleAuthRepUserKey(ThreeScaleAuthRep):
     """ThreeScaleAuthRepUserKey(): class to invoke authrep with user_key auth pattern GET API."""
@@ -328,6 +1410,8 @@ class ThreeScaleAuthorize(ThreeScale):
     """ThreeScaleAuthorize(): The derived class for ThreeScale. It is
     main class to invoke authorize GET API."""
 
+    auth_response = None
+
     def validate(self):
         """validate the arguments. If any of following parameters is
         missing, exit from the script.
@@ -363,36 +1447,18 @@ class ThreeScaleAuthorize(ThreeScale):
         """
         self.authorized = False
         self.auth_xml = None
+        self.auth_headers = None
+        self.auth_response = None
 
         self.validate()
-        auth_url = self.get_auth_url()
-        query_str = self.get_query_string(other_params, usage)
-
-        query_url = "%s?%s" % (auth_url, query_str)
-
-        try:
-            req = Request(query_url)
-            self.add_version_header(req)
-            resp = urlopen(req, timeout=timeout).read()
-            self.authorized = True
-            self.auth_xml = resp
-            return True
-        except HTTPError as err:
-            if err.code in [403, 404, 409]:
-               self.authorized = False
-               self.error_code  = err.code
-               self.auth_xml = err.read()
-               return False
-
-            raise ThreeScaleServerError("Invalid response for url "
-                                        "%s: %s" % (auth_url, err))
-        except URLError as err:
-            raise ThreeScaleConnectionError("Connection error %s: "
-                                        "%s" % (auth_url, err))
-        except Exception as err:
-            # handle all other exceptions
-            raise ThreeScaleException("Unknown error %s: "
-                                        "%s" % (auth_url, err))
+        result = self.call_authorize(usage=usage, other_params=other_params, timeout=timeout)
+        self.authorized = result.success
+        self.auth_xml = result.body
+        self.auth_headers = result.headers
+        self.auth_response = result.response
+        if not self.authorized:
+            self.error_code = result.status
+        return self.authorized
 
     def build_auth_response(self):
         """
@@ -405,32 +1471,16 @@ class ThreeScaleAuthorize(ThreeScale):
         the server is not valid.
         """
 
-        xml = None
-        resp = ThreeScaleAuthorizeResponse()
-
-        try:
-            xml = etree.fromstring(self.auth_xml)
-        except Exception as err:
-            raise ThreeScaleException("Invalid xml %s" % err)
+        if self.auth_response is None:
+            error_code = None if self.authorized else self.error_code
+            self.auth_response = ThreeScaleLazyAuthorizeResponse.parse(self.auth_xml, error_code,
+                                                                       self.auth_headers)
+        return self.auth_response
 
-        status = xml.xpath('/status')
-        if status:
-            resp.set_plan(xml.xpath('/status/plan')[0].text)
-            reports = xml.xpath('/status/usage_reports/usage_report')
-            for report in reports:
-                resp.add_usage_report(report)
 
-        if not self.authorized:
-            if self.error_code == 409 and status:
-                resp.set_reason(xml.xpath('/status/reason')[0].text)
-            elif self.error_code == 403 or self.error_code == 404:
-                resp.set_reason(xml.xpath('/error')[0].text)
-        return resp
-
-
-class ThreeScaleAuthorizeUserKey(ThreeScale):
-    """ThreeScaleAuthorizeUserKey(): The derived class for ThreeScale. It is
-    main class to invoke authorize GET API."""
+class ThreeScaleAuthorizeUserKey(ThreeScaleAuthorize):
+    """ThreeScaleAuthorizeUserKey(): The derived class for ThreeScaleAuthorize.
+    It is main class to invoke authorize with user_key auth pattern GET API."""
 
     def validate(self):
         """validate the arguments. If any of following parameters is
@@ -448,87 +1498,6 @@ class ThreeScaleAuthorizeUserKey(ThreeScale):
         if len(err):
             raise ThreeScaleException(': '.join(err))
 
-
-    def authorize(self, timeout = 10, usage = { 'hits': 1 }, other_params = {}):
-        """authorize() -- invoke authorize GET request.
-        - usage passes the usage of each metric of your API.
-        - other_params passes other parameters to the authrep call, e.g.
-          service_id, user_id, a.s.o.
-
-        The authorize response is stored in a class variable.
-
-        returns True, if authorization is successful.
-        @throws ThreeScaleServerError error, if invalid response is
-        received.
-        @throws ThreeScaleConnectionError error, if connection can not be
-        established.
-        @throws ThreeScaleException error, if any other unknown error is
-        occurred while receiving response for authorize GET api.
-        """
-        self.authorized = False
-        self.auth_xml = None
-
-        self.validate()
-        auth_url = self.get_auth_url()
-        query_str = self.get_query_string(other_params, usage)
-
-        query_url = "%s?%s" % (auth_url, query_str)
-        try:
-            req = Request(query_url)
-            self.add_version_header(req)
-            resp = urlopen(req, timeout=timeout).read()
-            self.authorized = True
-            self.auth_xml = resp
-            return True
-        except HTTPError as err:
-            if err.code in [403, 404, 409]:
-               self.authorized = False
-               self.error_code  = err.code
-               self.auth_xml = err.read()
-               return False
-
-            raise ThreeScaleServerError("Invalid response for url "
-                                        "%s: %s" % (auth_url, err))
-        except URLError as err:
-            raise ThreeScaleConnectionError("Connection error %s: "
-                                        "%s" % (auth_url, err))
-        except Exception as err:
-            # handle all other exceptions
-            raise ThreeScaleException("Unknown error %s: "
-                                        "%s" % (auth_url, err))
-
-    def build_auth_response(self):
-        """
-        Store the xml response from authorize GET api in a Python
-        object, ThreeScaleAuthorizeResponse. The values in xml output
-        can be retrived using the class methods.
-
-        @returns ThreeScaleAuthorizeResponse object.
-        @throws ThreeScaleException error, if xml output received from
-        the server is not valid.
-        """
-
-        xml = None
-        resp = ThreeScaleAuthorizeResponse()
-        try:
-            xml = etree.fromstring(self.auth_xml)
-        except Exception as err:
-            raise ThreeScaleException("Invalid xml %s" % err)
-
-        status = xml.xpath('/status')
-        if status:
-            resp.set_plan(xml.xpath('/status/plan')[0].text)
-            reports = xml.xpath('/status/usage_reports/usage_report')
-            for report in reports:
-                resp.add_usage_report(report)
-
-        if not self.authorized:
-            if self.error_code == 409 and status:
-                resp.set_reason(xml.xpath('/status/reason')[0].text)
-            elif self.error_code == 403 or self.error_code == 404:
-                resp.set_reason(xml.xpath('/error')[0].text)
-        return resp
-
 class ThreeScaleAuthorizeResponse():
     """The derived class for ThreeScale() class. The object constitutes
     the xml data retrived from authorize GET api."""
@@ -536,6 +1505,58 @@ class ThreeScaleAuthorizeResponse():
         self.reason = None
         self.plan = None
         self.usage_reports = []
+        self.usage_index = None
+        self.authorized = None
+        self.error_code = None
+        self.limit_remaining = None
+        self.limit_reset = None
+        self.limit_max_value = None
+
+    @classmethod
+    def parse(cls, body, error_code=None, headers=None):
+        """
+        build the response from the xml body returned by the authorize
+        GET api. error_code is the HTTP status of a rejected call, or None
+        if the call was successful. The extension headers, if any, are read
+        from headers, and the body can then be empty.
+
+        @throws ThreeScaleException error, if the xml is not valid.
+        """
+        resp = cls()
+        resp.set_authorized(error_code is None, error_code)
+        if headers is not None:
+            read_extension_headers(resp, headers)
+            if not body:
+                return resp
+
+        # a single walk over the document, see benchmarks/bench_parse.py
+        xml = parse_xml(body)
+        if xml.tag == 'status':
+            reason = None
+            for child in xml:
+                tag = child.tag
+                if tag == 'plan':
+                    resp.plan = child.text
+                elif tag == 'reason':
+                    reason = child.text
+                elif tag == 'usage_reports':
+                    for report in child:
+                        resp.add_usage_report(report)
+            if error_code is not None:
+                resp.set_reason(reason)
+        elif error_code is not None:
+            resp.set_reason(find_reason(xml))
+        return resp
+
+    def set_authorized(self, authorized, error_code=None):
+        self.authorized = authorized
+        self.error_code = error_code
+
+    def is_authorized(self):
+        return self.authorized
+
+    def get_error_code(self):
+        return self.error_code
 
     def set_plan(self, plan):
         self.plan = plan
@@ -549,40 +1570,249 @@ class ThreeScaleAuthorizeResponse():
     def get_reason(self):
         return self.reason
 
+    def get_limit_remaining(self):
+        """remaining calls of the most limiting usage limit, from the
+        3scale-limit-remaining header, -1 if there is no limit"""
+        return self.limit_remaining
+
+    def get_limit_reset(self):
+        """seconds to the reset of the most limiting usage limit, from
+        the 3scale-limit-reset header"""
+        return self.limit_reset
+
+    def get_limit_max_value(self):
+        return self.limit_max_value
+
     def add_usage_report(self, xml):
         """
         Create the ThreeScaleAuthorizeResponseUsageReport object for
         each usage report.
         """
-        report = ThreeScaleAuthorizeResponseUsageReport()
-        report.set_metric(xml.xpath('@metric')[0])
-        period = xml.xpath('@period')[0]
-        report.set_period(period)
-        if period != "eternity":
-            start = xml.xpath('period_start')[0].text
-            end = xml.xpath('period_end')[0].text
-            report.set_interval(start, end)
-        report.set_max_value(xml.xpath('max_value')[0].text)
-        report.set_current_value(xml.xpath(\
-                                'current_value')[0].text)
-        self.usage_reports.append(report)
+        self.usage_reports.append(ThreeScaleAuthorizeResponseUsageReport.parse(xml))
+        self.usage_index = None
 
     def get_usage_reports(self):
         """get all usage reports returned by the authorize GET api."""
         return self.usage_reports
 
+    def get_usage_index(self):
+        """return the usage reports indexed by (metric, period), and by
+        (metric, None) for the first report of each metric."""
+        if self.usage_index is None:
+            index = {}
+            for report in self.get_usage_reports():
+                index.setdefault((report.metric, None), report)
+                index[(report.metric, report.period)] = report
+            self.usage_index = index
+        return self.usage_index
+
+    def get_usage_report(self, metric, period=None):
+        """get the usage report of a metric, for the given period if
+        there are several, or None if there is none."""
+        return self.get_usage_index().get((metric, period))
+
+    def get_remaining(self, metric=None):
+        """return what is left of the most limiting usage limit, of the
+        metric if it is given, or None if there is no limit."""
+        remaining = [report.get_remaining() for report in self.get_usage_reports()
+                     if metric is None or report.metric == metric]
+        remaining = [value for value in remaining if value is not None]
+        return min(remaining) if remaining else None
+
+    def get_next_reset(self, metric=None):
+        """return the time, in seconds since the epoch, of the next reset
+        of a usage limit, of the metric if it is given, or None if the
+        limits never reset. Without a metric, the 3scale-limit-reset
+        header counts as well, so that it works without a body."""
+        ends = [report.end for report in self.get_usage_reports()
+                if report.end is not None and (metric is None or report.metric == metric)]
+        if metric is None and self.limit_reset is not None and self.limit_reset >= 0:
+            ends.append(time.time() + self.limit_reset)
+        return min(ends) if ends else None
+
+
+class ThreeScaleLazyResponse(object):
+    """Base of the lazy responses, which keep the raw body and only parse
+    it when a part of it is first asked for. Each part is then looked up
+    on its own and kept. is_authorized(), get_error_code() and the limits
+    of the extension headers never need the body.
+    """
+
+    def __init__(self, body=b'', error_code=None):
+        self.body = body
+        self.xml = None
+        self.authorized = error_code is None
+        self.error_code = error_code
+        self.limit_remaining = None
+        self.limit_reset = None
+        self.limit_max_value = None
+        self.parsed_reason = UNPARSED
+
+    @classmethod
+    def parse(cls, body, error_code=None, headers=None):
+        """build the response from the body without parsing it. An
+        invalid body only raises when a part of it is asked for."""
+        resp = cls(body, error_code)
+        if headers is not None:
+            read_extension_headers(resp, headers)
+            if body:
+                # the reason in the body wins over the header one
+                resp.parsed_reason = UNPARSED
+        return resp
+
+    def get_xml(self):
+        """return the root element of the body, parsing it on first use.
+
+        @throws ThreeScaleException error, if the xml is not valid.
+        """
+        if self.xml is None:
+            self.xml = parse_xml(self.body)
+        return self.xml
+
+    @property
+    def reason(self):
+        if self.parsed_reason is UNPARSED:
+            if self.error_code is None or not self.body:
+                self.parsed_reason = None
+            else:
+                self.parsed_reason = find_reason(self.get_xml())
+        return self.parsed_reason
+
+    @reason.setter
+    def reason(self, reason):
+        self.parsed_reason = reason
+
+
+class ThreeScaleLazyAuthRepResponse(ThreeScaleLazyResponse, ThreeScaleAuthRepResponse):
+    """ThreeScaleAuthRepResponse parsed on demand: the body of a
+    successful authrep is never parsed."""
 
-class ThreeScaleAuthorizeResponseUsageReport():
-    """Object to store all information related to the usage report."""
-    def __init__(self):
-        self.metric = None
-        self.period = None
-        self.start = None
-        self.end = None
-        self.max_value = None
-        self.current_value = None
-        self.start_period = None
-        self.end_period = None
+
+class ThreeScaleLazyAuthorizeResponse(ThreeScaleLazyResponse, ThreeScaleAuthorizeResponse):
+    """ThreeScaleAuthorizeResponse parsed on demand. The plan, the reason
+    and the usage reports are each looked up when first asked for, and
+    get_usage_report() only builds the report it returns.
+    """
+
+    def __init__(self, body=b'', error_code=None):
+        ThreeScaleLazyResponse.__init__(self, body, error_code)
+        self.parsed_plan = UNPARSED
+        self.parsed_usage_reports = UNPARSED
+        self.usage_index = None
+
+    def get_status_xml(self):
+        """return the <status> root element, or None for an empty body or
+        an <error> document."""
+        if not self.body:
+            return None
+        xml = self.get_xml()
+        return xml if xml.tag == 'status' else None
+
+    def iter_usage_report_xml(self):
+        xml = self.get_status_xml()
+        reports = xml.find('usage_reports') if xml is not None else None
+        return iter(reports) if reports is not None else iter(())
+
+    @property
+    def plan(self):
+        if self.parsed_plan is UNPARSED:
+            xml = self.get_status_xml()
+            self.parsed_plan = xml.findtext('plan') if xml is not None else None
+        return self.parsed_plan
+
+    @plan.setter
+    def plan(self, plan):
+        self.parsed_plan = plan
+
+    @property
+    def usage_reports(self):
+        if self.parsed_usage_reports is UNPARSED:
+            self.parsed_usage_reports = [ThreeScaleAuthorizeResponseUsageReport.parse(xml)
+                                         for xml in self.iter_usage_report_xml()]
+        return self.parsed_usage_reports
+
+    @usage_reports.setter
+    def usage_reports(self, reports):
+        self.parsed_usage_reports = reports
+        self.usage_index = None
+
+    def get_usage_report(self, metric, period=None):
+        if self.usage_index is not None or self.parsed_usage_reports is not UNPARSED:
+            return ThreeScaleAuthorizeResponse.get_usage_report(self, metric, period)
+        for xml in self.iter_usage_report_xml():
+            if xml.get('metric') == metric and (period is None or xml.get('period') == period):
+                return ThreeScaleAuthorizeResponseUsageReport.parse(xml)
+        return None
+
+
+def format_period(seconds):
+    """convert seconds since the epoch to a usage report period bound"""
+    return time.strftime('%Y-%m-%d %H:%M:%S +0000', time.gmtime(seconds))
+
+def parse_int(value):
+    return int(value) if value is not None else None
+
+class ThreeScaleAuthorizeResponseUsageReport(object):
+    """Object to store all information related to the usage report.
+
+    The values are kept typed: max_value and current_value as ints, start
+    and end as seconds since the epoch, or None for the eternity period.
+    The getters return the strings of the xml, as they always did: the
+    period strings are kept as given, with their timezone offset.
+    """
+    __slots__ = ('metric', 'period', 'start', 'end', 'max_value', 'current_value',
+                 'start_text', 'end_text')
+
+    def __init__(self, metric=None, period=None, start=None, end=None,
+                 max_value=None, current_value=None):
+        self.metric = metric
+        self.period = period
+        self.start = start
+        self.end = end
+        self.max_value = max_value
+        self.current_value = current_value
+        self.start_text = None
+        self.end_text = None
+
+    @classmethod
+    def parse(cls, xml):
+        """build the usage report from a <usage_report> element.
+
+        @throws ThreeScaleException error, if a value is not valid.
+        """
+        report = cls(xml.get('metric'), xml.get('period'))
+        try:
+            for child in xml:
+                tag = child.tag
+                if tag == 'current_value':
+                    report.current_value = int(child.text)
+                elif tag == 'max_value':
+                    report.max_value = int(child.text)
+                elif tag == 'period_start':
+                    report.set_start_period(child.text)
+                elif tag == 'period_end':
+                    report.set_end_period(child.text)
+        except (TypeError, ValueError) as err:
+            raise ThreeScaleException("Invalid usage report %s" % err)
+        return report
+
+    @property
+    def start_period(self):
+        if self.start_text is not None:
+            return self.start_text
+        return format_period(self.start) if self.start is not None else None
+
+    @property
+    def end_period(self):
+        if self.end_text is not None:
+            return self.end_text
+        return format_period(self.end) if self.end is not None else None
+
+    def get_remaining(self):
+        """return how much of the limit is left, never less than 0"""
+        if self.max_value is None or self.current_value is None:
+            return None
+        return max(0, self.max_value - self.current_value)
 
     def set_metric(self, metric):
         self.metric = metric
@@ -591,17 +1821,22 @@ class ThreeScaleAuthorizeResponseUsageReport():
         self.period = period
 
     def set_interval(self, start, end):
-        self.start_period = start
-        self.end_period = end
+        self.set_start_period(start)
+        self.set_end_period(end)
+
+    def set_start_period(self, start_period):
+        self.start = parse_period(start_period) if start_period else None
+        self.start_text = start_period or None
 
     def set_end_period(self, end_period):
-        self.end_period = end_period
+        self.end = parse_period(end_period) if end_period else None
+        self.end_text = end_period or None
 
     def set_max_value(self, max_value):
-        self.max_value = max_value
+        self.max_value = parse_int(max_value)
 
     def set_current_value(self, current_value):
-        self.current_value = current_value
+        self.current_value = parse_int(current_value)
 
     def get_metric(self):
         return self.metric
@@ -616,67 +1851,935 @@ class ThreeScaleAuthorizeResponseUsageReport():
         return self.end_period
 
     def get_max_value(self):
-        return self.max_value
+        return str(self.max_value) if self.max_value is not None else None
 
     def get_current_value(self):
-        return self.current_value
+        return str(self.current_value) if self.current_value is not None else None
 
 
-class ThreeScaleReport(ThreeScale):
-    """ThreeScaleReport()
-    The derived class for ThreeScale() base class, for making report
-    POST request.
+class ThreeScaleAuthorizeCache(object):
+    """Bounded LRU cache of successful authorize responses, keyed by the
+    authorize query (credentials, service and requested usage).
+
+    An entry expires after ttl seconds, or earlier when the first of the
+    periods in its usage reports ends, since the limits are reset then.
+    It is safe to share between threads and ThreeScaleAuthorize instances.
     """
 
-    def build_post_data(self, transactions):
-        if self.service_token:
-            body_params = "service_token=%s" % (self.service_token)
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_expiry(self, response, now):
+        """return the time at which the response stops being valid"""
+        expires = now + self.ttl
+        reset = response.get_next_reset()
+        return min(expires, reset) if reset is not None else expires
+
+    def get(self, key):
+        """return the cached (xml, ThreeScaleAuthorizeResponse, headers)
+        tuple for the key, or None if it is missing or expired. headers
+        are the 3scale-* headers of the response."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1], entry[2], entry[3]
+
+    def set(self, key, xml, response, headers={}):
+        """store a successful response and its extension headers, evicting
+        the least recently used entries if the cache is full."""
+        now = time.time()
+        expires = self.get_expiry(response, now)
+        if expires <= now:
+            return
+        headers = get_extension_headers(headers)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (expires, xml, response, headers)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ThreeScaleSharedAuthorizeCache(ThreeScaleAuthorizeCache):
+    """Authorization cache in shared memory, for the worker processes of a
+    pre-fork server: the workers share its hits and expiry, so the backend
+    only sees one miss per host.
+
+    It is a hash table of slots of slot_size bytes in a memory-mapped file.
+    With no path, the file is an unlinked temporary file shared with the
+    processes forked after the cache is created, e.g. the workers of a
+    server when it is created in the master. With a path, it is shared by
+    all the processes that open it with the same layout.
+
+    A key is looked up in up to PROBES consecutive slots. Each slot has a
+    version that writers make odd while they update it, so readers retry
+    instead of locking. Writers lock the file with fcntl. A slot holds the
+    url encoded extension headers of the response, a newline and its body.
+    Responses that do not fit in a slot are not cached, and a full set of
+    slots evicts the entry that expires first.
+    """
+
+    MAGIC = b'3SA2'
+    FILE_HEADER = struct.Struct('>4sII')
+    SLOT_HEADER = struct.Struct('>I20sdI')
+    VERSION = struct.Struct('>I')
+    PROBES = 4
+    RETRIES = 10
+
+    def __init__(self, path=None, slots=4096, slot_size=2048, ttl=60):
+        """@throws ThreeScaleException error, if the file at path has a
+        different layout."""
+        self.ttl = ttl
+        self.slots = slots
+        self.slot_size = slot_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if path is None:
+            import tempfile
+            self.file = tempfile.TemporaryFile()
         else:
-            body_params = "provider_key=%s" % (self.provider_key)
-        if self.service_id:
-            body_params = "%s&service_id=%s" % (body_params, self.service_id)
-        body_params = "%s&%s" % (body_params, self.encode_transactions(transactions))
-        return body_params.encode(ThreeScale.ENCODING)
+            self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o600), 'r+b')
+        self.size = slot_size * (slots + 1)
 
-    def encode_transactions(self, transactions):
+        header = self.FILE_HEADER.pack(self.MAGIC, slots, slot_size)
+        self.acquire()
+        try:
+            self.file.seek(0)
+            existing = self.file.read(self.FILE_HEADER.size)
+            if not existing:
+                self.file.truncate(self.size)
+                self.file.seek(0)
+                self.file.write(header)
+                self.file.flush()
+                existing = header
+        finally:
+            self.release()
+        if existing != header:
+            self.file.close()
+            raise ThreeScaleException("The cache file %s has a different layout" % path)
+        self.mm = mmap.mmap(self.file.fileno(), self.size)
+
+    def acquire(self):
+        self.lock.acquire()
+        if fcntl is not None:
+            fcntl.lockf(self.file.fileno(), fcntl.LOCK_EX)
+
+    def release(self):
+        if fcntl is not None:
+            fcntl.lockf(self.file.fileno(), fcntl.LOCK_UN)
+        self.lock.release()
+
+    def get_offsets(self, digest):
+        """return the offsets of the slots where the key can be"""
+        start = struct.unpack('>Q', digest[:8])[0]
+        return [self.slot_size * ((start + i) % self.slots + 1) for i in range(self.PROBES)]
+
+    def read_slot(self, offset, digest):
+        """return (expires, xml) if the slot holds the key, None otherwise"""
+        for attempt in range(self.RETRIES):
+            version, slot_digest, expires, length = self.SLOT_HEADER.unpack_from(self.mm, offset)
+            if version & 1:
+                # being written
+                continue
+            if slot_digest != digest:
+                return None
+            start = offset + self.SLOT_HEADER.size
+            xml = self.mm[start:start + length]
+            if self.VERSION.unpack_from(self.mm, offset)[0] == version:
+                return expires, xml
+        return None
+
+    def get(self, key):
+        """return the cached (xml, ThreeScaleAuthorizeResponse, headers)
+        tuple for the key, or None if it is missing or expired."""
+        digest = hashlib.sha1(key.encode(ThreeScale.ENCODING)).digest()
+        now = time.time()
+        for offset in self.get_offsets(digest):
+            entry = self.read_slot(offset, digest)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                encoded, _, xml = entry[1].partition(b'\n')
+                headers = dict((name, values[0]) for name, values
+                               in parse_qs(encoded.decode('ascii')).items())
+                return xml, ThreeScaleLazyAuthorizeResponse.parse(xml, None, headers), headers
+        self.misses += 1
+        return None
+
+    def write_slot(self, offset, digest, expires, xml):
+        """update a slot, with the file locked. The version is odd while
+        the slot is written, even with a writer killed half way."""
+        writing = self.VERSION.unpack_from(self.mm, offset)[0] | 1
+        self.VERSION.pack_into(self.mm, offset, writing)
+        self.SLOT_HEADER.pack_into(self.mm, offset, writing, digest, expires, len(xml))
+        start = offset + self.SLOT_HEADER.size
+        self.mm[start:start + len(xml)] = xml
+        self.VERSION.pack_into(self.mm, offset, (writing + 1) & 0xffffffff)
+
+    def set(self, key, xml, response, headers={}):
+        """store a successful response and its extension headers, in the
+        slot of the key, a free or expired one, or the one that expires
+        first."""
+        now = time.time()
+        expires = self.get_expiry(response, now)
+        encoded = urlencode(sorted(get_extension_headers(headers).items()))
+        xml = encoded.encode('ascii') + b'\n' + xml
+        if expires <= now or len(xml) > self.slot_size - self.SLOT_HEADER.size:
+            return
+        digest = hashlib.sha1(key.encode(ThreeScale.ENCODING)).digest()
+        self.acquire()
+        try:
+            chosen = None
+            for offset in self.get_offsets(digest):
+                version, slot_digest, slot_expires, length = self.SLOT_HEADER.unpack_from(self.mm, offset)
+                if slot_digest == digest:
+                    chosen = offset
+                    break
+                if chosen is None or slot_expires < chosen_expires:
+                    chosen, chosen_expires = offset, slot_expires
+            self.write_slot(chosen, digest, expires, xml)
+        finally:
+            self.release()
+
+    def clear(self):
+        self.acquire()
+        try:
+            for slot in range(1, self.slots + 1):
+                self.write_slot(self.slot_size * slot, b'\0' * 20, 0, b'')
+        finally:
+            self.release()
+
+    def __len__(self):
+        now = time.time()
+        count = 0
+        for slot in range(1, self.slots + 1):
+            if self.SLOT_HEADER.unpack_from(self.mm, self.slot_size * slot)[2] > now:
+                count += 1
+        return count
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+
+class ThreeScaleQuotaLimiter(object):
+    """Local view of the usage limits of the applications, seeded from the
+    usage reports returned by authrep and authorize calls and updated with
+    the usage consumed locally, e.g. authorizations served from the cache.
+
+    It lets the clients reject the calls that are clearly over a limit
+    without calling the backend. check() asks for a resync from the backend
+    when one of the periods of the application has ended, when the usage
+    consumed locally since the last sync is over drift_threshold times a
+    limit, or, if max_age is set, when the last sync is older than that.
+    Rejections consume no usage, so an application that would be rejected
+    is synced again once its last sync is older than reject_ttl seconds,
+    which also covers the limits whose period never ends. At most max_size
+    applications are tracked.
+    """
+
+    ALLOW = 'allow'
+    REJECT = 'reject'
+    SYNC = 'sync'
+
+    REJECTION_XML = ("<status><authorized>false</authorized>"
+                     "<reason>usage limits are exceeded</reason>"
+                     "<plan>%s</plan></status>")
+
+    def __init__(self, drift_threshold=0.1, max_age=None, reject_ttl=10, max_size=10000):
+        self.drift_threshold = drift_threshold
+        self.max_age = max_age
+        self.reject_ttl = reject_ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.apps = OrderedDict()
+        self.rejected = 0
+
+    def update(self, app, response):
+        """seed the limits of the application from the usage reports of a
+        ThreeScaleAuthorizeResponse, dropping the local usage."""
+        limits = {}
+        for report in response.get_usage_reports():
+            if report.max_value is None or report.current_value is None:
+                continue
+            limits[(report.metric, report.period)] = \
+                [report.max_value, report.current_value, report.end]
+
+        state = {'limits': limits, 'plan': response.get_plan(), 'synced': time.time(), 'local': {}}
+        with self.lock:
+            self.apps.pop(app, None)
+            self.apps[app] = state
+            while len(self.apps) > self.max_size:
+                self.apps.popitem(last=False)
+
+    def update_from_result(self, app, result):
+        """update the limits from a ThreeScaleResult of an authrep or
+        authorize call, if its body has usage reports."""
+        if result.status not in (200, 409) or not result.body:
+            return
+        try:
+            response = ThreeScaleAuthorizeResponse.parse(result.body, None if result.success else result.status)
+        except ThreeScaleException:
+            return
+        self.update(app, response)
+
+    def parse_usage(self, usage):
+        """return the usage with int values, e.g. {'hits': '2'} to
+        {'hits': 2}.
+
+        @throws ThreeScaleException error, if a value is not an integer.
         """
-        @throws ThreeScaleException error, if transaction is invalid.
+        try:
+            return dict((metric, int(value)) for metric, value in usage.items())
+        except (AttributeError, TypeError, ValueError):
+            raise ThreeScaleException("Invalid usage %r" % (usage,))
+
+    def check(self, app, usage):
+        """return REJECT if the usage is over one of the known limits of
+        the application, SYNC if the backend has to be asked because the
+        local view is missing or stale, ALLOW otherwise.
+
+        @throws ThreeScaleException error, if the usage is invalid.
         """
-        encoded = ''
-        i = 0
+        usage = self.parse_usage(usage)
+        now = time.time()
+        with self.lock:
+            state = self.apps.get(app)
+            if state is None:
+                return self.SYNC
+            if self.max_age is not None and now - state['synced'] >= self.max_age:
+                return self.SYNC
+
+            local = state['local']
+            decision = self.ALLOW
+            for (metric, period), (max_value, current_value, end) in state['limits'].items():
+                if end is not None and end <= now:
+                    return self.SYNC
+                if local.get(metric, 0) > self.drift_threshold * max_value:
+                    return self.SYNC
+                if current_value + usage.get(metric, 0) > max_value:
+                    decision = self.REJECT
+            if decision == self.REJECT:
+                if now - state['synced'] >= self.reject_ttl:
+                    return self.SYNC
+                self.rejected += 1
+            return decision
+
+    def consume(self, app, usage):
+        """add usage consumed without calling the backend
+
+        @throws ThreeScaleException error, if the usage is invalid.
+        """
+        usage = self.parse_usage(usage)
+        with self.lock:
+            state = self.apps.get(app)
+            if state is None:
+                return
+            local = state['local']
+            for metric, value in usage.items():
+                local[metric] = local.get(metric, 0) + value
+            for (metric, period), limit in state['limits'].items():
+                limit[1] += usage.get(metric, 0)
+
+    def build_rejection(self, call, app):
+        """return the ThreeScaleResult of a call rejected locally, like the
+        409 the backend would have returned."""
+        with self.lock:
+            state = self.apps.get(app)
+            plan = state['plan'] if state and state['plan'] else ''
+        body = (self.REJECTION_XML % escape(plan)).encode(ThreeScale.ENCODING)
+        return ThreeScaleResult(call, 409, body, {}, False)
+
+
+class ThreeScaleFlight(object):
+    """a call in flight in a ThreeScaleSingleFlight"""
+    __slots__ = ('done', 'result', 'error')
 
-        if not isinstance(transactions, (tuple, list)):
-            raise ThreeScaleException("Invalid transaction type")
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
-        for trans in transactions:
-            prefix = "&transactions[%d]" % (i)
-            encoded += self.encode_recursive(prefix, trans)
-            i += 1
 
-        return encoded
+class ThreeScaleSingleFlight(object):
+    """Coalesces concurrent identical calls: while a call for a key is in
+    flight, the other callers for the same key wait for it and share its
+    result, or its exception, instead of calling the backend themselves.
+    Results are not kept once the call is over, see ThreeScaleAuthorizeCache
+    for that.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.coalesced = 0
 
-    def encode_recursive(self, prefix, trans):
-        """encode every value in transactions
-        @throws ThreeScaleException error, if the timestamp specified in
-        transaction is invalid.
+    def do(self, key, func, timeout=None):
+        """return func(), or the result of the call in flight for key.
+
+        @throws ThreeScaleConnectionError error, if the call in flight has
+        not completed after timeout seconds.
         """
-        new_value = ""
-        for key in trans.keys():
-            if key == 'usage': # usage is list
-                    new_prefix=("%s[usage]" % (prefix))
-                    new_value += self.encode_recursive(new_prefix, trans[key])
-            elif key == 'timestamp': # specially encode the timestamp
-                ts = trans[key]
-                try:
-                    new_value += "%s[%s]=%s" % (prefix, key, quote(str(time.strftime('%Y-%m-%d %H:%M:%S %z', ts))))
-                except Exception:
-                    raise ThreeScaleException("Invalid timestamp "
-                                              "'%s' specified in "
-                                              "transaction" % ts)
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = ThreeScaleFlight()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if not flight.done.wait(timeout):
+                raise ThreeScaleConnectionError("Timeout waiting for the call in flight")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+            return flight.result
+        except Exception as err:
+            flight.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+
+class ThreeScaleCircuitBreaker(object):
+    """Circuit breaker in front of the backend calls.
+
+    While closed, the outcome of the last window_size calls is recorded. A
+    call fails if it raises, gets a 5xx response or, when
+    slow_call_threshold is set, takes longer than that many seconds. Once
+    at least min_calls are recorded and the failures reach error_threshold
+    of them, the circuit opens: the calls then fail at once with a
+    ThreeScaleCircuitOpenError. After open_timeout seconds the circuit is
+    half-open and lets half_open_probes calls through, whose outcome closes
+    or opens it again.
+
+    With fail_open, authrep and authorize calls that can not reach the
+    backend, or get a 5xx from it, return the last known authorization of
+    the application, or an authorized result if there is none, instead of
+    raising. Report calls always raise.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    FAIL_OPEN_XML = b"<status><authorized>true</authorized></status>"
+
+    def __init__(self, error_threshold=0.5, slow_call_threshold=None, window_size=20,
+                 min_calls=10, open_timeout=30, half_open_probes=1, fail_open=False,
+                 max_size=10000):
+        self.error_threshold = error_threshold
+        self.slow_call_threshold = slow_call_threshold
+        self.min_calls = min_calls
+        self.open_timeout = open_timeout
+        self.half_open_probes = half_open_probes
+        self.fail_open = fail_open
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.outcomes = deque(maxlen=window_size)
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.probes = 0
+        self.last_known = OrderedDict()
+        self.rejected = 0
+        self.failed_open = 0
+
+    def get_state(self):
+        return self.state
+
+    def allow(self):
+        """return whether a call can be sent to the backend now"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.open_timeout:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self.probes = 0
+            if self.probes >= self.half_open_probes:
+                self.rejected += 1
+                return False
+            self.probes += 1
+            return True
+
+    def record(self, success, elapsed):
+        """record the outcome of a call that was allowed"""
+        failed = not success or (self.slow_call_threshold is not None and
+                                 elapsed > self.slow_call_threshold)
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                if failed:
+                    self.trip()
+                else:
+                    self.state = self.CLOSED
+                    self.outcomes.clear()
+            elif self.state == self.CLOSED:
+                self.outcomes.append(failed)
+                if (len(self.outcomes) >= self.min_calls and
+                        sum(self.outcomes) >= self.error_threshold * len(self.outcomes)):
+                    self.trip()
+
+    def trip(self):
+        self.state = self.OPEN
+        self.opened_at = time.time()
+        self.outcomes.clear()
+
+    def remember(self, app, result):
+        """keep the outcome of an authrep or authorize call of the
+        application, to fail open with it."""
+        if not self.fail_open or result.status not in (200, 409):
+            return
+        with self.lock:
+            self.last_known.pop(app, None)
+            self.last_known[app] = (result.status, result.body, result.success)
+            while len(self.last_known) > self.max_size:
+                self.last_known.popitem(last=False)
+
+    def fallback(self, call, app):
+        """return the ThreeScaleResult of a call that failed open"""
+        with self.lock:
+            self.failed_open += 1
+            last = self.last_known.get(app)
+        if last is None:
+            return ThreeScaleResult(call, 200, self.FAIL_OPEN_XML, {}, True)
+        return ThreeScaleResult(call, last[0], last[1], {}, last[2])
+
+
+class ThreeScaleHedger(object):
+    """Hedged requests: a call that has not answered after the hedging
+    delay is sent a second time, and the first answer wins. The other one
+    is discarded when it arrives; its connection goes back to the pool.
+
+    The delay is the given percentile of the latencies of the last
+    window_size requests, or delay seconds until min_samples of them are
+    known. Only idempotent calls are hedged: authrep goes through an
+    authorize and a report of the usage, queued on reporter if it is set,
+    e.g. a ThreeScaleBatchReporter, or sent in the background otherwise.
+
+    The requests run on worker threads which are kept for the next calls,
+    so that no thread is started per call once the hedger is warm. A worker
+    left idle for idle_timeout seconds exits, so the threads started by a
+    burst of calls do not stay around; workers counts the running ones.
+
+    fired counts the calls that were hedged, won the ones the second
+    request answered first, failed the reports of the usage that could
+    not be sent or queued.
+    """
+
+    def __init__(self, percentile=95, delay=0.05, window_size=100, min_samples=20,
+                 reporter=None, idle_timeout=60):
+        self.percentile = percentile
+        self.delay = delay
+        self.min_samples = min_samples
+        self.reporter = reporter
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window_size)
+        self.recorded = 0
+        self.hedge_delay = delay
+        self.calls = 0
+        self.fired = 0
+        self.won = 0
+        self.failed = 0
+        self.tasks = Queue.Queue()
+        self.idle = 0
+        self.workers = 0
+
+    def get_delay(self):
+        return self.hedge_delay
+
+    def record(self, latency):
+        """add the latency of a request, the delay is updated every 10"""
+        with self.lock:
+            self.latencies.append(latency)
+            self.recorded += 1
+            if len(self.latencies) >= self.min_samples and self.recorded % 10 == 0:
+                latencies = sorted(self.latencies)
+                index = min(len(latencies) - 1, len(latencies) * self.percentile // 100)
+                self.hedge_delay = latencies[index]
+
+    def attempt(self, func, hedge, results):
+        start = time.time()
+        try:
+            value = func()
+        except Exception as err:
+            results.put((hedge, None, err))
+        else:
+            self.record(time.time() - start)
+            results.put((hedge, value, None))
+
+    def submit(self, task):
+        """run task() on an idle worker thread, or on a new one if they are
+        all busy"""
+        with self.lock:
+            spawn = not self.idle
+            if spawn:
+                self.workers += 1
+            else:
+                self.idle -= 1
+            # queued under the lock, so that the idle worker it is meant
+            # for does not exit meanwhile
+            self.tasks.put(task)
+        if spawn:
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def work(self):
+        while True:
+            try:
+                task = self.tasks.get(timeout=self.idle_timeout)
+            except Queue.Empty:
+                with self.lock:
+                    if self.tasks.empty():
+                        self.idle -= 1
+                        self.workers -= 1
+                        return
+                continue
+            task()
+            with self.lock:
+                self.idle += 1
+
+    def start(self, func, hedge, results):
+        self.submit(lambda: self.attempt(func, hedge, results))
+
+    def report(self, client, transaction, timeout):
+        """report the usage of a split authrep, without failing the call"""
+        try:
+            if self.reporter is not None:
+                self.reporter.enqueue(transaction)
+            else:
+                self.submit(lambda: self.send_report(client, transaction, timeout))
+        except ThreeScaleException:
+            with self.lock:
+                self.failed += 1
+
+    def send_report(self, client, transaction, timeout):
+        try:
+            client.call_report([transaction], timeout)
+        except ThreeScaleException:
+            with self.lock:
+                self.failed += 1
+
+    def do(self, func):
+        """return the first value returned by func() in one of the
+        requests. If both raise, the error of the first one is raised."""
+        results = Queue.Queue()
+        self.start(func, False, results)
+        with self.lock:
+            self.calls += 1
+        try:
+            outcome = results.get(timeout=self.hedge_delay)
+        except Queue.Empty:
+            with self.lock:
+                self.fired += 1
+            self.start(func, True, results)
+            outcome = results.get()
+            if outcome[2] is not None:
+                other = results.get()
+                if other[2] is None:
+                    outcome = other
+            if outcome[0] and outcome[2] is None:
+                with self.lock:
+                    self.won += 1
+        if outcome[2] is not None:
+            raise outcome[2]
+        return outcome[1]
+
+
+class ThreeScaleBackendEndpoint(object):
+    """state of a backend URI in a ThreeScaleBackendBalancer"""
+    __slots__ = ('uri', 'outstanding', 'ewma', 'failures', 'ejected', 'probe_at', 'probing')
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.outstanding = 0
+        self.ewma = 0.0
+        self.failures = 0
+        self.ejected = False
+        self.probe_at = 0
+        self.probing = False
+
+
+class ThreeScaleBackendBalancer(object):
+    """Spreads the calls over several backend replicas.
+
+    Each call goes to the healthy endpoint with the fewest requests in
+    flight ('least_outstanding', ties broken by latency) or with the
+    lowest moving average of latency weighted by its requests in flight
+    ('ewma'). An endpoint that fails max_failures calls in a row, by
+    raising or with a 5xx response, is ejected. Every probe_interval
+    seconds a GET probe_path is then sent to it from a background thread,
+    and it is added back once the probe succeeds. If all the endpoints are
+    ejected, the calls are spread over all of them.
+    """
+
+    LEAST_OUTSTANDING = 'least_outstanding'
+    EWMA = 'ewma'
+
+    def __init__(self, uris, strategy=LEAST_OUTSTANDING, decay=0.3, max_failures=3,
+                 probe_interval=5, probe_path='/status', probe_timeout=2):
+        if strategy not in (self.LEAST_OUTSTANDING, self.EWMA):
+            raise ThreeScaleException("Unknown balancing strategy '%s'" % strategy)
+        self.endpoints = [ThreeScaleBackendEndpoint(uri) for uri in uris]
+        self.strategy = strategy
+        self.decay = decay
+        self.max_failures = max_failures
+        self.probe_interval = probe_interval
+        self.probe_path = probe_path
+        self.probe_timeout = probe_timeout
+        self.lock = threading.Lock()
+        self.ejections = 0
+
+    def get_uris(self):
+        return [endpoint.uri for endpoint in self.endpoints]
+
+    def get_healthy_uris(self):
+        return [endpoint.uri for endpoint in self.endpoints if not endpoint.ejected]
+
+    def score(self, endpoint):
+        if self.strategy == self.EWMA:
+            return endpoint.ewma * (endpoint.outstanding + 1)
+        return (endpoint.outstanding, endpoint.ewma)
+
+    def acquire(self):
+        """return the endpoint for a call, release() it when it is done"""
+        now = time.time()
+        probes = []
+        with self.lock:
+            healthy = []
+            for endpoint in self.endpoints:
+                if not endpoint.ejected:
+                    healthy.append(endpoint)
+                elif not endpoint.probing and endpoint.probe_at <= now:
+                    endpoint.probing = True
+                    probes.append(endpoint)
+            endpoint = min(healthy or self.endpoints, key=self.score)
+            endpoint.outstanding += 1
+
+        for probe in probes:
+            thread = threading.Thread(target=self.probe, args=(probe,))
+            thread.daemon = True
+            thread.start()
+        return endpoint
+
+    def release(self, endpoint, success, elapsed):
+        """record the outcome of a call sent to the endpoint"""
+        with self.lock:
+            endpoint.outstanding -= 1
+            if endpoint.ewma:
+                endpoint.ewma += self.decay * (elapsed - endpoint.ewma)
+            else:
+                endpoint.ewma = elapsed
+            if success:
+                endpoint.failures = 0
             else:
-                new_value += ("%s[%s]=%s" % (prefix, key, quote(str(trans[key]))))
+                endpoint.failures += 1
+                if endpoint.failures >= self.max_failures and not endpoint.ejected:
+                    self.eject(endpoint)
 
-        return new_value
+    def eject(self, endpoint):
+        endpoint.ejected = True
+        endpoint.probe_at = time.time() + self.probe_interval
+        self.ejections += 1
+
+    def probe(self, endpoint):
+        """check an ejected endpoint, and add it back if it is healthy"""
+        try:
+            resp = ThreeScale.connection_pool.request('GET', endpoint.uri + self.probe_path,
+                                                      timeout=self.probe_timeout, idempotent=True)
+            healthy = resp.status < 500
+        except Exception:
+            healthy = False
+        with self.lock:
+            endpoint.probing = False
+            if healthy:
+                endpoint.ejected = False
+                endpoint.failures = 0
+            else:
+                endpoint.probe_at = time.time() + self.probe_interval
+
+
+class ThreeScaleCallMetrics(object):
+    """What a ThreeScaleCollector gets for each call. phases maps the
+    phases the call went through, among PHASES, to their duration in
+    seconds: the connection phases are only there when a new connection
+    was opened, and none of them when the authorization cache answered.
+    cache is 'hit', 'miss' or None when no cache is set, retries counts
+    the requests sent again on a fresh connection, error is the exception
+    the call raised, if any.
+    """
+    PHASES = ('dns', 'connect', 'tls', 'ttfb', 'body')
+    __slots__ = ('call', 'start', 'duration', 'status', 'success', 'phases',
+                 'request_bytes', 'response_bytes', 'reused', 'retries', 'cache', 'error')
+
+    def __init__(self, call):
+        self.call = call
+        self.start = time.time()
+        self.duration = None
+        self.status = None
+        self.success = None
+        self.phases = {}
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.reused = None
+        self.retries = 0
+        self.cache = None
+        self.error = None
+
+    def finish(self, result, error=None):
+        self.duration = time.time() - self.start
+        if result is not None:
+            self.status = result.status
+            self.success = result.success
+        self.error = error
+
+    def __str__(self):
+        fields = ["%s status=%s total=%.1fms" % (self.call, self.status, self.duration * 1000)]
+        for phase in self.PHASES:
+            if phase in self.phases:
+                fields.append("%s=%.1fms" % (phase, self.phases[phase] * 1000))
+        fields.append("sent=%dB received=%dB" % (self.request_bytes, self.response_bytes))
+        if self.reused is not None:
+            fields.append("reused=%s" % self.reused)
+        if self.retries:
+            fields.append("retries=%d" % self.retries)
+        if self.cache is not None:
+            fields.append("cache=%s" % self.cache)
+        if self.error is not None:
+            fields.append("error=%r" % self.error)
+        return " ".join(fields)
+
+
+class ThreeScaleCollector(object):
+    """Receives the ThreeScaleCallMetrics of every call made by the
+    instances it is set on, see ThreeScale.set_collector(). collect() is
+    called in the thread of the call once it is complete, so it should be
+    quick. When no collector is set, nothing is measured."""
+
+    def collect(self, metrics):
+        """called with the ThreeScaleCallMetrics of each call. Does
+        nothing here: subclasses override it."""
+        pass
+
+
+class ThreeScaleLoggingCollector(ThreeScaleCollector):
+    """Logs a line per call, with its status, phases and sizes, on logger
+    at level, logging.DEBUG by default. The line is only formatted if the
+    level is enabled."""
+
+    def __init__(self, logger=None, level=None):
+        # logging is only imported when a logging collector is used
+        import logging
+        self.logger = logger or logging.getLogger('ThreeScalePY')
+        self.level = logging.DEBUG if level is None else level
+
+    def collect(self, metrics):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, "3scale %s", metrics)
+
+
+class ThreeScalePrometheusCollector(ThreeScaleCollector):
+    """Prometheus histograms of the durations of the calls and of their
+    phases, and counters of the calls per status, of the cache outcomes,
+    of the retries and of the bytes sent and received. expose() returns
+    them in the Prometheus text format, to be served on the metrics
+    endpoint of the application: the prometheus_client package is not
+    needed.
+    """
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix='threescale', buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # (call, phase) -> [count per bucket..., count above, sum]
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, call, phase, value):
+        histogram = self.histograms.get((call, phase))
+        if histogram is None:
+            histogram = self.histograms[(call, phase)] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect.bisect_left(self.buckets, value)] += 1
+        histogram[-1] += value
+
+    def count(self, name, labels, value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def collect(self, metrics):
+        call = metrics.call
+        status = 'error' if metrics.error is not None else str(metrics.status)
+        with self.lock:
+            self.observe(call, 'total', metrics.duration)
+            for phase, value in metrics.phases.items():
+                self.observe(call, phase, value)
+            self.count('calls_total', (('call', call), ('status', status)))
+            if metrics.cache is not None:
+                self.count('cache_total', (('call', call), ('outcome', metrics.cache)))
+            if metrics.retries:
+                self.count('retries_total', (('call', call),), metrics.retries)
+            self.count('request_bytes_total', (('call', call),), metrics.request_bytes)
+            self.count('response_bytes_total', (('call', call),), metrics.response_bytes)
+
+    def expose(self):
+        """return the metrics in the Prometheus text exposition format"""
+        with self.lock:
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+            counters = sorted(self.counters.items())
+        name = "%s_call_duration_seconds" % self.prefix
+        lines = ["# HELP %s Duration of the calls to 3scale and of their phases." % name,
+                 "# TYPE %s histogram" % name]
+        for (call, phase), histogram in histograms:
+            labels = 'call="%s",phase="%s"' % (call, phase)
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%g"} %d' % (name, labels, bound, cumulative))
+            cumulative += histogram[-2]
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, cumulative))
+            lines.append('%s_sum{%s} %r' % (name, labels, histogram[-1]))
+            lines.append('%s_count{%s} %d' % (name, labels, cumulative))
+        typed = set()
+        for (counter, labels), value in counters:
+            name = "%s_%s" % (self.prefix, counter)
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE %s counter" % name)
+            lines.append('%s{%s} %d' % (name, ",".join('%s="%s"' % label for label in labels), value))
+        return "\n".join(lines) + "\n"
+
+
+class ThreeScaleReport(ThreeScale):
+    """ThreeScaleReport()
+    The derived class for ThreeScale() base class, for making report
+    POST request.
+    """
 
     def report(self, transactions, timeout = 10):
         """send the report POST request.
@@ -690,27 +2793,930 @@ class ThreeScaleReport(ThreeScale):
         occurred while receiving response for report POST api.
         """
 
-        report_url = self.get_report_url()
-        data = self.build_post_data(transactions)
+        return self.call_report(transactions, timeout).success
+
+class ThreeScaleFlushMarker(object):
+    """queued by ThreeScaleBatchReporter.flush(), set once the transactions
+    queued before it have been sent."""
+    __slots__ = ('done',)
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class ThreeScaleBatchReporter(ThreeScaleReport):
+    """ThreeScaleBatchReporter()
+    The derived class for ThreeScaleReport. Transactions are queued with
+    enqueue(), which does not wait for the backend, and a background thread
+    reports them in batches of batch_size transactions, or earlier once the
+    oldest queued transaction has waited for flush_interval seconds.
 
+    When the queue holds max_queue_size transactions, enqueue() blocks until
+    there is room, or drops the transaction if block is False.
+
+    A forked process, e.g. a pre-fork server worker, starts a background
+    thread and a queue of its own on its first enqueue(). The transactions
+    queued before the fork are left to the parent.
+
+    Call close() on shutdown so that the queued transactions are reported.
+    """
+
+    MAX_BATCH_SIZE = 1000
+    # how often blocked calls check that the background thread is alive
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, provider_key="", app_id="", app_key="", user_key="", service_id="", service_token="", backend_uri="",
+                 batch_size=MAX_BATCH_SIZE, flush_interval=1.0, max_queue_size=10000, block=True,
+                 timeout=10, on_error=None):
+        """initialize the credentials like ThreeScale() and start the
+        background thread.
+        - on_error, if given, is called as on_error(exception, transactions)
+          when a batch can not be reported.
+
+        @throws ThreeScaleException error, if batch_size is not between 1
+        and 1000.
+        """
+        ThreeScaleReport.__init__(self, provider_key, app_id, app_key, user_key, service_id, service_token, backend_uri)
+
+        if not 0 < batch_size <= self.MAX_BATCH_SIZE:
+            raise ThreeScaleException("Batch size must be between 1 and %d" % self.MAX_BATCH_SIZE)
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self.timeout = timeout
+        self.on_error = on_error
+        self.dropped = 0
+        self.failed = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.max_queue_size = max_queue_size
+        self.start_thread()
+
+    def start_thread(self):
+        """start the background thread of this process, with an empty
+        queue."""
+        self.pid = os.getpid()
+        self.queue = Queue.Queue(self.max_queue_size)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def check_fork(self):
+        """start a background thread in a forked process, where the one of
+        the parent does not run."""
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid != os.getpid():
+                self.start_thread()
+
+    def enqueue(self, transaction):
+        """queue a transaction to be reported.
+
+        @returns True if the transaction is queued, False if it is dropped
+        because the queue is full.
+        @throws ThreeScaleException error, if the reporter is closed or its
+        background thread has stopped.
+        """
+        if self.closed:
+            raise ThreeScaleException("The reporter is closed")
+        self.check_fork()
+        while True:
+            self.check_thread()
+            try:
+                self.queue.put(transaction, self.block, self.POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                if not self.block:
+                    self.dropped += 1
+                    return False
+
+    def check_thread(self):
+        """@throws ThreeScaleException error, if the background thread has
+        stopped."""
+        if not self.thread.is_alive():
+            raise ThreeScaleException("The reporter thread has stopped")
+
+    def flush(self, timeout=None):
+        """wait until the transactions queued so far have been sent, or
+        for timeout seconds.
+
+        @throws ThreeScaleException error, if the background thread has
+        stopped.
+        """
+        self.check_fork()
+        self.check_thread()
+        deadline = time.time() + timeout if timeout is not None else None
+        marker = ThreeScaleFlushMarker()
+        self.queue.put(marker)
+        while not marker.done.is_set():
+            wait = self.POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return
+            marker.done.wait(wait)
+            if not marker.done.is_set():
+                self.check_thread()
+
+    def close(self, timeout=None):
+        """report the queued transactions and stop the background thread."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.pid == os.getpid() and self.thread.is_alive():
+            self.flush(timeout)
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+    def send(self, batch):
+        if not batch:
+            return
         try:
-            req = Request(report_url, data)
-            self.add_version_header(req)
-            urlopen(req, timeout=timeout)
-            return True
-        except HTTPError as err:
-            raise ThreeScaleServerError("Invalid response for url "
-                                        "%s: %s" % (report_url, err))
-            return False
-        except URLError as err:
-            raise ThreeScaleConnectionError("Connection error %s: "
-                                        "%s" % (report_url, err))
-            return False
+            self.report(batch, self.timeout)
         except Exception as err:
-            # handle all other exceptions
-            raise ThreeScaleException("Unknown error %s: "
-                                        "%s" % (report_url, err))
+            self.failed += len(batch)
+            if self.on_error is not None:
+                try:
+                    self.on_error(err, batch)
+                except Exception:
+                    # the background thread must keep running
+                    pass
+
+    def run(self):
+        """background thread: collect the queued transactions and report
+        them when the batch is full or the flush interval has passed."""
+        batch = []
+        deadline = None
+        while True:
+            try:
+                if deadline is None:
+                    item = self.queue.get()
+                else:
+                    item = self.queue.get(True, max(0, deadline - time.time()))
+            except Queue.Empty:
+                self.send(batch)
+                batch, deadline = [], None
+                continue
+
+            if item is None or isinstance(item, ThreeScaleFlushMarker):
+                self.send(batch)
+                batch, deadline = [], None
+                if item is None:
+                    return
+                item.done.set()
+                continue
+
+            batch.append(item)
+            if deadline is None:
+                deadline = time.time() + self.flush_interval
+            if len(batch) >= self.batch_size:
+                self.send(batch)
+                batch, deadline = [], None
+
+class ThreeScaleSpoolReporter(ThreeScaleReport):
+    """ThreeScaleSpoolReporter()
+    The derived class for ThreeScaleReport. Transactions are appended with
+    enqueue() to an append-only log in spool_dir, and a background thread
+    replays the log to the backend in batches of batch_size transactions,
+    so that no usage is lost when the backend can not be reached or the
+    process restarts.
+
+    The log is made of memory-mapped segment files of segment_size bytes.
+    Each record is the url encoded transaction, without its index, framed
+    by its length and crc32. The segments are synced to disk every
+    sync_interval seconds, and the position reported so far in a segment is
+    kept in its .ack file. Segments are deleted once fully reported. The
+    log takes at most max_segments segments, enqueue() drops the
+    transactions beyond that.
+
+    Transactions are stamped with the time they are enqueued, if they have
+    no timestamp. A batch is sent again after retry_interval seconds if the
+    backend can not be reached or answers with a 5xx, so transactions are
+    reported at least once. Other errors drop the batch, and on_error, if
+    given, is called as on_error(exception, count).
+    """
+
+    MAX_BATCH_SIZE = 1000
+    HEADER = struct.Struct('>II')
+    ACK = struct.Struct('>Q')
+
+    def __init__(self, provider_key="", app_id="", app_key="", user_key="", service_id="", service_token="", backend_uri="",
+                 spool_dir="3scale-spool", batch_size=MAX_BATCH_SIZE, segment_size=16 * 1024 * 1024,
+                 max_segments=64, sync_interval=0.1, retry_interval=1.0, timeout=10, on_error=None):
+        """initialize the credentials like ThreeScale(), open the log and
+        start the background thread. The transactions left in the log by
+        a previous process are reported first.
+
+        @throws ThreeScaleException error, if batch_size is not between 1
+        and 1000.
+        """
+        ThreeScaleReport.__init__(self, provider_key, app_id, app_key, user_key, service_id, service_token, backend_uri)
+
+        if not 0 < batch_size <= self.MAX_BATCH_SIZE:
+            raise ThreeScaleException("Batch size must be between 1 and %d" % self.MAX_BATCH_SIZE)
+
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.sync_interval = sync_interval
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.on_error = on_error
+        self.dropped = 0
+        self.failed = 0
+        self.reported = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.stopping = threading.Event()
+        self.timestamp = (None, None)
+        self.post_head = self.build_post_data(())
+
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(spool_dir)
+                               if name.endswith('.seg'))
+        # the segments of a previous process are only read
+        self.open_segment(self.segments[-1] + 1 if self.segments else 0)
+        self.read_id = self.segments[0]
+        self.read_offset = self.read_ack(self.read_id)
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def segment_path(self, segment_id, ext='.seg'):
+        return os.path.join(self.spool_dir, "%020d%s" % (segment_id, ext))
+
+    def open_segment(self, segment_id):
+        """start a new segment to write to, with the lock held"""
+        with open(self.segment_path(segment_id), 'w+b') as segment:
+            segment.truncate(self.segment_size)
+            self.mm = mmap.mmap(segment.fileno(), self.segment_size)
+        self.write_id = segment_id
+        self.write_offset = 0
+        self.dirty = False
+        self.segments.append(segment_id)
+
+    def read_ack(self, segment_id):
+        try:
+            with open(self.segment_path(segment_id, '.ack'), 'rb') as ack:
+                return self.ACK.unpack(ack.read(self.ACK.size))[0]
+        except (IOError, OSError, struct.error):
+            return 0
+
+    def write_ack(self, segment_id, offset):
+        """record the position reported so far in a segment. If it can not
+        be written, the records are reported again by the next reporter
+        opened on spool_dir."""
+        try:
+            with open(self.segment_path(segment_id, '.ack'), 'wb') as ack:
+                ack.write(self.ACK.pack(offset))
+        except (IOError, OSError):
+            pass
+
+    def encode(self, transaction):
+        """return the record of a transaction, e.g. b'&[app_id]=foo&[usage][hits]=1'"""
+        record = ''.join(self.iter_encoded_fields("&", transaction, {}))
+        if 'timestamp' not in transaction:
+            now = int(time.time())
+            if self.timestamp[0] != now:
+                self.timestamp = (now, quote(time.strftime('%Y-%m-%d %H:%M:%S %z', time.localtime(now))))
+            record = "%s&[timestamp]=%s" % (record, self.timestamp[1])
+        return record.encode(ThreeScale.ENCODING)
+
+    def enqueue(self, transaction):
+        """append a transaction to the log.
+
+        @returns True if the transaction is spooled, False if it is dropped
+        because the log is full.
+        @throws ThreeScaleException error, if the reporter is closed or the
+        transaction is invalid.
+        """
+        if self.closed:
+            raise ThreeScaleException("The reporter is closed")
+        record = self.encode(transaction)
+        size = self.HEADER.size + len(record)
+        if size + self.HEADER.size > self.segment_size:
+            raise ThreeScaleException("Transaction too large for the spool segments")
+
+        with self.lock:
+            if self.write_offset + size + self.HEADER.size > self.segment_size:
+                if self.max_segments and len(self.segments) >= self.max_segments:
+                    self.dropped += 1
+                    return False
+                self.mm.flush()
+                self.mm.close()
+                self.open_segment(self.write_id + 1)
+            offset = self.write_offset
+            self.mm[offset + self.HEADER.size:offset + size] = record
+            self.mm[offset:offset + self.HEADER.size] = self.HEADER.pack(
+                len(record), zlib.crc32(record) & 0xffffffff)
+            self.write_offset += size
+            self.dirty = True
+            self.changed.notify_all()
+        return True
+
+    def read_records(self, data, offset, end):
+        """return the valid records of a segment from offset, up to
+        batch_size of them, and the offset after the last one."""
+        records = []
+        while len(records) < self.batch_size and offset + self.HEADER.size <= end:
+            length, crc = self.HEADER.unpack(data[offset:offset + self.HEADER.size])
+            start = offset + self.HEADER.size
+            if length == 0 or start + length > end:
+                break
+            record = data[start:start + length]
+            if zlib.crc32(record) & 0xffffffff != crc:
+                # torn write
+                break
+            records.append(record)
+            offset = start + length
+        return records, offset
+
+    def next_batch(self):
+        """return (segment id, records, offset after them) of the next
+        records to report, dropping the fully reported segments."""
+        with self.lock:
+            while True:
+                if self.read_id == self.write_id:
+                    records, offset = self.read_records(self.mm, self.read_offset, self.write_offset)
+                    return self.read_id, records, offset
+                records = None
+                try:
+                    with open(self.segment_path(self.read_id), 'rb') as segment:
+                        data = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+                except (IOError, OSError, ValueError):
+                    # missing or empty segment
+                    pass
+                else:
+                    try:
+                        records, offset = self.read_records(data, self.read_offset, len(data))
+                    finally:
+                        data.close()
+                if records:
+                    return self.read_id, records, offset
+                self.remove_segment(self.read_id)
+
+    def remove_segment(self, segment_id):
+        """delete a reported segment and move to the next one, with the
+        lock held"""
+        for ext in ('.seg', '.ack'):
+            try:
+                os.remove(self.segment_path(segment_id, ext))
+            except OSError:
+                pass
+        self.segments.remove(segment_id)
+        self.read_id, self.read_offset = self.segments[0], 0
+
+    def send(self, records):
+        """report the records, return False if they have to be sent again"""
+        chunks = [self.post_head]
+        for i, record in enumerate(records):
+            chunks.append(record.replace(b'&[', ('&transactions[%d][' % i).encode(ThreeScale.ENCODING)))
+        try:
+            resp = self.send_request('POST', self.get_report_url(), b''.join(chunks),
+                                     self.POST_HEADERS, timeout=self.timeout)
+        except ThreeScaleConnectionError:
             return False
+        if resp.status >= 500:
+            return False
+        try:
+            self.check_response(self.get_report_url(), resp, rejected_codes=())
+            self.reported += len(records)
+        except ThreeScaleException as err:
+            self.failed += len(records)
+            if self.on_error is not None:
+                try:
+                    self.on_error(err, len(records))
+                except Exception:
+                    # the background thread must keep running
+                    pass
+        return True
+
+    def sync(self):
+        """write the records appended since the last sync to disk"""
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            mm = self.mm
+        try:
+            mm.flush()
+        except ValueError:
+            # closed by enqueue() when the segment is full, after a flush
+            pass
+
+    def flush(self, timeout=None):
+        """wait until the transactions spooled so far have been reported,
+        or dropped."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            target = (self.write_id, self.write_offset)
+            while (self.read_id, self.read_offset) < target and self.thread.is_alive():
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return
+                self.changed.wait(remaining if remaining is not None else 1.0)
+
+    def close(self, timeout=None):
+        """report the spooled transactions, within timeout, and stop the
+        background thread. The transactions left are reported by the next
+        reporter opened on spool_dir."""
+        if self.closed:
+            return
+        self.closed = True
+        self.flush(timeout)
+        self.stopping.set()
+        with self.lock:
+            self.changed.notify_all()
+        self.thread.join(timeout)
+        if not self.thread.is_alive():
+            self.mm.flush()
+            self.mm.close()
+
+    def run(self):
+        """background thread: sync the log and replay it to the backend."""
+        while not self.stopping.is_set():
+            self.sync()
+            segment_id, records, offset = self.next_batch()
+            if not records:
+                with self.lock:
+                    if (self.read_id, self.read_offset) == (self.write_id, self.write_offset) \
+                            and not self.stopping.is_set():
+                        self.changed.wait(self.sync_interval)
+                continue
+
+            if not self.send(records):
+                self.stopping.wait(self.retry_interval)
+                continue
+
+            self.write_ack(segment_id, offset)
+            with self.lock:
+                self.read_offset = offset
+                self.changed.notify_all()
+
+class ThreeScaleUsageAggregator(object):
+    """ThreeScaleUsageAggregator()
+    Sums the usage of the transactions added with add() per application
+    and metric within time buckets of bucket_size seconds, and reports one
+    transaction per application and bucket when it flushes. A background
+    thread flushes the past buckets every bucket_size seconds.
+
+    The transactions are sent to reporter: enqueued if it has an enqueue()
+    method, e.g. a ThreeScaleBatchReporter or a ThreeScaleSpoolReporter,
+    reported in batches of 1000 otherwise. The timestamp of the merged
+    transactions is the start of their bucket, in UTC. With keep_log, they
+    carry the log of the last transaction added, which is dropped
+    otherwise.
+
+    With a ThreeScaleMultiServiceReporter, transactions are aggregated per
+    service_id. Other reporters report to their own service only, so a
+    transaction of another service is rejected by add().
+
+    The counters are split into shards, each with its own lock, so that
+    threads adding usage for different applications rarely wait for each
+    other. Transactions that can not be reported are counted in failed and
+    passed to on_error, if given, as on_error(exception, transactions).
+    """
+
+    MAX_BATCH_SIZE = 1000
+
+    def __init__(self, reporter, bucket_size=1.0, shards=16, keep_log=False, timeout=10,
+                 on_error=None):
+        self.reporter = reporter
+        self.bucket_size = bucket_size
+        self.keep_log = keep_log
+        self.timeout = timeout
+        self.on_error = on_error
+        self.multi_service = isinstance(reporter, ThreeScaleMultiServiceReporter)
+        self.shards = [(threading.Lock(), {}) for i in range(shards)]
+        self.emitted = 0
+        self.failed = 0
+        self.closed = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, transaction):
+        """add the usage of a transaction.
+
+        @throws ThreeScaleException error, if the aggregator is closed, the
+        transaction is invalid or of a service the reporter does not
+        report to.
+        """
+        if self.closed:
+            raise ThreeScaleException("The aggregator is closed")
+        try:
+            app_id = transaction.get('app_id')
+            user_key = transaction.get('user_key')
+            timestamp = transaction.get('timestamp')
+            usage = [(metric, int(value)) for metric, value in transaction.get('usage', {}).items()]
+            now = timegm(timestamp) if timestamp is not None else time.time()
+        except (AttributeError, TypeError, ValueError, OverflowError):
+            raise ThreeScaleException("Invalid transaction %r" % (transaction,))
+        if not (app_id or user_key):
+            raise ThreeScaleException("Transaction without app_id or user_key")
+        service_id = transaction.get('service_id')
+        if not self.multi_service:
+            if service_id and service_id != getattr(self.reporter, 'service_id', None):
+                raise ThreeScaleException("Transaction of service '%s' can not be reported "
+                                          "to another service" % service_id)
+            service_id = None
+
+        key = (service_id, app_id, user_key, int(now // self.bucket_size))
+        lock, counters = self.shards[hash(key) % len(self.shards)]
+        with lock:
+            entry = counters.get(key)
+            if entry is None:
+                entry = counters[key] = [{}, None]
+            totals = entry[0]
+            for metric, value in usage:
+                totals[metric] = totals.get(metric, 0) + value
+            if self.keep_log and 'log' in transaction:
+                entry[1] = transaction['log']
+
+    def __len__(self):
+        """number of transactions waiting to be reported"""
+        return sum(len(counters) for lock, counters in self.shards)
+
+    def collect(self, everything=False):
+        """remove and return the merged transactions of the past buckets,
+        or of all of them."""
+        current = int(time.time() // self.bucket_size)
+        transactions = []
+        for lock, counters in self.shards:
+            with lock:
+                keys = [key for key in counters if everything or key[3] < current]
+                entries = [(key, counters.pop(key)) for key in keys]
+            for (service_id, app_id, user_key, bucket), (usage, log) in entries:
+                transaction = {'usage': usage,
+                               'timestamp': time.gmtime(bucket * self.bucket_size)}
+                if app_id:
+                    transaction['app_id'] = app_id
+                if user_key:
+                    transaction['user_key'] = user_key
+                if service_id:
+                    transaction['service_id'] = service_id
+                if log is not None:
+                    transaction['log'] = log
+                transactions.append(transaction)
+        return transactions
+
+    def flush(self, everything=True):
+        """report the merged transactions, of the current bucket as well
+        unless everything is False.
+
+        @throws ThreeScaleException error, if a batch can not be reported
+        and there is no on_error callback.
+        """
+        transactions = self.collect(everything)
+        self.emitted += len(transactions)
+        errors = []
+        if hasattr(self.reporter, 'enqueue'):
+            for transaction in transactions:
+                try:
+                    self.reporter.enqueue(transaction)
+                except Exception as err:
+                    self.fail(err, [transaction], errors)
+        elif self.multi_service:
+            try:
+                results = self.reporter.report(transactions, self.timeout)
+            except Exception as err:
+                self.fail(err, transactions, errors)
+            else:
+                for result in results:
+                    if result.error is not None:
+                        self.fail(result.error, result.transactions, errors)
+        else:
+            for i in range(0, len(transactions), self.MAX_BATCH_SIZE):
+                batch = transactions[i:i + self.MAX_BATCH_SIZE]
+                try:
+                    self.reporter.report(batch, self.timeout)
+                except Exception as err:
+                    self.fail(err, batch, errors)
+        if errors:
+            raise errors[0]
+
+    def fail(self, error, transactions, errors):
+        """count transactions that could not be reported, and pass them to
+        on_error, or keep the error to raise it"""
+        self.failed += len(transactions)
+        if self.on_error is not None:
+            try:
+                self.on_error(error, transactions)
+            except Exception:
+                pass
+        else:
+            errors.append(error)
+
+    def close(self, timeout=None):
+        """stop the background thread and report all the usage."""
+        if self.closed:
+            return
+        self.closed = True
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.flush()
+
+    def run(self):
+        """background thread: report the past buckets"""
+        while not self.stopping.wait(self.bucket_size):
+            try:
+                self.flush(False)
+            except Exception:
+                # counted in failed
+                pass
+
+class ThreeScaleBatchResult(object):
+    """outcome of a batch sent by ThreeScaleMultiServiceReporter: the
+    ThreeScaleResult of the report call, or the exception it raised."""
+    __slots__ = ('service_id', 'transactions', 'result', 'error')
+
+    def __init__(self, service_id, transactions, result, error):
+        self.service_id = service_id
+        self.transactions = transactions
+        self.result = result
+        self.error = error
+
+    def __bool__(self):
+        return self.is_success()
+    __nonzero__ = __bool__
+
+    def is_success(self):
+        return self.error is None and self.result.success
+
+    def get_service_id(self):
+        return self.service_id
+
+    def get_transactions(self):
+        return self.transactions
+
+    def get_result(self):
+        return self.result
+
+    def get_error(self):
+        return self.error
+
+
+class ThreeScaleMultiServiceReporter(object):
+    """ThreeScaleMultiServiceReporter()
+    Reports transactions of several services. Each transaction carries the
+    id of its service in service_id. report() partitions them by service,
+    splits each partition in batches of batch_size transactions, and sends
+    the batches from up to max_workers threads.
+
+    The services are authenticated with their token in service_tokens, a
+    dict of service id to service token, or with provider_key.
+    """
+
+    MAX_BATCH_SIZE = 1000
+
+    def __init__(self, provider_key="", service_tokens=None, backend_uri="", max_workers=4,
+                 batch_size=MAX_BATCH_SIZE):
+        """@throws ThreeScaleException error, if there are no credentials or
+        batch_size is not between 1 and 1000."""
+        if not provider_key and not service_tokens:
+            raise ThreeScaleException("Provider key or service tokens must be defined")
+        if not 0 < batch_size <= self.MAX_BATCH_SIZE:
+            raise ThreeScaleException("Batch size must be between 1 and %d" % self.MAX_BATCH_SIZE)
+        self.provider_key = provider_key
+        self.service_tokens = dict(service_tokens or {})
+        self.backend_uri = backend_uri
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.reporters = {}
+
+    def get_reporter(self, service_id):
+        """return the ThreeScaleReport of a service.
+
+        @throws ThreeScaleException error, if there are no credentials for
+        the service.
+        """
+        reporter = self.reporters.get(service_id)
+        if reporter is None:
+            token = self.service_tokens.get(service_id)
+            if not token and not self.provider_key:
+                raise ThreeScaleException("No service token for service '%s'" % service_id)
+            reporter = ThreeScaleReport(self.provider_key, service_id=service_id,
+                                        service_token=token or "", backend_uri=self.backend_uri)
+            reporter = self.reporters.setdefault(service_id, reporter)
+        return reporter
+
+    def partition(self, transactions):
+        """return the batches of (service id, transactions) to send.
+
+        @throws ThreeScaleException error, if a transaction has no
+        service_id or its service has no credentials.
+        """
+        services = OrderedDict()
+        for transaction in transactions:
+            try:
+                service_id = transaction['service_id']
+            except (KeyError, TypeError):
+                raise ThreeScaleException("Transaction without service_id %r" % (transaction,))
+            self.get_reporter(service_id)
+            services.setdefault(service_id, []).append(
+                dict((key, value) for key, value in transaction.items() if key != 'service_id'))
+
+        batches = []
+        for service_id, service_transactions in services.items():
+            for i in range(0, len(service_transactions), self.batch_size):
+                batches.append((service_id, service_transactions[i:i + self.batch_size]))
+        return batches
+
+    def report(self, transactions, timeout=10):
+        """report the transactions, of any service.
+
+        @returns list of ThreeScaleBatchResult, one per batch, in the
+        order of the services in the transactions.
+        @throws ThreeScaleException error, if a transaction has no
+        service_id or its service has no credentials. Nothing is sent
+        then.
+        """
+        batches = self.partition(transactions)
+
+        def send(index):
+            service_id, batch = batches[index]
+            return self.get_reporter(service_id).call_report(batch, timeout)
+
+        results = [None] * len(batches)
+        workers = min(self.max_workers, len(batches))
+        for index, result, error in run_parallel(send, range(len(batches)), workers):
+            service_id, batch = batches[index]
+            results[index] = ThreeScaleBatchResult(service_id, batch, result, error)
+        return results
+
+class ThreeScaleMiddleware(object):
+    """Base class of the WSGI and ASGI middlewares, which authorize every
+    request with the credentials it carries before passing it on to the
+    application.
+
+    client is the ThreeScale instance, with the service credentials, used
+    to authorize the requests. It gets a ThreeScaleAuthorizeCache if it has
+    no cache yet. The usage of the authorized requests is reported by
+    reporter, a ThreeScaleBatchReporter for the service of the client by
+    default, out of the request path. The usage the reporter does not take
+    is counted in dropped and logged as a warning on the 'ThreeScalePY'
+    logger.
+
+    extract_credentials(request) returns the dict of app_id, app_key and
+    user_key of a request, by default taken from the query string or from
+    the X-App-Id, X-App-Key and X-User-Key headers. map_usage(request)
+    returns its usage, {'hits': 1} by default. The request is the WSGI
+    environ or the ASGI scope.
+
+    Requests are rejected with a 403, or a 429 when the usage limits are
+    exceeded, and a 503 when the backend can not be reached. The timing of
+    the authorization and of the application, in seconds, is put in the
+    request as 'threescale.timing' and passed to on_timing(request,
+    timing), if given.
+    """
+
+    CREDENTIAL_HEADERS = (('app_id', 'x-app-id'), ('app_key', 'x-app-key'), ('user_key', 'x-user-key'))
+    LIMITS_EXCEEDED = "usage limits are exceeded"
+    # rejection reason in the 3scale-rejection-reason header
+    LIMITS_EXCEEDED_CODE = "limits_exceeded"
+    STATUS_LINES = {403: '403 Forbidden', 429: '429 Too Many Requests',
+                    503: '503 Service Unavailable'}
+
+    def __init__(self, client, reporter=None, extract_credentials=None, map_usage=None,
+                 on_timing=None, timeout=10):
+        if client.auth_cache is None:
+            client.set_auth_cache(ThreeScaleAuthorizeCache())
+        if reporter is None:
+            reporter = ThreeScaleBatchReporter(client.provider_key, service_id=client.service_id,
+                                               service_token=client.service_token,
+                                               backend_uri=client.backend_uri, block=False)
+        self.client = client
+        self.reporter = reporter
+        self.extract_credentials = extract_credentials
+        self.map_usage = map_usage
+        self.on_timing = on_timing
+        self.timeout = timeout
+        self.dropped = 0
+
+    def parse_credentials(self, query_string, headers):
+        """return the credentials in the query string, or in the headers,
+        a dict of lowercased names."""
+        params = parse_qs(query_string) if query_string else {}
+        credentials = {}
+        for key, header in self.CREDENTIAL_HEADERS:
+            value = params[key][0] if key in params else headers.get(header)
+            if value:
+                credentials[key] = value
+        return credentials
+
+    def get_usage(self, request):
+        return self.map_usage(request) if self.map_usage is not None else {'hits': 1}
+
+    def check_credentials(self, credentials):
+        """return the rejection of a request without credentials, if any"""
+        if not credentials or not (credentials.get('app_id') or credentials.get('user_key')):
+            return 403, "missing credentials"
+        return None
+
+    def check_result(self, result):
+        """return the (status, reason) rejection of a failed
+        authorization, None if it succeeded."""
+        if result.success:
+            return None
+        try:
+            reason = result.get_response().get_reason() or "forbidden"
+        except ThreeScaleException:
+            reason = "forbidden"
+        if result.status == 409 and reason in (self.LIMITS_EXCEEDED, self.LIMITS_EXCEEDED_CODE):
+            return 429, reason
+        return 403, reason
+
+    def authorize(self, credentials, usage):
+        """return the (status, reason) rejection of the request, or None,
+        and the ThreeScaleResult of the authorization."""
+        rejection = self.check_credentials(credentials)
+        if rejection is not None:
+            return rejection, None
+        try:
+            result = self.client.call_authorize(usage=usage, timeout=self.timeout, **credentials)
+        except ThreeScaleException:
+            return (503, "authorization unavailable"), None
+        return self.check_result(result), result
+
+    def report(self, credentials, usage):
+        """queue the usage of an authorized request"""
+        transaction = {'usage': usage}
+        for key in ('app_id', 'user_key'):
+            if credentials.get(key):
+                transaction[key] = credentials[key]
+        try:
+            if self.reporter.enqueue(transaction) is not False:
+                return
+            error = "the queue is full"
+        except ThreeScaleException as err:
+            error = err
+        self.dropped += 1
+        # logging is only imported when some usage is dropped
+        import logging
+        logging.getLogger('ThreeScalePY').warning("3scale usage dropped (%d so far): %s", self.dropped, error)
+
+    def close(self):
+        """report the queued usage"""
+        self.reporter.close()
+
+
+class ThreeScaleWSGIMiddleware(ThreeScaleMiddleware):
+    """ThreeScaleWSGIMiddleware(app, client, ...)
+    WSGI middleware that authorizes the requests before they reach app,
+    see ThreeScaleMiddleware.
+
+    Usage:
+        client = ThreeScalePY.ThreeScale(service_id = 'your_service_id', service_token = 'your_service_token')
+        application = ThreeScalePY.ThreeScaleWSGIMiddleware(application, client)
+    """
+
+    def __init__(self, app, client, **kwargs):
+        ThreeScaleMiddleware.__init__(self, client, **kwargs)
+        self.app = app
+
+    def get_credentials(self, environ):
+        if self.extract_credentials is not None:
+            return self.extract_credentials(environ)
+        headers = {}
+        for key, header in self.CREDENTIAL_HEADERS:
+            value = environ.get('HTTP_' + header.upper().replace('-', '_'))
+            if value:
+                headers[header] = value
+        return self.parse_credentials(environ.get('QUERY_STRING', ''), headers)
+
+    def __call__(self, environ, start_response):
+        start = time.time()
+        credentials = self.get_credentials(environ)
+        usage = self.get_usage(environ)
+        rejection, result = self.authorize(credentials, usage)
+        timing = {'authorize': time.time() - start}
+        environ['threescale.timing'] = timing
+        environ['threescale.result'] = result
+
+        if rejection is not None:
+            if self.on_timing is not None:
+                self.on_timing(environ, timing)
+            status, reason = rejection
+            body = reason.encode(ThreeScale.ENCODING)
+            start_response(self.STATUS_LINES[status], [('Content-Type', 'text/plain; charset=utf-8'),
+                                                       ('Content-Length', str(len(body)))])
+            return [body]
+
+        self.report(credentials, usage)
+        start = time.time()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            timing['app'] = time.time() - start
+            if self.on_timing is not None:
+                self.on_timing(environ, timing)
 
 class ThreeScaleException(Exception):
     """main exception class. raise this exception for all other errors"""
@@ -719,8 +3725,13 @@ class ThreeScaleException(Exception):
 class ThreeScaleServerError(ThreeScaleException):
     """raise exception if there are any exception during server
     interaction"""
-    pass
+    # HTTP status of the response, if there was one
+    status = None
 
 class ThreeScaleConnectionError(ThreeScaleException):
     """raise exception if server connection can not be establised"""
     pass
+
+class ThreeScaleCircuitOpenError(ThreeScaleConnectionError):
+    """raise exception if the circuit breaker does not let a call through"""
+    pass
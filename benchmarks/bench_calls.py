@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the authrep, authorize and report calls against a local
+stub of the backend (see fake_backend.py), so it runs offline.
+
+For each call type and concurrency level it measures the throughput, the
+p50/p99 latency of the calls and the memory allocated while running a
+call; the cost of parsing the response body is measured on its own.
+
+    python benchmarks/bench_calls.py --calls 2000 --concurrency 1 8 32 --mode limited
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(BASEDIR)
+
+import ThreeScalePY
+from fake_backend import FakeBackend
+
+CALLS = {
+    'authrep': lambda client: client.call_authrep(app_id='foo', app_key='bar', usage={'hits': 1}),
+    'authorize': lambda client: client.call_authorize(app_id='foo', app_key='bar', usage={'hits': 1}),
+    'report': lambda client: client.call_report([{'app_id': 'foo', 'usage': {'hits': 1}}]),
+}
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def run_calls(client, call, calls, concurrency):
+    """run the calls from concurrency threads, returning the wall time and
+    the latency of every call"""
+    latencies = []
+    lock = threading.Lock()
+    per_thread = calls // concurrency
+
+    def worker():
+        mine = []
+        for _ in range(per_thread):
+            start = time.time()
+            call(client)
+            mine.append(time.time() - start)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, latencies
+
+def allocated_per_call(client, call, calls=200):
+    """average peak of the memory allocated while running one call, in KiB"""
+    if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+        return float('nan')
+    tracemalloc.start()
+    total = 0
+    for _ in range(calls):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        call(client)
+        total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return total / 1024.0 / calls
+
+def parse_cost(client, name, call, number=2000):
+    """time to build the response object from the body, in microseconds"""
+    if name == 'report':
+        return float('nan')
+    result = call(client)
+    cls = ThreeScalePY.ThreeScaleAuthRepResponse if name == 'authrep' else ThreeScalePY.ThreeScaleAuthorizeResponse
+    error_code = None if result.success else result.status
+    return min(timeit.repeat(lambda: cls.parse(result.body, error_code), repeat=3, number=number)) / number * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--calls', type=int, default=2000, help="calls per call type and concurrency level")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added by the backend to every call")
+    parser.add_argument('--mode', choices=['ok', 'forbidden', 'limited'], default='ok')
+    parser.add_argument('--reports', type=int, default=3, help="usage reports per status document")
+    parser.add_argument('--call', choices=sorted(CALLS), nargs='+', default=sorted(CALLS))
+    args = parser.parse_args()
+
+    backend = FakeBackend(latency=args.latency, mode=args.mode, reports=args.reports).start()
+    client = ThreeScalePY.ThreeScale(service_id='1', service_token='token', backend_uri=backend.uri())
+    client.set_connection_pool(ThreeScalePY.ThreeScaleConnectionPool(max_size=max(args.concurrency)))
+
+    print("mode=%s latency=%.3fs reports=%d calls=%d" % (args.mode, args.latency, args.reports, args.calls))
+    print("%-10s %5s %12s %10s %10s %12s %11s" % ("call", "conc", "calls/s", "p50 (ms)", "p99 (ms)",
+                                                  "alloc (KiB)", "parse (us)"))
+    try:
+        for name in args.call:
+            call = CALLS[name]
+            # warm up the connections and the caches
+            run_calls(client, call, max(args.concurrency), max(args.concurrency))
+            alloc = allocated_per_call(client, call)
+            parse = parse_cost(client, name, call)
+            for concurrency in args.concurrency:
+                elapsed, latencies = run_calls(client, call, args.calls, concurrency)
+                print("%-10s %5d %12.0f %10.3f %10.3f %12.1f %11.1f" % (
+                      name, concurrency, len(latencies) / elapsed,
+                      percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3,
+                      alloc, parse))
+    finally:
+        backend.stop()
+
+if __name__ == '__main__':
+    main()
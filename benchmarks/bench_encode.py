@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of the report payload encoder.
+
+Compares ThreeScale.build_post_data(), which joins the encoded fields once,
+with the former implementation, which grew the payload with repeated string
+concatenation.
+
+    python benchmarks/bench_encode.py [number]
+"""
+import os
+import sys
+import time
+import timeit
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(BASEDIR)
+
+import ThreeScalePY
+
+def concat_encode_recursive(prefix, trans):
+    new_value = ""
+    for key in trans.keys():
+        if key == 'usage':
+            new_value += concat_encode_recursive("%s[usage]" % (prefix), trans[key])
+        elif key == 'timestamp':
+            new_value += "%s[%s]=%s" % (prefix, key, quote(str(time.strftime('%Y-%m-%d %H:%M:%S %z', trans[key]))))
+        else:
+            new_value += ("%s[%s]=%s" % (prefix, key, quote(str(trans[key]))))
+    return new_value
+
+def concat_build_post_data(client, transactions):
+    """the encoder as it was before the single join"""
+    encoded = ''
+    for i, trans in enumerate(transactions):
+        encoded += concat_encode_recursive("&transactions[%d]" % (i), trans)
+    body_params = "service_token=%s&service_id=%s&%s" % (client.service_token, client.service_id, encoded)
+    return body_params.encode(ThreeScalePY.ThreeScale.ENCODING)
+
+def transactions(count):
+    timestamp = time.gmtime(1500000000)
+    return [{'app_id': 'app_%d' % (i % 20), 'timestamp': timestamp,
+             'usage': {'hits': 1, 'search': i % 7}} for i in range(count)]
+
+def best_of(func, number):
+    return min(timeit.repeat(func, repeat=5, number=number)) / number
+
+def main(number=200):
+    client = ThreeScalePY.ThreeScale(service_id='1', service_token='token')
+    print("%-14s %14s %14s %8s" % ("transactions", "concat (us)", "join (us)", "speedup"))
+    for count in (10, 100, 1000):
+        trans = transactions(count)
+        old = best_of(lambda: concat_build_post_data(client, trans), number)
+        new = best_of(lambda: client.build_post_data(trans), number)
+        print("%-14d %14.1f %14.1f %7.1fx" % (count, old * 1e6, new * 1e6, old / new))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
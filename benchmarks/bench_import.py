@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the cold start of the plugin.
+
+Imports ThreeScalePY in fresh interpreters and reports the time spent in
+the import, the peak memory of the process and whether lxml was loaded,
+then the same for the first response parsed with each xml backend.
+
+    python benchmarks/bench_import.py [runs]
+"""
+import os
+import subprocess
+import sys
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+BODY = "b'<status><authorized>true</authorized><plan>Basic</plan></status>'"
+
+SCENARIOS = [
+    ("interpreter", "pass"),
+    ("import", "import ThreeScalePY"),
+    ("parse, lxml", "import ThreeScalePY\n"
+                    "ThreeScalePY.set_xml_backend('lxml')\n"
+                    "ThreeScalePY.parse_xml(%s)" % BODY),
+    ("parse, etree", "import ThreeScalePY\n"
+                     "ThreeScalePY.set_xml_backend('etree')\n"
+                     "ThreeScalePY.parse_xml(%s)" % BODY),
+]
+
+CHILD = """
+import sys, time
+sys.path.insert(0, %r)
+start = time.time()
+%s
+elapsed = time.time() - start
+try:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+except ImportError:
+    rss = 0
+print("%%f %%d %%d %%d" %% (elapsed, rss, len(sys.modules), 'lxml' in sys.modules))
+"""
+
+def run(code):
+    output = subprocess.check_output([sys.executable, "-c", CHILD % (BASEDIR, code)])
+    elapsed, rss, modules, lxml = output.split()
+    return float(elapsed), int(rss), int(modules), lxml == b'1'
+
+def main(runs=20):
+    print("%-14s %12s %14s %8s %6s" % ("scenario", "time (ms)", "max rss (kB)", "modules", "lxml"))
+    for name, code in SCENARIOS:
+        try:
+            samples = [run(code) for _ in range(runs)]
+        except subprocess.CalledProcessError:
+            print("%-14s %12s" % (name, "unavailable"))
+            continue
+        elapsed = sorted(sample[0] for sample in samples)[len(samples) // 2]
+        rss = sorted(sample[1] for sample in samples)[len(samples) // 2]
+        print("%-14s %12.1f %14d %8d %6s" % (name, elapsed * 1000, rss, samples[0][2],
+                                            "yes" if samples[0][3] else "no"))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
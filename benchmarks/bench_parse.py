@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of the authorize response parser.
+
+Compares ThreeScaleAuthorizeResponse.parse(), which walks the document
+once, with the former implementation, which evaluated a new XPath string
+for every field of every usage report. The last columns time
+ThreeScaleLazyAuthorizeResponse when only the plan, or one usage report,
+is asked for. The former implementation needs lxml: without it, its
+columns are left empty.
+
+    python benchmarks/bench_parse.py [number]
+"""
+import os
+import sys
+import timeit
+
+BASEDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(BASEDIR)
+
+import ThreeScalePY
+
+USAGE_REPORT = """
+    <usage_report metric="metric_%d" period="%s">
+      <period_start>2010-04-26 00:00:00 +0000</period_start>
+      <period_end>2010-04-27 00:00:00 +0000</period_end>
+      <max_value>50000</max_value>
+      <current_value>%d</current_value>
+    </usage_report>"""
+
+PERIODS = ['minute', 'hour', 'day', 'week', 'month', 'year']
+
+def status_xml(reports):
+    """return an authorize response body with the given number of usage reports"""
+    usage = ''.join(USAGE_REPORT % (i, PERIODS[i % len(PERIODS)], i) for i in range(reports))
+    return ("<status><authorized>true</authorized><plan>Basic</plan>"
+            "<usage_reports>%s</usage_reports></status>" % usage).encode('utf-8')
+
+def xpath_parse(body):
+    """the parser as it was before the single walk"""
+    from lxml import etree
+    resp = ThreeScalePY.ThreeScaleAuthorizeResponse()
+    xml = etree.fromstring(body)
+    if xml.xpath('/status'):
+        resp.set_plan(xml.xpath('/status/plan')[0].text)
+        for node in xml.xpath('/status/usage_reports/usage_report'):
+            report = ThreeScalePY.ThreeScaleAuthorizeResponseUsageReport()
+            report.set_metric(node.xpath('@metric')[0])
+            period = node.xpath('@period')[0]
+            report.set_period(period)
+            if period != "eternity":
+                report.set_interval(node.xpath('period_start')[0].text,
+                                    node.xpath('period_end')[0].text)
+            report.set_max_value(node.xpath('max_value')[0].text)
+            report.set_current_value(node.xpath('current_value')[0].text)
+            resp.usage_reports.append(report)
+    return resp
+
+def lazy_plan(body):
+    return ThreeScalePY.ThreeScaleLazyAuthorizeResponse.parse(body).get_plan()
+
+def lazy_report(body):
+    return ThreeScalePY.ThreeScaleLazyAuthorizeResponse.parse(body).get_usage_report('metric_0')
+
+def best_of(func, body, number):
+    return min(timeit.repeat(lambda: func(body), repeat=5, number=number)) / number
+
+def main(number=300):
+    try:
+        import lxml
+        has_lxml = True
+    except ImportError:
+        has_lxml = False
+    print("%-10s %14s %14s %8s %14s %14s" % ("reports", "xpath (us)", "single (us)", "speedup",
+                                             "lazy plan (us)", "lazy one (us)"))
+    for reports in (0, 1, 10, 50, 200):
+        body = status_xml(reports)
+        new = best_of(ThreeScalePY.ThreeScaleAuthorizeResponse.parse, body, number)
+        plan = best_of(lazy_plan, body, number)
+        one = best_of(lazy_report, body, number)
+        if has_lxml:
+            old = best_of(xpath_parse, body, number)
+            old_columns = "%14.1f %14.1f %7.1fx" % (old * 1e6, new * 1e6, old / new)
+        else:
+            old_columns = "%14s %14.1f %8s" % ("-", new * 1e6, "-")
+        print("%-10d %s %14.1f %14.1f" % (reports, old_columns, plan * 1e6, one * 1e6))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
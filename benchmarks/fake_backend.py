@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""In-process stub of the 3scale Service Management API for benchmarks.
+
+Serves /transactions/authrep.xml, /transactions/authorize.xml and
+/transactions.xml with keep-alive connections, an optional latency and one
+of the following modes:
+ - ok: every call is authorized (200, 202 for reports)
+ - forbidden: every call is rejected with 403 and an <error> document
+ - limited: authorizations are rejected with 409, usage limits exceeded
+
+It can be started on its own to benchmark other clients:
+
+    python benchmarks/fake_backend.py --port 8081 --latency 0.005 --mode limited
+"""
+import argparse
+import threading
+import time
+
+try:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+USAGE_REPORT = """<usage_report metric="metric_%d" period="day">
+      <period_start>2010-04-26 00:00:00 +0000</period_start>
+      <period_end>2010-04-27 00:00:00 +0000</period_end>
+      <max_value>50000</max_value>
+      <current_value>%d</current_value>
+    </usage_report>"""
+
+def status_body(authorized, reports, reason=None):
+    usage = ''.join(USAGE_REPORT % (i, i) for i in range(reports))
+    reason = "<reason>%s</reason>" % reason if reason else ""
+    return ("<status><authorized>%s</authorized>%s<plan>Basic</plan>"
+            "<usage_reports>%s</usage_reports></status>"
+            % ('true' if authorized else 'false', reason, usage)).encode('utf-8')
+
+FORBIDDEN_BODY = b'<error code="user_key_invalid">user key "foo" is invalid</error>'
+
+
+class FakeBackendHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def respond(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if server.latency:
+            time.sleep(server.latency)
+
+        path = self.path.split('?', 1)[0]
+        if path == '/transactions.xml':
+            status, body = (403, FORBIDDEN_BODY) if server.mode == 'forbidden' else (202, b'')
+        elif path in ('/transactions/authrep.xml', '/transactions/authorize.xml'):
+            status, body = server.bodies[server.mode]
+        else:
+            status, body = 404, b''
+
+        with server.lock:
+            server.calls += 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/vnd.3scale-v2.0+xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeBackend(ThreadingMixIn, HTTPServer):
+    """the stub backend, serving from a daemon thread once start() is called"""
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, port=0, latency=0.0, mode='ok', reports=3):
+        HTTPServer.__init__(self, ('127.0.0.1', port), FakeBackendHandler)
+        self.latency = latency
+        self.mode = mode
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.bodies = {
+            'ok': (200, status_body(True, reports)),
+            'limited': (409, status_body(False, reports, "usage limits are exceeded")),
+            'forbidden': (403, FORBIDDEN_BODY),
+        }
+        self.thread = None
+
+    def uri(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--mode', choices=['ok', 'forbidden', 'limited'], default='ok')
+    parser.add_argument('--reports', type=int, default=3, help="usage reports per status document")
+    args = parser.parse_args()
+    backend = FakeBackend(args.port, args.latency, args.mode, args.reports)
+    print("fake 3scale backend listening on %s" % backend.uri())
+    try:
+        backend.serve_forever()
+    except KeyboardInterrupt:
+        pass
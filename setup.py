@@ -9,7 +9,10 @@ setup(
     author_email='support@3scale.net',
     url='https://github.com/3scale/3scale_ws_api_for_python',
     license='MIT',
-    py_modules=['ThreeScalePY'],
+    py_modules=['ThreeScalePY', 'ThreeScaleAsync'],
+    extras_require={
+        'lxml': ['lxml>=3.4.0'],
+    },
     dependency_links=[
         "ftp://xmlsoft.org/libxml2/python/libxml2-python-2.6.21.tar.gz"
     ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+"""ASGI application and client used by the middleware tests. The
+coroutines are kept out of tests.py, which must compile on Python 2."""
+import asyncio
+
+async def app(scope, receive, send):
+    """answer with the body of the ThreeScaleResult of the request"""
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': scope['threescale.result'].get_body()})
+
+def call(middleware, scope):
+    """run the middleware for an http request and return its (status, body)"""
+    messages = []
+    async def send(message):
+        messages.append(message)
+    async def receive():
+        return {'type': 'http.request'}
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(middleware(scope, receive, send))
+    finally:
+        loop.close()
+    return messages[0]['status'], messages[1]['body']
@@ -8,11 +8,123 @@ sys.path.append(BASEDIR)
 #!/usr/bin/env python -I ../
 
 import unittest
+import calendar
+import hashlib
+import logging
+import shutil
+import subprocess
+import tempfile
 import time
+import threading
 import httpretty
+import xml.etree.ElementTree as ElementTree
+
+try:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
 
 import ThreeScalePY
 
+try:
+    import asyncio
+    import ThreeScaleAsync
+    import asgi_app
+except (ImportError, SyntaxError):
+    # Python 2
+    ThreeScaleAsync = None
+
+AUTHORIZED_XML = b"""<status>
+  <authorized>true</authorized>
+  <plan>Basic</plan>
+</status>"""
+
+class FakeBackendHandler(BaseHTTPRequestHandler):
+    """serves the responses registered in FakeBackend.responses, keeping
+    the connections alive"""
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.respond()
+
+    def do_CONNECT(self):
+        # act as a proxy to itself
+        self.server.requests.append((self.command, self.path, self.client_address[1], b''))
+        self.server.request_headers.append(dict((k.lower(), v) for k, v in self.headers.items()))
+        self.send_response(200)
+        self.end_headers()
+        # the CONNECT is sent as HTTP/1.0, keep the tunnel open anyway
+        self.close_connection = False
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        self.server.requests.append((self.command, self.path, self.client_address[1], body))
+        self.server.request_headers.append(dict((k.lower(), v) for k, v in self.headers.items()))
+        if self.server.drops:
+            # the request is read, then the connection is closed without
+            # any response
+            self.server.drops -= 1
+            self.close_connection = True
+            return
+        path = self.path.split('?', 1)[0]
+        response = self.server.responses.get(path, (200, AUTHORIZED_XML))
+        status, resp_body = response[:2]
+        delay = self.server.delays.pop(0) if self.server.delays else self.server.delay
+        if delay:
+            time.sleep(delay)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/vnd.3scale-v2.0+xml')
+        self.send_header('Content-Length', str(len(resp_body)))
+        for name, value in (response[2] if len(response) > 2 else {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(resp_body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeBackend(ThreadingMixIn, HTTPServer):
+    """in-process 3scale backend listening on a random local port"""
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeBackendHandler)
+        self.requests = []
+        self.request_headers = []
+        # path -> (status, body) or (status, body, headers)
+        self.responses = {}
+        self.delay = 0
+        # delays of the next requests, in the order they arrive
+        self.delays = []
+        # number of the next requests left without response
+        self.drops = 0
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def uri(self):
+        return 'http://127.0.0.1:%d' % self.server_port
+
+    def handle_error(self, request, client_address):
+        # clients giving up on purpose, e.g. on timeouts
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
 class TestThreeScale(unittest.TestCase):
     """base class for testing authorize and report APIs"""
     def setupTests(self):
@@ -243,6 +355,1947 @@ class TestThreeScaleAuthorize(TestThreeScale):
         self.assertEquals(reports[0].get_max_value(), "50000")
         self.assertEquals(reports[0].get_current_value(), "50002")
 
+class TestThreeScaleConnectionPool(unittest.TestCase):
+    """test case for the keep-alive connection pool, against a local backend"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.pool = ThreeScalePY.ThreeScaleConnectionPool()
+
+    def tearDown(self):
+        self.pool.clear()
+        self.backend.stop()
+
+    def client(self, cls=ThreeScalePY.ThreeScaleAuthRep, **kwargs):
+        client = cls(service_id='1', service_token='token', backend_uri=self.backend.uri(), **kwargs)
+        client.set_connection_pool(self.pool)
+        return client
+
+    def testConnectionIsReused(self):
+        """test that consecutive calls share one keep-alive connection"""
+        authrep = self.client(app_id='foo')
+        self.assertTrue(authrep.authrep())
+        self.assertTrue(authrep.authrep())
+        auth = self.client(ThreeScalePY.ThreeScaleAuthorizeUserKey, user_key='bar')
+        self.assertTrue(auth.authorize())
+        ports = set(req[2] for req in self.backend.requests)
+        self.assertEqual(len(self.backend.requests), 3)
+        self.assertEqual(len(ports), 1)
+
+    def testIdleConnectionsAreEvicted(self):
+        """test that connections idle for longer than idle_timeout are not reused"""
+        self.pool.idle_timeout = -1
+        authrep = self.client(app_id='foo')
+        self.assertTrue(authrep.authrep())
+        self.assertTrue(authrep.authrep())
+        ports = set(req[2] for req in self.backend.requests)
+        self.assertEqual(len(ports), 2)
+
+    def testAuthorizeIsSentAgain(self):
+        """test that an authorize lost on a reused connection is sent again"""
+        auth = self.client(ThreeScalePY.ThreeScaleAuthorizeUserKey, user_key='bar')
+        self.assertTrue(auth.authorize())
+        self.backend.drops = 1
+        self.assertTrue(auth.authorize())
+        self.assertEqual(len(self.backend.requests), 3)
+
+    def testAuthRepIsNotSentAgain(self):
+        """test that an authrep lost on a reused connection is not sent twice"""
+        authrep = self.client(app_id='foo')
+        self.assertTrue(authrep.authrep())
+        self.backend.drops = 1
+        self.assertRaises(ThreeScalePY.ThreeScaleConnectionError, authrep.authrep)
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def testForkedProcessOpensItsConnections(self):
+        """test that a forked process does not reuse the connections of its parent"""
+        if not hasattr(os, 'fork'):
+            self.skipTest("fork is not available")
+        auth = self.client(ThreeScalePY.ThreeScaleAuthorizeUserKey, user_key='bar')
+        self.assertTrue(auth.authorize())
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                metrics = ThreeScalePY.ThreeScaleCallMetrics('authorize')
+                resp = self.pool.request('GET', self.backend.uri() + '/transactions/authorize.xml',
+                                         metrics=metrics)
+                os.write(write, ("%d %s" % (resp.status, metrics.reused)).encode('ascii'))
+            finally:
+                os._exit(0)
+        os.close(write)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read, 64), b'200 False')
+        os.close(read)
+        self.assertTrue(auth.authorize())
+        ports = [req[2] for req in self.backend.requests]
+        self.assertEqual(len(ports), 3)
+        self.assertEqual(ports[0], ports[2])
+        self.assertNotEqual(ports[0], ports[1])
+
+    def set_proxy_environ(self, **environ):
+        saved = dict(os.environ)
+        self.addCleanup(os.environ.update, saved)
+        self.addCleanup(os.environ.clear)
+        for name in ('http_proxy', 'https_proxy', 'no_proxy'):
+            os.environ.pop(name, None)
+            os.environ.pop(name.upper(), None)
+        os.environ.update(environ)
+
+    def testHttpProxy(self):
+        """test that http requests go to the proxy of the environment with the absolute URI"""
+        self.set_proxy_environ(http_proxy='user:secret@' + self.backend.uri()[len('http://'):])
+        resp = self.pool.request('GET', 'http://backend.example.com/transactions/authorize.xml?user_key=bar')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(self.backend.requests[0][1],
+                         'http://backend.example.com/transactions/authorize.xml?user_key=bar')
+        self.assertEqual(self.backend.request_headers[0]['host'], 'backend.example.com')
+        self.assertEqual(self.backend.request_headers[0]['proxy-authorization'],
+                         'Basic dXNlcjpzZWNyZXQ=')
+
+    def testHttpsProxyTunnel(self):
+        """test that https requests go through a CONNECT tunnel to the proxy"""
+        self.set_proxy_environ(https_proxy=self.backend.uri())
+        # the fake backend does not speak TLS in the tunnel
+        self.assertRaises(ThreeScalePY.ThreeScaleConnectionError, self.pool.request,
+                          'GET', 'https://backend.example.com/transactions/authorize.xml', timeout=2)
+        self.assertEqual(self.backend.requests[0][:2], ('CONNECT', 'backend.example.com:443'))
+
+    def testNoProxy(self):
+        """test that the hosts in no_proxy are reached directly"""
+        self.set_proxy_environ(http_proxy='http://127.0.0.1:1', no_proxy='127.0.0.1')
+        resp = self.pool.request('GET', self.backend.uri() + '/transactions/authorize.xml')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(self.backend.requests[0][1], '/transactions/authorize.xml')
+
+    def testPoolIsShared(self):
+        """test that all the clients use the same default pool"""
+        authrep = ThreeScalePY.ThreeScaleAuthRep(service_id='1', service_token='token')
+        report = ThreeScalePY.ThreeScaleReport(service_id='1', service_token='token')
+        self.assertTrue(authrep.connection_pool is report.connection_pool)
+
+    def testRejectedAuthRep(self):
+        """test that 409 responses are returned as a rejection with its reason"""
+        self.backend.responses['/transactions/authrep.xml'] = (409,
+            b"<status><authorized>false</authorized><reason>usage limits are exceeded</reason><plan>Basic</plan></status>")
+        authrep = self.client(app_id='foo')
+        self.assertFalse(authrep.authrep())
+        self.assertEqual(409, authrep.error_code)
+        self.assertEqual("usage limits are exceeded", authrep.build_response().get_reason())
+
+    def testServerError(self):
+        """test that unexpected statuses raise ThreeScaleServerError"""
+        self.backend.responses['/transactions.xml'] = (500, b"")
+        report = self.client(ThreeScalePY.ThreeScaleReport)
+        self.assertRaises(ThreeScalePY.ThreeScaleServerError, report.report, [{'app_id': 'foo', 'usage': {'hits': 1}}])
+
+    def testReportIsPosted(self):
+        """test that report sends the url encoded transactions"""
+        report = self.client(ThreeScalePY.ThreeScaleReport)
+        self.assertTrue(report.report([{'app_id': 'foo', 'usage': {'hits': 1}}]))
+        method, path, _, body = self.backend.requests[0]
+        self.assertEqual(('POST', '/transactions.xml'), (method, path))
+        self.assertTrue(b"&transactions[0][usage][hits]=1" in body)
+
+    def testConnectionError(self):
+        """test that a refused connection raises ThreeScaleConnectionError"""
+        authrep = self.client(app_id='foo')
+        self.backend.stop()
+        self.assertRaises(ThreeScalePY.ThreeScaleConnectionError, authrep.authrep)
+
+class TestThreeScaleAuthorizeCache(unittest.TestCase):
+    """test case for the client-side authorization cache"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def client(self, cache):
+        auth = ThreeScalePY.ThreeScaleAuthorize(app_id='foo', service_id='1', service_token='token',
+                                                backend_uri=self.backend.uri())
+        auth.set_auth_cache(cache)
+        return auth
+
+    def testCachedAuthorize(self):
+        """test that a cached authorization does not call the backend again"""
+        cache = ThreeScalePY.ThreeScaleAuthorizeCache()
+        auth = self.client(cache)
+        self.assertTrue(auth.authorize())
+        self.assertTrue(auth.authorize())
+        self.assertTrue(self.client(cache).authorize())
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(auth.build_auth_response().get_plan(), "Basic")
+
+    def testCacheKeyIncludesUsage(self):
+        """test that different usages are cached separately"""
+        auth = self.client(ThreeScalePY.ThreeScaleAuthorizeCache())
+        self.assertTrue(auth.authorize(usage={'hits': 1}))
+        self.assertTrue(auth.authorize(usage={'hits': 2}))
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def testRejectionsAreNotCached(self):
+        """test that rejected authorizations always go to the backend"""
+        self.backend.responses['/transactions/authorize.xml'] = (409,
+            b"<status><authorized>false</authorized><reason>application key is missing</reason><plan>Basic</plan></status>")
+        auth = self.client(ThreeScalePY.ThreeScaleAuthorizeCache())
+        self.assertFalse(auth.authorize())
+        self.assertFalse(auth.authorize())
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def testEntryExpiresAtPeriodEnd(self):
+        """test that an entry is not kept past the end of its usage periods"""
+        self.backend.responses['/transactions/authorize.xml'] = (200, b"""<status>
+              <authorized>true</authorized>
+              <plan>Basic</plan>
+              <usage_reports>
+                <usage_report metric="hits" period="day">
+                  <period_start>2010-04-26 00:00:00 +0000</period_start>
+                  <period_end>2010-04-27 00:00:00 +0000</period_end>
+                  <current_value>1</current_value>
+                  <max_value>50000</max_value>
+                </usage_report>
+              </usage_reports>
+            </status>""")
+        auth = self.client(ThreeScalePY.ThreeScaleAuthorizeCache())
+        self.assertTrue(auth.authorize())
+        self.assertTrue(auth.authorize())
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def testLeastRecentlyUsedEviction(self):
+        """test that the cache keeps at most max_size entries"""
+        cache = ThreeScalePY.ThreeScaleAuthorizeCache(max_size=1)
+        auth = self.client(cache)
+        self.assertTrue(auth.authorize(usage={'hits': 1}))
+        self.assertTrue(auth.authorize(usage={'hits': 2}))
+        self.assertTrue(auth.authorize(usage={'hits': 1}))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(len(self.backend.requests), 3)
+
+    def testExtensionHeadersAreCached(self):
+        """test that a hit without body keeps the limits of the headers"""
+        headers = {'3scale-limit-remaining': '7', '3scale-limit-reset': '42'}
+        self.backend.responses['/transactions/authorize.xml'] = (200, b'', headers)
+        client = ThreeScalePY.ThreeScale(service_id='1', service_token='token',
+                                         backend_uri=self.backend.uri())
+        client.set_backend_options(no_body=True, limit_headers=True)
+        client.set_auth_cache(ThreeScalePY.ThreeScaleAuthorizeCache())
+        client.call_authorize(app_id='foo')
+        result = client.call_authorize(app_id='foo')
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertEqual(result.get_headers(), headers)
+        response = result.get_response()
+        self.assertEqual((response.get_limit_remaining(), response.get_limit_reset()), (7, 42))
+
+    def testEntryExpiresAtLimitReset(self):
+        """test that an entry is not kept past the reset of the limit header"""
+        self.backend.responses['/transactions/authorize.xml'] = (200, b'', {'3scale-limit-reset': '0'})
+        auth = self.client(ThreeScalePY.ThreeScaleAuthorizeCache())
+        auth.set_backend_options(no_body=True, limit_headers=True)
+        self.assertTrue(auth.authorize())
+        self.assertTrue(auth.authorize())
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def testParsePeriod(self):
+        """test the conversion of period bounds to epoch seconds"""
+        self.assertEqual(ThreeScalePY.parse_period("1970-01-01 01:00:00 +0100"), 0)
+        self.assertEqual(ThreeScalePY.parse_period("1970-01-01 00:00:00 -0030"), 1800)
+
+class TestThreeScaleBatchReporter(unittest.TestCase):
+    """test case for the background batching reporter"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.reporter = None
+
+    def tearDown(self):
+        if self.reporter:
+            self.reporter.close()
+        self.backend.stop()
+
+    def create_reporter(self, **kwargs):
+        self.reporter = ThreeScalePY.ThreeScaleBatchReporter(service_id='1', service_token='token',
+                                                             backend_uri=self.backend.uri(), **kwargs)
+        return self.reporter
+
+    def posted_transactions(self):
+        return [req[3].count(b'[usage][hits]') for req in self.backend.requests]
+
+    def testFlushInBatches(self):
+        """test that the queued transactions are sent in chunks of batch_size"""
+        reporter = self.create_reporter(flush_interval=60)
+        for i in range(2500):
+            self.assertTrue(reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}}))
+        reporter.flush()
+        self.assertEqual(self.posted_transactions(), [1000, 1000, 500])
+
+    def testFlushInterval(self):
+        """test that a partial batch is sent after flush_interval"""
+        reporter = self.create_reporter(flush_interval=0.05)
+        reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}})
+        time.sleep(0.5)
+        self.assertEqual(self.posted_transactions(), [1])
+
+    def testDropWhenFull(self):
+        """test that transactions are dropped when the queue is full and block is False"""
+        self.backend.delay = 0.5
+        reporter = self.create_reporter(batch_size=1, max_queue_size=1, block=False)
+        self.assertTrue(reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}}))
+        time.sleep(0.2)
+        self.assertTrue(reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}}))
+        self.assertFalse(reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}}))
+        self.assertEqual(reporter.dropped, 1)
+
+    def testErrorCallback(self):
+        """test that failed batches are passed to on_error"""
+        self.backend.responses['/transactions.xml'] = (403, b"<error>service token is invalid</error>")
+        errors = []
+        reporter = self.create_reporter(on_error=lambda err, batch: errors.append((err, batch)))
+        reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}})
+        reporter.flush()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(isinstance(errors[0][0], ThreeScalePY.ThreeScaleServerError))
+        self.assertEqual(reporter.failed, 1)
+
+    def testRaisingErrorCallback(self):
+        """test that an on_error callback which raises does not stop the reporter"""
+        self.backend.responses['/transactions.xml'] = (403, b"<error>service token is invalid</error>")
+        def on_error(err, batch):
+            raise ValueError("callback error")
+        reporter = self.create_reporter(on_error=on_error)
+        reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}})
+        reporter.flush()
+        reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}})
+        reporter.flush()
+        self.assertEqual(reporter.failed, 2)
+        self.assertTrue(reporter.thread.is_alive())
+
+    def testStoppedThread(self):
+        """test that flush and enqueue raise instead of blocking when the thread is gone"""
+        reporter = self.create_reporter(batch_size=1, max_queue_size=1)
+        reporter.queue.put(None)
+        reporter.thread.join(1)
+        reporter.queue.put({'app_id': 'foo', 'usage': {'hits': 1}})
+        self.assertRaises(ThreeScalePY.ThreeScaleException, reporter.enqueue,
+                          {'app_id': 'foo', 'usage': {'hits': 1}})
+        self.assertRaises(ThreeScalePY.ThreeScaleException, reporter.flush)
+        reporter.close()
+
+    def testClose(self):
+        """test that close reports the queued transactions and rejects new ones"""
+        reporter = self.create_reporter(flush_interval=60)
+        reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}})
+        reporter.close()
+        self.assertEqual(self.posted_transactions(), [1])
+        self.assertFalse(reporter.thread.is_alive())
+        self.assertRaises(ThreeScalePY.ThreeScaleException, reporter.enqueue, {'app_id': 'foo'})
+
+    def testForkedProcessReports(self):
+        """test that a forked process reports from a thread of its own"""
+        if not hasattr(os, 'fork'):
+            self.skipTest("fork is not available")
+        reporter = self.create_reporter(flush_interval=60)
+        reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}})
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                reporter.enqueue({'app_id': 'bar', 'usage': {'hits': 1}})
+                reporter.enqueue({'app_id': 'bar', 'usage': {'hits': 1}})
+                reporter.flush(5)
+                os.write(write, b'ok')
+            finally:
+                os._exit(0)
+        os.close(write)
+        os.waitpid(pid, 0)
+        self.assertEqual(os.read(read, 64), b'ok')
+        os.close(read)
+        self.assertEqual(self.posted_transactions(), [2])
+        self.assertTrue(b'bar' in self.backend.requests[0][3] and b'foo' not in self.backend.requests[0][3])
+        reporter.flush()
+        self.assertEqual(self.posted_transactions(), [2, 1])
+
+    def testInvalidBatchSize(self):
+        """test that batches over the backend limit are rejected"""
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.create_reporter, batch_size=1001)
+
+class TestThreeScaleAsync(unittest.TestCase):
+    """test case for the asyncio client"""
+
+    def setUp(self):
+        if ThreeScaleAsync is None:
+            self.skipTest("asyncio is not available")
+        self.backend = FakeBackend()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        self.backend.stop()
+
+    def client(self, cls, **kwargs):
+        return cls(service_id='1', service_token='token', backend_uri=self.backend.uri(), **kwargs)
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def testAsyncAuthRep(self):
+        """test concurrent authrep calls over pooled connections"""
+        authrep = self.client(ThreeScaleAsync.ThreeScaleAsyncAuthRep, app_id='foo')
+        responses = self.run_async(asyncio.gather(*[authrep.authrep_async() for i in range(20)]))
+        responses += self.run_async(asyncio.gather(*[authrep.authrep_async() for i in range(20)]))
+        self.assertTrue(all(resp.is_authorized() for resp in responses))
+        self.assertEqual(len(self.backend.requests), 40)
+        ports = set(req[2] for req in self.backend.requests)
+        self.assertTrue(len(ports) <= 20)
+
+    def testAsyncAuthorizeRejected(self):
+        """test that rejections are returned as responses with their reason"""
+        self.backend.responses['/transactions/authorize.xml'] = (409,
+            b"<status><authorized>false</authorized><reason>usage limits are exceeded</reason><plan>Basic</plan></status>")
+        auth = self.client(ThreeScaleAsync.ThreeScaleAsyncAuthorizeUserKey, user_key='bar')
+        resp = self.run_async(auth.authorize_async())
+        self.assertFalse(resp.is_authorized())
+        self.assertEqual(409, resp.get_error_code())
+        self.assertEqual("usage limits are exceeded", resp.get_reason())
+        self.assertEqual("Basic", resp.get_plan())
+
+    def testAsyncReport(self):
+        """test report_async and its error mapping"""
+        report = self.client(ThreeScaleAsync.ThreeScaleAsyncReport)
+        self.assertTrue(self.run_async(report.report_async([{'app_id': 'foo', 'usage': {'hits': 1}}])))
+        self.backend.responses['/transactions.xml'] = (403, b"<error>service token is invalid</error>")
+        self.assertRaises(ThreeScalePY.ThreeScaleServerError, self.run_async,
+                          report.report_async([{'app_id': 'foo', 'usage': {'hits': 1}}]))
+
+    def testAsyncConnectionError(self):
+        """test that timeouts and refused connections raise ThreeScaleConnectionError"""
+        self.backend.delay = 0.5
+        authrep = self.client(ThreeScaleAsync.ThreeScaleAsyncAuthRep, app_id='foo')
+        self.assertRaises(ThreeScalePY.ThreeScaleConnectionError, self.run_async,
+                          authrep.authrep_async(timeout=0.1))
+        self.backend.stop()
+        self.assertRaises(ThreeScalePY.ThreeScaleConnectionError, self.run_async,
+                          authrep.authrep_async())
+
+    def testAsyncOnlyAuthorizeIsSentAgain(self):
+        """test that only authorize calls lost on a reused connection are sent again"""
+        auth = self.client(ThreeScaleAsync.ThreeScaleAsyncAuthorizeUserKey, user_key='bar')
+        self.assertTrue(self.run_async(auth.authorize_async()).is_authorized())
+        self.backend.drops = 1
+        self.assertTrue(self.run_async(auth.authorize_async()).is_authorized())
+        self.assertEqual(len(self.backend.requests), 3)
+        authrep = self.client(ThreeScaleAsync.ThreeScaleAsyncAuthRep, app_id='foo')
+        self.backend.drops = 1
+        self.assertRaises(ThreeScalePY.ThreeScaleConnectionError, self.run_async,
+                          authrep.authrep_async())
+        self.assertEqual(len(self.backend.requests), 4)
+
+    def testAsyncMetrics(self):
+        """test that the coroutines report their metrics to the collector"""
+        collector = ListCollector()
+        auth = self.client(ThreeScaleAsync.ThreeScaleAsyncAuthorizeUserKey, user_key='bar')
+        auth.set_async_connection_pool(ThreeScaleAsync.ThreeScaleAsyncConnectionPool())
+        auth.set_auth_cache(ThreeScalePY.ThreeScaleAuthorizeCache())
+        auth.set_collector(collector)
+        self.assertTrue(self.run_async(auth.authorize_async()).is_authorized())
+        self.assertTrue(self.run_async(auth.authorize_async()).is_authorized())
+        miss, hit = collector.metrics
+        self.assertEqual((miss.call, miss.status, miss.success, miss.cache), ('authorize', 200, True, 'miss'))
+        self.assertEqual(sorted(miss.phases), ['body', 'connect', 'ttfb'])
+        self.assertTrue(miss.duration >= sum(miss.phases.values()) - 0.001)
+        self.assertEqual((hit.cache, hit.phases), ('hit', {}))
+
+        authrep = self.client(ThreeScaleAsync.ThreeScaleAsyncAuthRep, app_id='foo')
+        authrep.set_async_connection_pool(auth.async_connection_pool)
+        authrep.set_collector(collector)
+        self.assertTrue(self.run_async(authrep.authrep_async()).is_authorized())
+        self.assertEqual((collector.metrics[2].call, collector.metrics[2].reused), ('authrep', True))
+        report = self.client(ThreeScaleAsync.ThreeScaleAsyncReport)
+        report.set_collector(collector)
+        self.backend.responses['/transactions.xml'] = (403, b"<error>service token is invalid</error>")
+        self.assertRaises(ThreeScalePY.ThreeScaleServerError, self.run_async,
+                          report.report_async([{'app_id': 'foo', 'usage': {'hits': 1}}]))
+        metrics = collector.metrics[3]
+        self.assertEqual((metrics.call, metrics.status), ('report', 403))
+        self.assertTrue(isinstance(metrics.error, ThreeScalePY.ThreeScaleServerError))
+
+        # the base collector does nothing
+        authrep.set_collector(ThreeScalePY.ThreeScaleCollector())
+        self.assertTrue(self.run_async(authrep.authrep_async()).is_authorized())
+
+USAGE_REPORTS_XML = b"""<status>
+  <authorized>false</authorized>
+  <reason>usage limits are exceeded</reason>
+  <plan>Ultimate</plan>
+  <usage_reports>
+    <usage_report metric="hits" period="day" exceeded="true">
+      <period_start>2010-04-26 00:00:00 +0000</period_start>
+      <period_end>2010-04-27 00:00:00 +0000</period_end>
+      <current_value>50002</current_value>
+      <max_value>50000</max_value>
+    </usage_report>
+    <usage_report metric="hits" period="eternity">
+      <current_value>999872</current_value>
+      <max_value>150000</max_value>
+    </usage_report>
+  </usage_reports>
+</status>"""
+
+class TestThreeScaleResponseParsing(unittest.TestCase):
+    """test case for parsing the backend responses, without network"""
+
+    def testParseUsageReports(self):
+        """test that plan, reason and usage reports are read in one walk"""
+        resp = ThreeScalePY.ThreeScaleAuthorizeResponse.parse(USAGE_REPORTS_XML, 409)
+        self.assertFalse(resp.is_authorized())
+        self.assertEqual(resp.get_plan(), "Ultimate")
+        self.assertEqual(resp.get_reason(), "usage limits are exceeded")
+        day, eternity = resp.get_usage_reports()
+        self.assertEqual((day.get_metric(), day.get_period()), ("hits", "day"))
+        self.assertEqual(day.get_start_period(), "2010-04-26 00:00:00 +0000")
+        self.assertEqual(day.get_end_period(), "2010-04-27 00:00:00 +0000")
+        self.assertEqual((day.get_max_value(), day.get_current_value()), ("50000", "50002"))
+        self.assertEqual(eternity.get_period(), "eternity")
+        self.assertEqual(eternity.get_start_period(), None)
+        self.assertEqual(eternity.get_current_value(), "999872")
+
+    def testReasonIsOnlySetOnRejections(self):
+        """test that successful responses have no reason"""
+        resp = ThreeScalePY.ThreeScaleAuthorizeResponse.parse(USAGE_REPORTS_XML)
+        self.assertTrue(resp.is_authorized())
+        self.assertEqual(resp.get_reason(), None)
+
+    def testParseError(self):
+        """test the reason of <error> documents"""
+        body = b'<error code="provider_key_invalid">provider key "foo" is invalid</error>'
+        resp = ThreeScalePY.ThreeScaleAuthRepResponse.parse(body, 403)
+        self.assertEqual(resp.get_reason(), 'provider key "foo" is invalid')
+        resp = ThreeScalePY.ThreeScaleAuthorizeResponse.parse(body, 403)
+        self.assertEqual(resp.get_reason(), 'provider key "foo" is invalid')
+        self.assertEqual(resp.get_plan(), None)
+
+    def testTypedUsageReports(self):
+        """test the typed values of the usage reports and their index"""
+        resp = ThreeScalePY.ThreeScaleAuthorizeResponse.parse(USAGE_REPORTS_XML, 409)
+        day = resp.get_usage_report('hits', 'day')
+        self.assertEqual((day.max_value, day.current_value), (50000, 50002))
+        self.assertEqual((day.start, day.end), (1272240000, 1272326400))
+        self.assertEqual(day.get_remaining(), 0)
+        self.assertFalse(hasattr(day, '__dict__'))
+        self.assertTrue(resp.get_usage_report('hits') is day)
+        self.assertEqual(resp.get_usage_report('hits', 'eternity').end, None)
+        self.assertEqual(resp.get_usage_report('other'), None)
+        self.assertEqual(resp.get_remaining('hits'), 0)
+        self.assertEqual(resp.get_remaining('other'), None)
+        self.assertEqual(resp.get_next_reset(), 1272326400)
+
+        body = USAGE_REPORTS_XML.replace(b'<max_value>50000', b'<max_value>lots')
+        self.assertRaises(ThreeScalePY.ThreeScaleException,
+                          ThreeScalePY.ThreeScaleAuthorizeResponse.parse, body, 409)
+
+    def testPeriodsKeepTheirOffset(self):
+        """test that the period getters return the strings of the xml"""
+        body = USAGE_REPORTS_XML.replace(b'2010-04-26 00:00:00 +0000', b'2010-04-26 02:00:00 +0200')
+        day = ThreeScalePY.ThreeScaleAuthorizeResponse.parse(body, 409).get_usage_report('hits', 'day')
+        self.assertEqual(day.get_start_period(), "2010-04-26 02:00:00 +0200")
+        self.assertEqual(day.start, 1272240000)
+        day.set_end_period("2010-04-27 01:00:00 +0100")
+        self.assertEqual((day.get_end_period(), day.end), ("2010-04-27 01:00:00 +0100", 1272326400))
+
+    def testInvalidXml(self):
+        """test that invalid bodies raise ThreeScaleException"""
+        self.assertRaises(ThreeScalePY.ThreeScaleException,
+                          ThreeScalePY.ThreeScaleAuthorizeResponse.parse, b"<status>")
+
+class TestThreeScaleCallAPI(unittest.TestCase):
+    """test case for the stateless call_* API"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.client = ThreeScalePY.ThreeScale(service_id='1', service_token='token',
+                                              backend_uri=self.backend.uri())
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def testSharedBetweenThreads(self):
+        """test that one instance serves calls with different credentials from several threads"""
+        results = {}
+        def call(app_id):
+            results[app_id] = self.client.call_authrep(app_id=app_id, usage={'hits': 2})
+        threads = [threading.Thread(target=call, args=('app%d' % i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(results.values()))
+        paths = sorted(req[1] for req in self.backend.requests)
+        self.assertEqual(len(paths), 10)
+        self.assertTrue(all('usage%5Bhits%5D=2' in path for path in paths))
+        self.assertTrue('app_id=app3' in paths[3])
+
+    def testResultIsImmutableAndLazy(self):
+        """test that results can not be modified and parse their body on demand"""
+        self.backend.responses['/transactions/authorize.xml'] = (409,
+            b"<status><authorized>false</authorized><reason>usage limits are exceeded</reason><plan>Basic</plan></status>")
+        result = self.client.call_authorize(user_key='bar')
+        self.assertFalse(result)
+        self.assertEqual(result.get_status(), 409)
+        self.assertEqual(result.response, None)
+        self.assertEqual(result.get_response().get_reason(), "usage limits are exceeded")
+        self.assertTrue(result.get_response() is result.get_response())
+        self.assertRaises(AttributeError, setattr, result, 'success', True)
+
+    def testCallAuthorizeUsesCache(self):
+        """test that call_authorize shares the authorization cache"""
+        self.client.set_auth_cache(ThreeScalePY.ThreeScaleAuthorizeCache())
+        self.assertTrue(self.client.call_authorize(app_id='foo'))
+        result = self.client.call_authorize(app_id='foo')
+        self.assertTrue(result)
+        self.assertEqual(result.get_response().get_plan(), "Basic")
+        self.assertEqual(len(self.backend.requests), 1)
+
+    def testCallReport(self):
+        """test call_report from the base class"""
+        self.assertTrue(self.client.call_report([{'app_id': 'foo', 'usage': {'hits': 1}}]))
+        self.assertEqual(self.client.call_report([]).get_response(), None)
+
+    def testMissingCredentials(self):
+        """test that calls without application credentials are rejected"""
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.client.call_authrep)
+        self.assertEqual(len(self.backend.requests), 0)
+
+class TestThreeScaleReportEncoding(unittest.TestCase):
+    """test case for encoding the report payload, without network"""
+
+    def setUp(self):
+        self.client = ThreeScalePY.ThreeScale(service_id='1', service_token='token')
+
+    def testBuildPostData(self):
+        """test the encoding of a transaction with usage, log and timestamp"""
+        trans = {'app_id': 'foo bar', 'usage': {'hits': 1},
+                 'timestamp': time.gmtime(0), 'log': {'code': 200}}
+        body = self.client.build_post_data([trans]).decode('utf-8').split('&')
+        self.assertEqual(body[:2], ['service_token=token', 'service_id=1'])
+        self.assertEqual(sorted(body[2:]), ['transactions[0][app_id]=foo%20bar',
+                                            'transactions[0][log][code]=200',
+                                            'transactions[0][timestamp]=1970-01-01%2000%3A00%3A00%20%2B0000',
+                                            'transactions[0][usage][hits]=1'])
+
+    def testGeneratorOfTransactions(self):
+        """test that any iterable of transactions can be encoded"""
+        encoded = self.client.encode_transactions(({'app_id': 'app%d' % i} for i in range(3)))
+        self.assertEqual(encoded, '&transactions[0][app_id]=app0&transactions[1][app_id]=app1'
+                                  '&transactions[2][app_id]=app2')
+
+    def testEqualValuesOfOtherTypes(self):
+        """test that equal values of different types are quoted apart"""
+        encoded = self.client.encode_transactions([{'usage': {'hits': 1.0}},
+                                                   {'usage': {'hits': True}}])
+        self.assertEqual(encoded, '&transactions[0][usage][hits]=1.0'
+                                  '&transactions[1][usage][hits]=True')
+
+    def testInvalidTransactions(self):
+        """test that invalid transactions raise ThreeScaleException"""
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.client.encode_transactions, {'app_id': 'foo'})
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.client.encode_transactions, 'foo')
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.client.encode_transactions, 1)
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.client.encode_transactions, ['foo'])
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.client.encode_transactions,
+                          [{'timestamp': 'invalidTimeStamp'}])
+
+class TestThreeScaleQueryString(unittest.TestCase):
+    """test case for the precomputed query strings, without network"""
+
+    def setUp(self):
+        self.client = ThreeScalePY.ThreeScaleAuthRep(app_id='foo', app_key='bar',
+                                                     service_id='1', service_token='token')
+
+    def testQueryString(self):
+        """test the query string of the credentials, usage and log"""
+        self.assertEqual(self.client.get_query_string({'user_id': 'u 1'}, {'hits': 1}, {'code': 200}),
+                         'app_id=foo&app_key=bar&service_id=1&service_token=token&user_id=u+1'
+                         '&usage%5Bhits%5D=1&log%5Bcode%5D=200')
+
+    def testChangedCredentials(self):
+        """test that credentials changed after construction are encoded again"""
+        self.client.app_id = 'baz'
+        self.assertEqual(self.client.get_query_string(usage={'hits': 1}),
+                         'app_id=baz&app_key=bar&service_id=1&service_token=token&usage%5Bhits%5D=1')
+
+    def testCallCredentials(self):
+        """test that the credentials of a call replace the ones of the instance"""
+        query = self.client.get_query_string(credentials={'app_id': 'x', 'app_key': None})
+        self.assertEqual(parse_qs(query), {'app_id': ['x'], 'service_id': ['1'],
+                                           'service_token': ['token']})
+        query = self.client.get_query_string({'service_id': '2'}, credentials={'user_key': 'k'})
+        self.assertEqual(parse_qs(query), {'user_key': ['k'], 'service_id': ['2'],
+                                           'service_token': ['token']})
+
+    def testOtherParamsOverrideCredentials(self):
+        """test that other_params still override the credentials"""
+        self.assertEqual(parse_qs(self.client.get_query_string({'service_id': '2'})),
+                         {'app_id': ['foo'], 'app_key': ['bar'], 'service_id': ['2'],
+                          'service_token': ['token']})
+
+    def testUsageEncodingIsRemembered(self):
+        """test that usages are only encoded once"""
+        self.assertEqual(self.client.encode_usage({'hits': 3}), 'usage%5Bhits%5D=3')
+        self.assertEqual(ThreeScalePY.ThreeScale.ENCODED_USAGES[(('hits', 3), int)], 'usage%5Bhits%5D=3')
+
+    def testEqualUsagesOfOtherTypes(self):
+        """test that equal usage values of different types are encoded apart"""
+        self.assertEqual(self.client.encode_usage({'hits': 1}), 'usage%5Bhits%5D=1')
+        self.assertEqual(self.client.encode_usage({'hits': 1.0}), 'usage%5Bhits%5D=1.0')
+        self.assertEqual(self.client.encode_usage({'hits': True}), 'usage%5Bhits%5D=True')
+
+def usage_status_xml(authorized, current_value, max_value, period_end="2999-01-01 00:00:00 +0000"):
+    reason = "" if authorized else "<reason>usage limits are exceeded</reason>"
+    return ("""<status><authorized>%s</authorized>%s<plan>Basic</plan><usage_reports>
+                <usage_report metric="hits" period="day">
+                  <period_start>2010-04-26 00:00:00 +0000</period_start>
+                  <period_end>%s</period_end>
+                  <current_value>%d</current_value>
+                  <max_value>%d</max_value>
+                </usage_report>
+              </usage_reports></status>""" % ('true' if authorized else 'false', reason,
+                                              period_end, current_value, max_value)).encode('utf-8')
+
+class TestThreeScaleQuotaLimiter(unittest.TestCase):
+    """test case for the client-side quota enforcement"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.limiter = ThreeScalePY.ThreeScaleQuotaLimiter(drift_threshold=0.1)
+        self.client = ThreeScalePY.ThreeScale(service_id='1', service_token='token',
+                                              backend_uri=self.backend.uri())
+        self.client.set_quota_limiter(self.limiter)
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def testRejectLocallyOverLimit(self):
+        """test that calls over a known limit are rejected without calling the backend"""
+        self.backend.responses['/transactions/authrep.xml'] = (409, usage_status_xml(False, 10, 10))
+        self.assertFalse(self.client.call_authrep(app_id='foo'))
+        result = self.client.call_authrep(app_id='foo')
+        self.assertFalse(result)
+        self.assertEqual(result.get_status(), 409)
+        self.assertEqual(result.get_response().get_reason(), "usage limits are exceeded")
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertEqual(self.limiter.rejected, 1)
+        # other applications are not affected
+        self.assertFalse(self.client.call_authrep(app_id='bar'))
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def testAllowedCallsGoToTheBackend(self):
+        """test that calls under the limits are still sent"""
+        self.backend.responses['/transactions/authrep.xml'] = (200, usage_status_xml(True, 1, 10))
+        self.assertTrue(self.client.call_authrep(app_id='foo'))
+        self.assertTrue(self.client.call_authrep(app_id='foo'))
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def testUsageValuesAreIntegers(self):
+        """test that string usage values are counted and invalid ones rejected"""
+        self.backend.responses['/transactions/authrep.xml'] = (200, usage_status_xml(True, 8, 10))
+        self.assertTrue(self.client.call_authrep(app_id='foo', usage={'hits': '1'}))
+        app = self.client.get_query_string(credentials={'app_id': 'foo'})
+        self.assertEqual(self.limiter.check(app, {'hits': '2'}), self.limiter.ALLOW)
+        self.assertEqual(self.limiter.check(app, {'hits': '3'}), self.limiter.REJECT)
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.limiter.check,
+                          app, {'hits': 'many'})
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.limiter.consume,
+                          app, {'hits': None})
+
+    def testCachedAuthorizationsConsumeLocally(self):
+        """test that cache hits count against the limit and force a resync on drift"""
+        self.client.set_auth_cache(ThreeScalePY.ThreeScaleAuthorizeCache())
+        self.backend.responses['/transactions/authorize.xml'] = (200, usage_status_xml(True, 7, 20))
+        for i in range(4):
+            self.assertTrue(self.client.call_authorize(app_id='foo'))
+        self.assertEqual(len(self.backend.requests), 1)
+        # 3 hits consumed locally, over 10% of 20: resync
+        self.assertTrue(self.client.call_authorize(app_id='foo'))
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def testResyncWhenPeriodEnds(self):
+        """test that limits whose period has ended are not enforced"""
+        self.backend.responses['/transactions/authrep.xml'] = (409,
+            usage_status_xml(False, 10, 10, period_end="2010-04-27 00:00:00 +0000"))
+        self.assertFalse(self.client.call_authrep(app_id='foo'))
+        self.assertFalse(self.client.call_authrep(app_id='foo'))
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def testResyncRejectedAfterTTL(self):
+        """test that applications rejected locally are synced again after reject_ttl"""
+        self.limiter.reject_ttl = 0.2
+        self.backend.responses['/transactions/authrep.xml'] = (409, usage_status_xml(False, 10, 10))
+        self.assertFalse(self.client.call_authrep(app_id='foo'))
+        self.assertFalse(self.client.call_authrep(app_id='foo'))
+        self.assertEqual(len(self.backend.requests), 1)
+        time.sleep(0.25)
+        self.backend.responses['/transactions/authrep.xml'] = (200, usage_status_xml(True, 0, 10))
+        self.assertTrue(self.client.call_authrep(app_id='foo'))
+        self.assertEqual(len(self.backend.requests), 2)
+
+class TestThreeScaleSingleFlight(unittest.TestCase):
+    """test case for coalescing concurrent identical authorize calls"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.backend.delay = 0.3
+        self.client = ThreeScalePY.ThreeScale(service_id='1', service_token='token',
+                                              backend_uri=self.backend.uri())
+        self.client.set_single_flight(ThreeScalePY.ThreeScaleSingleFlight())
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def run_threads(self, target, count=10):
+        results = []
+        def run(i):
+            try:
+                results.append(target(i))
+            except Exception as err:
+                results.append(err)
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def testIdenticalCallsAreCoalesced(self):
+        """test that one request is sent for concurrent identical authorizations"""
+        results = self.run_threads(lambda i: self.client.call_authorize(app_id='foo'))
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertTrue(all(result.is_success() for result in results))
+        self.assertEqual(self.client.single_flight.coalesced, 9)
+
+    def testDifferentCallsAreNotCoalesced(self):
+        """test that calls with different queries are all sent"""
+        self.run_threads(lambda i: self.client.call_authorize(app_id='foo%d' % (i % 2)))
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def testAuthRepIsNotCoalesced(self):
+        """test that authrep calls are all sent, since each one reports usage"""
+        self.run_threads(lambda i: self.client.call_authrep(app_id='foo'), 3)
+        self.assertEqual(len(self.backend.requests), 3)
+
+    def testErrorsAreShared(self):
+        """test that every waiter gets the exception of the call"""
+        self.backend.responses['/transactions/authorize.xml'] = (500, b"")
+        results = self.run_threads(lambda i: self.client.call_authorize(app_id='foo'))
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertTrue(all(isinstance(result, ThreeScalePY.ThreeScaleServerError) for result in results))
+
+    def testWaitersTimeOut(self):
+        """test that the waiters give up after the timeout of their call"""
+        single_flight = ThreeScalePY.ThreeScaleSingleFlight()
+        release = threading.Event()
+        leader = threading.Thread(target=single_flight.do, args=('key', release.wait))
+        leader.start()
+        while not single_flight.flights:
+            time.sleep(0.01)
+        start = time.time()
+        self.assertRaises(ThreeScalePY.ThreeScaleConnectionError,
+                          single_flight.do, 'key', lambda: True, 0.1)
+        self.assertTrue(time.time() - start < 1)
+        release.set()
+        leader.join()
+
+class TestThreeScaleCircuitBreaker(unittest.TestCase):
+    """test case for the circuit breaker in front of the backend calls"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.client = ThreeScalePY.ThreeScale(service_id='1', service_token='token',
+                                              backend_uri=self.backend.uri())
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def breaker(self, **kwargs):
+        breaker = ThreeScalePY.ThreeScaleCircuitBreaker(min_calls=3, window_size=3, **kwargs)
+        self.client.set_circuit_breaker(breaker)
+        return breaker
+
+    def testOpensOnErrors(self):
+        """test that the circuit opens on errors and then fails fast"""
+        breaker = self.breaker()
+        self.backend.responses['/transactions/authorize.xml'] = (500, b"")
+        for i in range(3):
+            self.assertRaises(ThreeScalePY.ThreeScaleServerError,
+                              self.client.call_authorize, app_id='foo')
+        self.assertEqual(breaker.get_state(), breaker.OPEN)
+        self.assertRaises(ThreeScalePY.ThreeScaleCircuitOpenError,
+                          self.client.call_authorize, app_id='foo')
+        self.assertEqual(len(self.backend.requests), 3)
+        self.assertEqual(breaker.rejected, 1)
+
+    def testOpensOnSlowCalls(self):
+        """test that calls slower than the threshold count as failures"""
+        breaker = self.breaker(slow_call_threshold=0.05)
+        self.backend.delay = 0.1
+        for i in range(3):
+            self.assertTrue(self.client.call_authorize(app_id='foo'))
+        self.assertEqual(breaker.get_state(), breaker.OPEN)
+
+    def testHalfOpenProbe(self):
+        """test that a probe closes the circuit, or opens it again"""
+        breaker = self.breaker(open_timeout=0.1)
+        breaker.trip()
+        time.sleep(0.15)
+        self.backend.responses['/transactions/authorize.xml'] = (500, b"")
+        self.assertRaises(ThreeScalePY.ThreeScaleServerError,
+                          self.client.call_authorize, app_id='foo')
+        self.assertEqual(breaker.get_state(), breaker.OPEN)
+        time.sleep(0.15)
+        del self.backend.responses['/transactions/authorize.xml']
+        self.assertTrue(self.client.call_authorize(app_id='foo'))
+        self.assertEqual(breaker.get_state(), breaker.CLOSED)
+        self.assertEqual(len(self.backend.requests), 2)
+
+    def testFailClosed(self):
+        """test that calls raise while the backend is down, by default"""
+        self.breaker()
+        self.backend.stop()
+        self.assertRaises(ThreeScalePY.ThreeScaleConnectionError,
+                          self.client.call_authrep, app_id='foo')
+
+    def testFailOpen(self):
+        """test that calls get the last known authorization while the backend is down"""
+        breaker = self.breaker(fail_open=True)
+        self.backend.responses['/transactions/authrep.xml'] = (409, usage_status_xml(False, 10, 10))
+        self.assertFalse(self.client.call_authrep(app_id='foo'))
+        self.backend.stop()
+        self.client.connection_pool.clear()
+        result = self.client.call_authrep(app_id='foo')
+        self.assertFalse(result)
+        self.assertEqual(result.get_status(), 409)
+        self.assertTrue(self.client.call_authrep(app_id='bar'))
+        self.assertTrue(self.client.call_authorize(app_id='bar'))
+        self.assertEqual(breaker.failed_open, 3)
+        self.assertRaises(ThreeScalePY.ThreeScaleConnectionError,
+                          self.client.call_report, [{'app_id': 'foo', 'usage': {'hits': 1}}])
+
+    def testFailOpenOnServerErrors(self):
+        """test that 5xx responses fail open like an unreachable backend"""
+        breaker = self.breaker(fail_open=True)
+        self.backend.responses['/transactions/authrep.xml'] = (503, b"")
+        self.backend.responses['/transactions/authorize.xml'] = (500, b"")
+        self.assertTrue(self.client.call_authrep(app_id='foo'))
+        self.assertTrue(self.client.call_authorize(app_id='foo'))
+        self.assertEqual(breaker.failed_open, 2)
+        self.backend.responses['/transactions/authorize.xml'] = (400, b"")
+        self.assertRaises(ThreeScalePY.ThreeScaleServerError, self.client.call_authorize, app_id='foo')
+        if ThreeScaleAsync is None:
+            return
+        authrep = ThreeScaleAsync.ThreeScaleAsyncAuthRep(app_id='foo', service_id='1', service_token='token',
+                                                         backend_uri=self.backend.uri())
+        authrep.set_circuit_breaker(ThreeScalePY.ThreeScaleCircuitBreaker(fail_open=True))
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertTrue(loop.run_until_complete(authrep.authrep_async()).is_authorized())
+        finally:
+            loop.close()
+
+    def testAsyncFailOpen(self):
+        """test that the asyncio calls go through the circuit breaker"""
+        if ThreeScaleAsync is None:
+            self.skipTest("asyncio is not available")
+        breaker = ThreeScalePY.ThreeScaleCircuitBreaker(fail_open=True)
+        breaker.trip()
+        authrep = ThreeScaleAsync.ThreeScaleAsyncAuthRep(app_id='foo', service_id='1', service_token='token',
+                                                         backend_uri=self.backend.uri())
+        authrep.set_circuit_breaker(breaker)
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertTrue(loop.run_until_complete(authrep.authrep_async()).is_authorized())
+        finally:
+            loop.close()
+        self.assertEqual(len(self.backend.requests), 0)
+        self.assertEqual(breaker.rejected, 1)
+
+class TestThreeScaleHedger(unittest.TestCase):
+    """test case for hedged authorize and authrep calls"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.hedger = ThreeScalePY.ThreeScaleHedger(delay=0.05)
+        self.client = ThreeScalePY.ThreeScale(service_id='1', service_token='token',
+                                              backend_uri=self.backend.uri())
+        self.client.set_hedger(self.hedger)
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def testFastCallIsNotHedged(self):
+        """test that a call answered before the delay is sent once"""
+        self.assertTrue(self.client.call_authorize(app_id='foo'))
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertEqual((self.hedger.calls, self.hedger.fired, self.hedger.won), (1, 0, 0))
+
+    def testSlowCallIsHedged(self):
+        """test that the hedge answers a slow call"""
+        self.backend.delays = [1.0, 0]
+        start = time.time()
+        self.assertTrue(self.client.call_authorize(app_id='foo'))
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(len(self.backend.requests), 2)
+        self.assertEqual((self.hedger.fired, self.hedger.won), (1, 1))
+
+    def reports(self, count, timeout=2):
+        """wait for count reports to reach the backend and return them"""
+        deadline = time.time() + timeout
+        while True:
+            reports = [req[3] for req in self.backend.requests if req[0] == 'POST']
+            if len(reports) >= count or time.time() > deadline:
+                return reports
+            time.sleep(0.01)
+
+    def testWorkersAreReused(self):
+        """test that consecutive calls run on the same worker thread"""
+        threads = set()
+        for i in range(5):
+            threads.add(self.hedger.do(threading.current_thread))
+            time.sleep(0.01)
+        self.assertEqual(len(threads), 1)
+        self.assertFalse(threading.current_thread() in threads)
+
+    def testIdleWorkersExit(self):
+        """test that the workers started by a burst of calls exit once idle"""
+        self.hedger.idle_timeout = 0.1
+        barrier = threading.Event()
+        for i in range(5):
+            self.hedger.submit(barrier.wait)
+        self.assertEqual(self.hedger.workers, 5)
+        barrier.set()
+        time.sleep(0.5)
+        self.assertEqual((self.hedger.workers, self.hedger.idle), (0, 0))
+        self.assertEqual(self.hedger.do(lambda: 42), 42)
+        self.assertEqual(self.hedger.workers, 1)
+
+    def testAuthRepIsSplit(self):
+        """test that a hedged authrep authorizes and then reports the usage once"""
+        self.backend.delays = [1.0, 0]
+        result = self.client.call_authrep(app_id='foo', usage={'hits': 2},
+                                          other_params={'timestamp': '2010-04-26 00:00:00 +0000'},
+                                          log={'code': 200})
+        self.assertTrue(result)
+        self.assertEqual(result.call, 'authrep')
+        report = parse_qs(self.reports(1)[0].decode('utf-8'))
+        paths = sorted(req[1].split('?', 1)[0] for req in self.backend.requests)
+        self.assertEqual(paths, ['/transactions.xml',
+                                 '/transactions/authorize.xml', '/transactions/authorize.xml'])
+        self.assertEqual(report['transactions[0][app_id]'], ['foo'])
+        self.assertEqual(report['transactions[0][usage][hits]'], ['2'])
+        self.assertEqual(report['transactions[0][log][code]'], ['200'])
+        self.assertTrue(report['transactions[0][timestamp]'][0].startswith('2010-04-26 00:00:00'))
+
+    def testReportErrorIsNotRaised(self):
+        """test that a failed report does not fail the authorized authrep"""
+        self.backend.responses['/transactions.xml'] = (403, b"<error>service token is invalid</error>")
+        self.assertTrue(self.client.call_authrep(app_id='foo'))
+        self.reports(1)
+        deadline = time.time() + 2
+        while not self.hedger.failed and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.hedger.failed, 1)
+
+    def testRejectedAuthRepIsNotReported(self):
+        """test that nothing is reported when the authorization fails"""
+        self.backend.responses['/transactions/authorize.xml'] = (409, usage_status_xml(False, 10, 10))
+        self.assertFalse(self.client.call_authrep(app_id='foo'))
+        self.assertEqual([req[0] for req in self.backend.requests], ['GET'])
+
+    def testDelayFollowsLatencies(self):
+        """test that the delay is a percentile of the recorded latencies"""
+        hedger = ThreeScalePY.ThreeScaleHedger(percentile=90, min_samples=10)
+        for i in range(100):
+            hedger.record(i / 1000.0)
+        self.assertAlmostEqual(hedger.get_delay(), 0.09)
+
+class TestThreeScaleBackendBalancer(unittest.TestCase):
+    """test case for spreading the calls over several backends"""
+
+    def setUp(self):
+        self.backends = [FakeBackend(), FakeBackend()]
+        self.uris = [backend.uri() for backend in self.backends]
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.stop()
+
+    def client(self, **kwargs):
+        client = ThreeScalePY.ThreeScale(service_id='1', service_token='token', backend_uri=self.uris)
+        balancer = ThreeScalePY.ThreeScaleBackendBalancer(self.uris, **kwargs)
+        client.set_backend_balancer(balancer)
+        return client, balancer
+
+    def testBaseUrlIsThePrimary(self):
+        """test that a list of URIs is accepted and the first one is the base url"""
+        client = ThreeScalePY.ThreeScale(service_id='1', service_token='token', backend_uri=self.uris)
+        self.assertEqual(client.get_base_url(), self.uris[0])
+        other = ThreeScalePY.ThreeScale(service_id='1', service_token='token', backend_uri=self.uris)
+        self.assertTrue(client.backend_balancer is other.backend_balancer)
+        self.assertRaises(ThreeScalePY.ThreeScaleException, ThreeScalePY.ThreeScale,
+                          service_id='1', service_token='token', backend_uri=[self.uris[0], 'foo'])
+
+    def testLeastOutstanding(self):
+        """test that concurrent calls are spread over the backends"""
+        client, balancer = self.client()
+        for backend in self.backends:
+            backend.delay = 0.2
+        threads = [threading.Thread(target=client.call_authorize, kwargs={'app_id': 'foo'})
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([len(backend.requests) for backend in self.backends], [5, 5])
+
+    def testEwma(self):
+        """test that the fastest endpoint is preferred"""
+        balancer = ThreeScalePY.ThreeScaleBackendBalancer(self.uris, strategy='ewma')
+        slow, fast = balancer.endpoints
+        balancer.release(balancer.acquire(), True, 0.5)
+        balancer.release(balancer.acquire(), True, 0.01)
+        self.assertTrue(balancer.acquire() is fast)
+        # weighted by the requests in flight
+        fast.outstanding = 100
+        self.assertTrue(balancer.acquire() is slow)
+
+    def testFailingEndpointIsEjectedAndProbed(self):
+        """test that a failing endpoint gets no calls until a probe succeeds"""
+        client, balancer = self.client(max_failures=1, probe_interval=0.2)
+        self.backends[1].responses['/transactions/authorize.xml'] = (500, b"")
+        for i in range(6):
+            try:
+                client.call_authorize(app_id='foo')
+            except ThreeScalePY.ThreeScaleServerError:
+                pass
+        self.assertEqual(balancer.get_healthy_uris(), self.uris[:1])
+        self.assertEqual(len(self.backends[1].requests), 1)
+        self.assertEqual(balancer.ejections, 1)
+
+        time.sleep(0.25)
+        client.call_authorize(app_id='foo')
+        time.sleep(0.1)
+        self.assertEqual(self.backends[1].requests[-1][1], '/status')
+        self.assertEqual(balancer.get_healthy_uris(), self.uris)
+
+class TestThreeScaleSpoolReporter(unittest.TestCase):
+    """test case for the on-disk report spool"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.spool_dir = tempfile.mkdtemp()
+        self.reporters = []
+
+    def tearDown(self):
+        for reporter in self.reporters:
+            reporter.close(1)
+        self.backend.stop()
+        shutil.rmtree(self.spool_dir)
+
+    def reporter(self, **kwargs):
+        reporter = ThreeScalePY.ThreeScaleSpoolReporter(service_id='1', service_token='token',
+                                                        backend_uri=self.backend.uri(),
+                                                        spool_dir=self.spool_dir,
+                                                        retry_interval=0.05, **kwargs)
+        self.reporters.append(reporter)
+        return reporter
+
+    def reports(self):
+        return [req[3] for req in self.backend.requests if req[1] == '/transactions.xml']
+
+    def testBatches(self):
+        """test that spooled transactions are reported in batches of 1000"""
+        reporter = self.reporter()
+        for i in range(2500):
+            self.assertTrue(reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}}))
+        reporter.flush(5)
+        self.assertEqual(reporter.reported, 2500)
+        counts = [body.count(b'[app_id]=foo') for body in self.reports()]
+        self.assertEqual(sum(counts), 2500)
+        self.assertTrue(max(counts) <= 1000)
+        fields = parse_qs(self.reports()[0].decode('utf-8'))
+        self.assertEqual(fields['service_token'], ['token'])
+        self.assertEqual(fields['service_id'], ['1'])
+        self.assertEqual(fields['transactions[0][app_id]'], ['foo'])
+        self.assertEqual(fields['transactions[0][usage][hits]'], ['1'])
+        self.assertTrue('transactions[0][timestamp]' in fields)
+
+    def testBackendOutage(self):
+        """test that transactions are kept until the backend is back"""
+        self.backend.responses['/transactions.xml'] = (503, b"")
+        reporter = self.reporter()
+        for i in range(5):
+            reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}})
+        time.sleep(0.2)
+        self.assertEqual(reporter.reported, 0)
+        self.assertTrue(len(self.reports()) > 1)
+        del self.backend.responses['/transactions.xml']
+        reporter.flush(5)
+        self.assertEqual(reporter.reported, 5)
+        self.assertEqual(self.reports()[-1].count(b'[app_id]=foo'), 5)
+
+    def testRestart(self):
+        """test that a new reporter reports what the previous one could not"""
+        self.backend.responses['/transactions.xml'] = (503, b"")
+        reporter = self.reporter(segment_size=512)
+        for i in range(20):
+            reporter.enqueue({'app_id': 'foo%d' % i, 'usage': {'hits': 1}})
+        reporter.close(0.1)
+        self.assertTrue(len(os.listdir(self.spool_dir)) > 2)
+
+        del self.backend.responses['/transactions.xml']
+        reporter = self.reporter(segment_size=512)
+        reporter.flush(5)
+        self.assertEqual(reporter.reported, 20)
+        reported = b''.join(self.reports()[-20:])
+        self.assertTrue(all(b'=foo%d&' % i in reported for i in range(20)))
+        self.assertEqual(len([name for name in os.listdir(self.spool_dir) if name.endswith('.seg')]), 1)
+
+    def testTornRecord(self):
+        """test that a record with an invalid checksum is not reported"""
+        self.backend.responses['/transactions.xml'] = (503, b"")
+        reporter = self.reporter()
+        for i in range(3):
+            reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}})
+        reporter.close(0.1)
+        path = os.path.join(self.spool_dir, sorted(os.listdir(self.spool_dir))[0])
+        with open(path, 'r+b') as segment:
+            data = segment.read(reporter.write_offset)
+            segment.seek(len(data) - 1)
+            segment.write(b'X')
+
+        del self.backend.responses['/transactions.xml']
+        reporter = self.reporter()
+        reporter.flush(5)
+        self.assertEqual(reporter.reported, 2)
+
+    def testFullSpool(self):
+        """test that transactions are dropped when the spool is full"""
+        self.backend.responses['/transactions.xml'] = (503, b"")
+        reporter = self.reporter(segment_size=512, max_segments=2)
+        results = [reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}}) for i in range(50)]
+        self.assertFalse(all(results))
+        self.assertEqual(reporter.dropped, results.count(False))
+
+    def testInvalidBatchIsDropped(self):
+        """test that a batch rejected by the backend is not sent again"""
+        self.backend.responses['/transactions.xml'] = (400, b"")
+        errors = []
+        reporter = self.reporter(on_error=lambda err, count: errors.append(count))
+        reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}})
+        reporter.flush(5)
+        self.assertEqual(errors, [1])
+        self.assertEqual(reporter.failed, 1)
+        self.assertEqual(len(self.reports()), 1)
+
+    def testRaisingErrorCallback(self):
+        """test that an on_error callback which raises does not stop the reporter"""
+        self.backend.responses['/transactions.xml'] = (400, b"")
+        def on_error(err, count):
+            raise ValueError("callback error")
+        reporter = self.reporter(on_error=on_error)
+        reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}})
+        reporter.flush(5)
+        del self.backend.responses['/transactions.xml']
+        reporter.enqueue({'app_id': 'foo', 'usage': {'hits': 1}})
+        reporter.flush(5)
+        self.assertEqual(reporter.failed, 1)
+        self.assertEqual(reporter.reported, 1)
+        self.assertTrue(reporter.thread.is_alive())
+
+class TestThreeScaleUsageAggregator(unittest.TestCase):
+    """test case for the aggregation of usage before reporting"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.reporter = ThreeScalePY.ThreeScaleReport(service_id='1', service_token='token',
+                                                      backend_uri=self.backend.uri())
+        self.aggregators = []
+
+    def tearDown(self):
+        for aggregator in self.aggregators:
+            aggregator.close(1)
+        self.backend.stop()
+
+    def aggregator(self, reporter=None, **kwargs):
+        aggregator = ThreeScalePY.ThreeScaleUsageAggregator(reporter or self.reporter, **kwargs)
+        self.aggregators.append(aggregator)
+        return aggregator
+
+    def testUsageIsMerged(self):
+        """test that the usage of an application is summed per metric"""
+        aggregator = self.aggregator(bucket_size=3600)
+        def add():
+            for i in range(250):
+                aggregator.add({'app_id': 'foo', 'usage': {'hits': 1}})
+        threads = [threading.Thread(target=add) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        aggregator.add({'user_key': 'bar', 'usage': {'hits': 2, 'search': 1}})
+        aggregator.add({'user_key': 'bar', 'usage': {'search': '3'}})
+        self.assertEqual(len(aggregator), 2)
+
+        transactions = sorted(aggregator.collect(True), key=lambda t: 'app_id' in t)
+        self.assertEqual(transactions[0]['user_key'], 'bar')
+        self.assertEqual(transactions[0]['usage'], {'hits': 2, 'search': 4})
+        self.assertEqual(transactions[1]['app_id'], 'foo')
+        self.assertEqual(transactions[1]['usage'], {'hits': 1000})
+        self.assertEqual(len(aggregator), 0)
+
+    def testFlush(self):
+        """test that the merged transactions are reported in a single call"""
+        aggregator = self.aggregator(bucket_size=3600)
+        for i in range(100):
+            aggregator.add({'app_id': 'foo', 'usage': {'hits': 1}, 'log': {'code': i}})
+        aggregator.flush()
+        self.assertEqual(len(self.backend.requests), 1)
+        body = self.backend.requests[0][3]
+        self.assertTrue(b'&transactions[0][usage][hits]=100' in body)
+        self.assertFalse(b'transactions[1]' in body)
+        self.assertFalse(b'[log]' in body)
+        self.assertEqual(aggregator.emitted, 1)
+
+    def testBuckets(self):
+        """test that the usage of different buckets is not merged"""
+        aggregator = self.aggregator(bucket_size=60, keep_log=True)
+        aggregator.add({'app_id': 'foo', 'usage': {'hits': 1}, 'timestamp': time.gmtime(60)})
+        aggregator.add({'app_id': 'foo', 'usage': {'hits': 1}, 'timestamp': time.gmtime(119),
+                        'log': {'code': 200}})
+        aggregator.add({'app_id': 'foo', 'usage': {'hits': 1}, 'timestamp': time.gmtime(120)})
+        transactions = sorted(aggregator.collect(), key=lambda t: calendar.timegm(t['timestamp']))
+        self.assertEqual([t['usage']['hits'] for t in transactions], [2, 1])
+        self.assertEqual([t['timestamp'] for t in transactions], [time.gmtime(60), time.gmtime(120)])
+        self.assertEqual(transactions[0]['log'], {'code': 200})
+
+    def testTimestampsInAnyTimezone(self):
+        """test that the buckets do not depend on the local timezone"""
+        if not hasattr(time, 'tzset'):
+            self.skipTest("time.tzset() is not available")
+        tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'Europe/Madrid'
+        time.tzset()
+        try:
+            aggregator = self.aggregator(bucket_size=60)
+            aggregator.add({'app_id': 'foo', 'usage': {'hits': 1}, 'timestamp': time.gmtime(1000000400)})
+            transactions = aggregator.collect(True)
+        finally:
+            if tz is None:
+                del os.environ['TZ']
+            else:
+                os.environ['TZ'] = tz
+            time.tzset()
+        self.assertEqual(transactions[0]['timestamp'], time.gmtime(1000000380))
+
+    def testServices(self):
+        """test that a reporter only gets the transactions of its service"""
+        aggregator = self.aggregator(bucket_size=3600)
+        aggregator.add({'app_id': 'foo', 'service_id': '1', 'usage': {'hits': 1}})
+        aggregator.add({'app_id': 'foo', 'usage': {'hits': 1}})
+        self.assertRaises(ThreeScalePY.ThreeScaleException, aggregator.add,
+                          {'app_id': 'foo', 'service_id': '2', 'usage': {'hits': 1}})
+        transactions = aggregator.collect(True)
+        self.assertEqual(len(transactions), 1)
+        self.assertEqual(transactions[0]['usage'], {'hits': 2})
+        self.assertFalse('service_id' in transactions[0])
+
+        multi = ThreeScalePY.ThreeScaleMultiServiceReporter(service_tokens={'1': 'a', '2': 'b'},
+                                                            backend_uri=self.backend.uri())
+        aggregator = self.aggregator(multi, bucket_size=3600)
+        aggregator.add({'app_id': 'foo', 'service_id': '1', 'usage': {'hits': 1}})
+        aggregator.add({'app_id': 'foo', 'service_id': '2', 'usage': {'hits': 1}})
+        aggregator.flush()
+        self.assertEqual(len(self.backend.requests), 2)
+        self.assertEqual(sorted(parse_qs(request[3].decode('utf-8'))['service_id'][0]
+                                for request in self.backend.requests), ['1', '2'])
+
+    def testFailures(self):
+        """test that the transactions that can not be reported are counted"""
+        class Reporter(object):
+            def enqueue(self, transaction):
+                raise ThreeScalePY.ThreeScaleException("full")
+        failures = []
+        aggregator = self.aggregator(Reporter(), bucket_size=3600,
+                                     on_error=lambda err, transactions: failures.append(transactions))
+        aggregator.add({'app_id': 'foo', 'usage': {'hits': 1}})
+        aggregator.add({'app_id': 'bar', 'usage': {'hits': 1}})
+        aggregator.flush()
+        self.assertEqual(aggregator.failed, 2)
+        self.assertEqual(len(failures), 2)
+
+        aggregator = self.aggregator(Reporter(), bucket_size=3600)
+        aggregator.add({'app_id': 'foo', 'usage': {'hits': 1}})
+        self.assertRaises(ThreeScalePY.ThreeScaleException, aggregator.flush)
+        self.assertEqual(aggregator.failed, 1)
+
+    def testBackgroundFlush(self):
+        """test that the past buckets are reported in the background"""
+        queued = []
+        class Reporter(object):
+            def enqueue(self, transaction):
+                queued.append(transaction)
+        aggregator = self.aggregator(Reporter(), bucket_size=0.1)
+        aggregator.add({'app_id': 'foo', 'usage': {'hits': 1}})
+        aggregator.add({'app_id': 'foo', 'usage': {'hits': 1}})
+        time.sleep(0.35)
+        self.assertEqual(len(queued), 1)
+        self.assertEqual(queued[0]['usage'], {'hits': 2})
+
+    def testInvalidTransaction(self):
+        """test that invalid transactions are rejected when added"""
+        aggregator = self.aggregator()
+        self.assertRaises(ThreeScalePY.ThreeScaleException, aggregator.add, {'usage': {'hits': 1}})
+        self.assertRaises(ThreeScalePY.ThreeScaleException, aggregator.add,
+                          {'app_id': 'foo', 'usage': {'hits': 'a'}})
+        self.assertRaises(ThreeScalePY.ThreeScaleException, aggregator.add, 'foo')
+
+class TestThreeScaleMultiServiceReporter(unittest.TestCase):
+    """test case for reporting the transactions of several services"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.reporter = ThreeScalePY.ThreeScaleMultiServiceReporter(
+            service_tokens={'1': 'token1', '2': 'token2'}, backend_uri=self.backend.uri())
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def testPartitions(self):
+        """test that transactions are sent per service, in batches of 1000"""
+        transactions = [{'service_id': str(i % 3 and 1 or 2), 'app_id': 'foo', 'usage': {'hits': 1}}
+                        for i in range(3000)]
+        results = self.reporter.report(transactions)
+        self.assertEqual([(result.get_service_id(), len(result.get_transactions())) for result in results],
+                         [('2', 1000), ('1', 1000), ('1', 1000)])
+        self.assertTrue(all(results))
+        bodies = [req[3] for req in self.backend.requests]
+        self.assertEqual(len(bodies), 3)
+        self.assertEqual(len([body for body in bodies if body.startswith(b'service_token=token1&service_id=1&')]), 2)
+        self.assertFalse(any(b'[service_id]' in body for body in bodies))
+
+    def testParallel(self):
+        """test that the batches are sent in parallel"""
+        self.backend.delay = 0.2
+        transactions = [{'service_id': '1', 'app_id': 'foo', 'usage': {'hits': 1}}] * 4
+        self.reporter.batch_size = 1
+        start = time.time()
+        self.assertTrue(all(self.reporter.report(transactions)))
+        self.assertTrue(time.time() - start < 0.6)
+        self.assertEqual(len(self.backend.requests), 4)
+
+    def testErrors(self):
+        """test that the error of a batch is returned in its result"""
+        self.backend.responses['/transactions.xml'] = (403, b"<error>forbidden</error>")
+        results = self.reporter.report([{'service_id': '1', 'app_id': 'foo', 'usage': {'hits': 1}}])
+        self.assertFalse(results[0])
+        self.assertTrue(isinstance(results[0].get_error(), ThreeScalePY.ThreeScaleServerError))
+
+    def testInvalidTransactions(self):
+        """test that nothing is sent if a transaction can not be reported"""
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.reporter.report,
+                          [{'service_id': '1', 'app_id': 'foo'}, {'app_id': 'foo'}])
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.reporter.report,
+                          [{'service_id': '3', 'app_id': 'foo'}])
+        self.assertEqual(len(self.backend.requests), 0)
+
+class TestThreeScaleSharedAuthorizeCache(unittest.TestCase):
+    """test case for the authorization cache in shared memory"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        self.backend.stop()
+        shutil.rmtree(self.tmp_dir)
+
+    def cache(self, **kwargs):
+        cache = ThreeScalePY.ThreeScaleSharedAuthorizeCache(**kwargs)
+        self.caches.append(cache)
+        return cache
+
+    def client(self, cache):
+        auth = ThreeScalePY.ThreeScaleAuthorize(app_id='foo', service_id='1', service_token='token',
+                                                backend_uri=self.backend.uri())
+        auth.set_auth_cache(cache)
+        return auth
+
+    def testCachedAuthorize(self):
+        """test that a cached authorization does not call the backend again"""
+        cache = self.cache()
+        self.assertTrue(self.client(cache).authorize())
+        auth = self.client(cache)
+        self.assertTrue(auth.authorize())
+        self.assertEqual(auth.build_auth_response().get_plan(), "Basic")
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def testSharedByPath(self):
+        """test that the caches opened on the same file share their entries"""
+        path = os.path.join(self.tmp_dir, 'cache')
+        self.assertTrue(self.client(self.cache(path=path)).authorize())
+        self.assertTrue(self.client(self.cache(path=path)).authorize())
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertRaises(ThreeScalePY.ThreeScaleException, self.cache, path=path, slots=10)
+
+    def testSharedWithForkedProcesses(self):
+        """test that an entry stored by a forked worker is seen by the others"""
+        if not hasattr(os, 'fork'):
+            self.skipTest("fork is not available")
+        cache = self.cache()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                cache.set('key', AUTHORIZED_XML, ThreeScalePY.ThreeScaleAuthorizeResponse.parse(AUTHORIZED_XML))
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(cache.get('key')[0], AUTHORIZED_XML)
+
+    def testEviction(self):
+        """test that the entry that expires first is evicted"""
+        cache = self.cache(slots=2)
+        response = ThreeScalePY.ThreeScaleAuthorizeResponse.parse(AUTHORIZED_XML)
+        for i in range(3):
+            cache.ttl = 60 + i
+            cache.set('key%d' % i, AUTHORIZED_XML, response)
+        self.assertEqual(cache.get('key0'), None)
+        self.assertEqual(cache.get('key1')[0], AUTHORIZED_XML)
+        self.assertEqual(cache.get('key2')[0], AUTHORIZED_XML)
+
+    def testExpiry(self):
+        """test that expired and oversized entries are not returned"""
+        cache = self.cache(ttl=0.1, slot_size=128)
+        response = ThreeScalePY.ThreeScaleAuthorizeResponse.parse(AUTHORIZED_XML)
+        cache.set('key', AUTHORIZED_XML, response)
+        self.assertTrue(cache.get('key'))
+        time.sleep(0.15)
+        self.assertEqual(cache.get('key'), None)
+        cache.set('large', AUTHORIZED_XML * 3, response)
+        self.assertEqual(cache.get('large'), None)
+
+    def testExtensionHeaders(self):
+        """test that the limits of the headers are shared with the body"""
+        headers = {'3scale-limit-remaining': '7', '3scale-limit-reset': '42'}
+        self.backend.responses['/transactions/authorize.xml'] = (200, b'', headers)
+        cache = self.cache()
+        auth = self.client(cache)
+        auth.set_backend_options(no_body=True, limit_headers=True)
+        self.assertTrue(auth.authorize())
+        other = self.client(cache)
+        other.set_backend_options(no_body=True, limit_headers=True)
+        result = other.call_authorize()
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertEqual(result.get_headers(), headers)
+        self.assertEqual(result.get_response().get_limit_remaining(), 7)
+        self.assertEqual(cache.get('missing'), None)
+
+    def testInterruptedWrite(self):
+        """test that a slot left half written by a killed process is readable once written again"""
+        cache = self.cache()
+        response = ThreeScalePY.ThreeScaleAuthorizeResponse.parse(AUTHORIZED_XML)
+        cache.set('key', AUTHORIZED_XML, response)
+        digest = hashlib.sha1(b'key').digest()
+        for offset in cache.get_offsets(digest):
+            version, slot_digest = cache.SLOT_HEADER.unpack_from(cache.mm, offset)[:2]
+            if slot_digest == digest:
+                # killed after marking the slot as being written
+                cache.VERSION.pack_into(cache.mm, offset, version + 1)
+        self.assertEqual(cache.get('key'), None)
+        cache.set('key', AUTHORIZED_XML, response)
+        self.assertEqual(cache.get('key')[0], AUTHORIZED_XML)
+
+class ListReporter(object):
+    """reporter keeping the enqueued transactions"""
+
+    def __init__(self):
+        self.transactions = []
+
+    def enqueue(self, transaction):
+        self.transactions.append(transaction)
+
+    def close(self):
+        pass
+
+class TestThreeScaleMiddleware(unittest.TestCase):
+    """test case for the WSGI and ASGI middlewares"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.client = ThreeScalePY.ThreeScale(service_id='1', service_token='token',
+                                              backend_uri=self.backend.uri())
+        self.reporter = ListReporter()
+        self.timings = []
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def wsgi_app(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'hello']
+
+    def call(self, middleware, query_string='', **headers):
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/', 'QUERY_STRING': query_string}
+        environ.update(headers)
+        response = {}
+        def start_response(status, headers):
+            response['status'] = status
+        response['body'] = b''.join(middleware(environ, start_response))
+        return response['status'], response['body'], environ
+
+    def middleware(self, **kwargs):
+        return ThreeScalePY.ThreeScaleWSGIMiddleware(self.wsgi_app, self.client, reporter=self.reporter,
+                                                     on_timing=lambda request, timing: self.timings.append(timing),
+                                                     **kwargs)
+
+    def testAuthorized(self):
+        """test that authorized requests reach the application and their usage is queued"""
+        middleware = self.middleware()
+        for i in range(3):
+            status, body, environ = self.call(middleware, 'app_id=foo&app_key=bar')
+            self.assertEqual((status, body), ('200 OK', b'hello'))
+        self.assertEqual(len(self.backend.requests), 1)
+        self.assertTrue('app_key=bar' in self.backend.requests[0][1])
+        self.assertEqual(self.reporter.transactions, [{'app_id': 'foo', 'usage': {'hits': 1}}] * 3)
+        self.assertTrue(environ['threescale.result'])
+        self.assertEqual(sorted(self.timings[-1]), ['app', 'authorize'])
+
+    def testRejections(self):
+        """test that failed authorizations are mapped to 403 and 429"""
+        middleware = self.middleware()
+        self.assertEqual(self.call(middleware)[:2], ('403 Forbidden', b'missing credentials'))
+        self.backend.responses['/transactions/authorize.xml'] = (409, usage_status_xml(False, 10, 10))
+        self.assertEqual(self.call(middleware, 'user_key=foo')[:2],
+                         ('429 Too Many Requests', b'usage limits are exceeded'))
+        self.backend.responses['/transactions/authorize.xml'] = (409,
+            b"<status><authorized>false</authorized><reason>application key is invalid</reason></status>")
+        self.assertEqual(self.call(middleware, 'user_key=foo')[0], '403 Forbidden')
+        self.backend.responses['/transactions/authorize.xml'] = (500, b"")
+        self.assertEqual(self.call(middleware, 'user_key=foo')[0], '503 Service Unavailable')
+        self.assertEqual(self.reporter.transactions, [])
+        self.assertEqual(len(self.timings), 4)
+
+    def testExtraction(self):
+        """test the credentials headers and the pluggable extraction and mapping"""
+        middleware = self.middleware(map_usage=lambda environ: {'hits': 1, environ['PATH_INFO'][1:] or 'root': 2})
+        self.assertEqual(self.call(middleware, HTTP_X_USER_KEY='foo')[0], '200 OK')
+        self.assertEqual(self.reporter.transactions, [{'user_key': 'foo', 'usage': {'hits': 1, 'root': 2}}])
+        middleware = self.middleware(extract_credentials=lambda environ: {'app_id': environ['REMOTE_USER']})
+        self.assertEqual(self.call(middleware, REMOTE_USER='bar')[0], '200 OK')
+        self.assertEqual(self.reporter.transactions[-1]['app_id'], 'bar')
+
+    def testDroppedUsage(self):
+        """test that the usage the reporter does not take is counted"""
+        reporter = ThreeScalePY.ThreeScaleBatchReporter(service_id='1', service_token='token',
+                                                        backend_uri=self.backend.uri())
+        reporter.close()
+        middleware = self.middleware()
+        middleware.reporter = reporter
+        self.assertEqual(self.call(middleware, 'app_id=foo')[0], '200 OK')
+        self.assertEqual(self.call(middleware, 'app_id=foo')[0], '200 OK')
+        self.assertEqual(middleware.dropped, 2)
+
+    def testASGI(self):
+        """test that the ASGI middleware authorizes the http requests"""
+        if ThreeScaleAsync is None:
+            self.skipTest("asyncio is not available")
+        client = ThreeScaleAsync.ThreeScaleAsyncAuthorize(service_id='1', service_token='token',
+                                                          backend_uri=self.backend.uri())
+        middleware = ThreeScaleAsync.ThreeScaleASGIMiddleware(asgi_app.app, client, reporter=self.reporter)
+        call = lambda scope: asgi_app.call(middleware, scope)
+
+        scope = {'type': 'http', 'path': '/', 'query_string': b'', 'headers': [(b'x-app-id', b'foo')]}
+        self.assertEqual(call(scope), (200, AUTHORIZED_XML))
+        self.assertEqual(call(dict(scope, headers=[])), (403, b'missing credentials'))
+        self.assertEqual(self.reporter.transactions, [{'app_id': 'foo', 'usage': {'hits': 1}}])
+
+class TestThreeScaleBulkAuthorize(unittest.TestCase):
+    """test case for authorizing many applications at once"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.client = ThreeScalePY.ThreeScale(service_id='1', service_token='token',
+                                              backend_uri=self.backend.uri())
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def testConcurrency(self):
+        """test that the calls are made concurrently and all the results are streamed"""
+        self.backend.delay = 0.05
+        credentials = ({'app_id': 'app%d' % i} for i in range(40))
+        start = time.time()
+        results = list(self.client.bulk_authorize(credentials, concurrency=10))
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertEqual(sorted(item['app_id'] for item, response in results),
+                         sorted('app%d' % i for i in range(40)))
+        self.assertTrue(all(response.is_authorized() for item, response in results))
+        self.assertEqual(len(self.backend.requests), 40)
+
+    def testFailures(self):
+        """test that rejections and errors are returned per credentials"""
+        self.backend.responses['/transactions/authorize.xml'] = (409, usage_status_xml(False, 10, 10))
+        results = dict((item.get('user_key'), response) for item, response in
+                       self.client.bulk_authorize([{'user_key': 'foo'}, {}], concurrency=2))
+        self.assertFalse(results['foo'].is_authorized())
+        self.assertEqual(results['foo'].get_reason(), "usage limits are exceeded")
+        self.assertTrue(isinstance(results[None], ThreeScalePY.ThreeScaleException))
+
+class ListCollector(ThreeScalePY.ThreeScaleCollector):
+    """collector keeping the metrics of the calls"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def collect(self, metrics):
+        self.metrics.append(metrics)
+
+class TestThreeScaleCollector(unittest.TestCase):
+    """test case for the instrumentation of the calls"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.client = ThreeScalePY.ThreeScale(service_id='1', service_token='token',
+                                              backend_uri=self.backend.uri())
+        self.client.set_connection_pool(ThreeScalePY.ThreeScaleConnectionPool())
+        self.collector = ListCollector()
+        self.client.set_collector(self.collector)
+
+    def tearDown(self):
+        self.backend.stop()
+        self.client.connection_pool.clear()
+
+    def testPhases(self):
+        """test that the phases of a call are recorded"""
+        result = self.client.call_authorize(app_id='foo')
+        self.assertTrue(result.success)
+        metrics = self.collector.metrics[0]
+        self.assertEqual((metrics.call, metrics.status, metrics.success), ('authorize', 200, True))
+        self.assertEqual(sorted(metrics.phases), ['body', 'connect', 'dns', 'ttfb'])
+        self.assertFalse(metrics.reused)
+        self.assertEqual(metrics.response_bytes, len(result.body))
+        self.assertTrue(metrics.duration >= sum(metrics.phases.values()) - 0.001)
+        self.assertTrue(result.response is None)
+
+        self.client.call_report([{'app_id': 'foo', 'usage': {'hits': 1}}])
+        metrics = self.collector.metrics[1]
+        self.assertEqual(metrics.call, 'report')
+        self.assertTrue(metrics.reused)
+        self.assertEqual(sorted(metrics.phases), ['body', 'ttfb'])
+        self.assertTrue(metrics.request_bytes > 0)
+
+    def testCacheAndErrors(self):
+        """test that the cache outcome and the errors are recorded"""
+        self.client.set_auth_cache(ThreeScalePY.ThreeScaleAuthorizeCache())
+        self.client.call_authorize(app_id='foo')
+        self.client.call_authorize(app_id='foo')
+        self.assertEqual([m.cache for m in self.collector.metrics], ['miss', 'hit'])
+        self.assertEqual(self.collector.metrics[1].phases, {})
+
+        self.backend.stop()
+        self.client.connection_pool.clear()
+        self.assertRaises(ThreeScalePY.ThreeScaleConnectionError,
+                          self.client.call_authrep, app_id='foo')
+        metrics = self.collector.metrics[2]
+        self.assertEqual(metrics.call, 'authrep')
+        self.assertTrue(isinstance(metrics.error, ThreeScalePY.ThreeScaleConnectionError))
+
+    def testFailingCollector(self):
+        """test that an exception in the collector does not reach the caller"""
+        def collect(metrics):
+            raise ValueError("collector error")
+        self.collector.collect = collect
+        self.assertTrue(self.client.call_authorize(app_id='foo'))
+        self.backend.stop()
+        self.client.connection_pool.clear()
+        self.assertRaises(ThreeScalePY.ThreeScaleConnectionError,
+                          self.client.call_authrep, app_id='foo')
+
+    def testProxyTunnel(self):
+        """test that a measured connection goes through its proxy tunnel"""
+        conn = ThreeScalePY.ThreeScaleHTTPConnection('127.0.0.1', self.backend.server_port, timeout=5)
+        conn.set_tunnel('backend.example.com', 443)
+        conn.phases = {}
+        conn.request('GET', '/transactions/authorize.xml')
+        resp = conn.getresponse()
+        resp.read()
+        conn.close()
+        self.assertEqual(resp.status, 200)
+        self.assertEqual([req[:2] for req in self.backend.requests],
+                         [('CONNECT', 'backend.example.com:443'), ('GET', '/transactions/authorize.xml')])
+        self.assertTrue('connect' in conn.phases)
+
+    def testAdapters(self):
+        """test the logging and Prometheus adapters"""
+        prometheus = ThreeScalePY.ThreeScalePrometheusCollector(buckets=(0.5, 60))
+        self.client.set_collector(prometheus)
+        self.client.call_authorize(app_id='foo')
+        self.client.call_authorize(app_id='foo')
+        text = prometheus.expose()
+        self.assertTrue('threescale_call_duration_seconds_bucket'
+                        '{call="authorize",phase="total",le="60"} 2\n' in text)
+        self.assertTrue('threescale_call_duration_seconds_count'
+                        '{call="authorize",phase="total"} 2\n' in text)
+        self.assertTrue('threescale_calls_total{call="authorize",status="200"} 2\n' in text)
+
+        messages = []
+        handler = logging.Handler()
+        handler.emit = lambda record: messages.append(record.getMessage())
+        logger = logging.getLogger('ThreeScalePY.test')
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        self.client.set_collector(ThreeScalePY.ThreeScaleLoggingCollector(logger, logging.INFO))
+        self.client.call_authorize(app_id='foo')
+        self.assertTrue(messages[0].startswith("3scale authorize status=200 total="))
+        self.assertTrue("ttfb=" in messages[0])
+
+class TestThreeScaleBackendOptions(unittest.TestCase):
+    """test case for the extensions of the backend responses"""
+
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.client = ThreeScalePY.ThreeScale(service_id='1', service_token='token',
+                                              backend_uri=self.backend.uri())
+
+    def tearDown(self):
+        self.backend.stop()
+
+    def testOptionsHeader(self):
+        """test that the options are sent in the 3scale-options header"""
+        self.client.call_authorize(app_id='foo')
+        self.assertFalse('3scale-options' in self.backend.request_headers[0])
+        self.client.set_backend_options(no_body=True, limit_headers=True)
+        self.client.call_authorize(app_id='foo')
+        self.assertEqual(self.backend.request_headers[1]['3scale-options'],
+                         'limit_headers=1&no_body=1')
+
+    def testResponseFromHeaders(self):
+        """test that the decision and the limits are read from the headers"""
+        self.client.set_backend_options(no_body=True, rejection_reason_header=True,
+                                        limit_headers=True)
+        headers = {'3scale-limit-remaining': '7', '3scale-limit-reset': '42'}
+        self.backend.responses['/transactions/authorize.xml'] = (200, b'', headers)
+        response = self.client.call_authorize(app_id='foo').get_response()
+        self.assertTrue(response.is_authorized())
+        self.assertEqual((response.get_limit_remaining(), response.get_limit_reset()), (7, 42))
+        self.assertEqual(response.get_usage_reports(), [])
+
+        headers = {'3scale-rejection-reason': 'limits_exceeded',
+                   '3scale-limit-remaining': '0', '3scale-limit-reset': '5'}
+        self.backend.responses['/transactions/authrep.xml'] = (409, b'', headers)
+        authrep = ThreeScalePY.ThreeScaleAuthRep(service_id='1', service_token='token', app_id='foo',
+                                                 backend_uri=self.backend.uri())
+        authrep.set_backend_options(no_body=True, rejection_reason_header=True)
+        self.assertFalse(authrep.authrep())
+        response = authrep.build_response()
+        self.assertEqual((response.get_error_code(), response.get_reason()), (409, 'limits_exceeded'))
+        self.assertEqual(response.get_limit_remaining(), 0)
+
+    def testReasonFromBody(self):
+        """test that the reason in the body wins over the header"""
+        headers = {'3scale-rejection-reason': 'limits_exceeded', '3scale-limit-remaining': '0'}
+        self.backend.responses['/transactions/authorize.xml'] = (409, usage_status_xml(False, 10, 10),
+                                                                 headers)
+        response = self.client.call_authorize(app_id='foo').get_response()
+        self.assertEqual(response.get_reason(), "usage limits are exceeded")
+        self.assertEqual(response.get_limit_remaining(), 0)
+        self.assertEqual(len(response.get_usage_reports()), 1)
+
+class TestThreeScaleLazyResponse(unittest.TestCase):
+    """test case for the responses parsed on demand"""
+
+    def testNothingParsedUntilAsked(self):
+        """test that the body is only parsed for the parts asked for"""
+        resp = ThreeScalePY.ThreeScaleLazyAuthorizeResponse.parse(usage_status_xml(True, 3, 10))
+        self.assertTrue(resp.is_authorized())
+        self.assertEqual(resp.get_reason(), None)
+        self.assertTrue(resp.xml is None)
+        self.assertEqual(resp.get_plan(), "Basic")
+        self.assertTrue(resp.parsed_usage_reports is ThreeScalePY.UNPARSED)
+
+        report = resp.get_usage_report('hits', 'day')
+        self.assertEqual((report.get_current_value(), report.get_max_value()), ('3', '10'))
+        self.assertEqual(resp.get_usage_report('hits', 'month'), None)
+        self.assertTrue(resp.parsed_usage_reports is ThreeScalePY.UNPARSED)
+        self.assertEqual(len(resp.get_usage_reports()), 1)
+
+        authrep = ThreeScalePY.ThreeScaleLazyAuthRepResponse.parse(b'not xml')
+        self.assertTrue(authrep.is_authorized())
+        self.assertEqual(authrep.get_reason(), None)
+
+    def testSameAsEager(self):
+        """test that the lazy responses match the ones parsed at once"""
+        for body, error_code in ((usage_status_xml(False, 10, 10), 409),
+                                 (b'<error code="application_not_found">not found</error>', 404)):
+            eager = ThreeScalePY.ThreeScaleAuthorizeResponse.parse(body, error_code)
+            lazy = ThreeScalePY.ThreeScaleLazyAuthorizeResponse.parse(body, error_code)
+            self.assertEqual((lazy.is_authorized(), lazy.get_error_code(), lazy.get_reason(), lazy.get_plan()),
+                             (eager.is_authorized(), eager.get_error_code(), eager.get_reason(), eager.get_plan()))
+            self.assertEqual([(r.get_metric(), r.get_end_period()) for r in lazy.get_usage_reports()],
+                             [(r.get_metric(), r.get_end_period()) for r in eager.get_usage_reports()])
+
+    def testInvalidBody(self):
+        """test that an invalid body raises when a part of it is asked for"""
+        resp = ThreeScalePY.ThreeScaleLazyAuthorizeResponse.parse(b'<status>', 409)
+        self.assertFalse(resp.is_authorized())
+        self.assertRaises(ThreeScalePY.ThreeScaleException, resp.get_plan)
+        self.assertRaises(ThreeScalePY.ThreeScaleException, resp.get_reason)
+
+class TestThreeScaleXMLBackend(unittest.TestCase):
+    """test case for the choice of the xml backend"""
+
+    def setUp(self):
+        self.fromstring = ThreeScalePY.xml_fromstring
+
+    def tearDown(self):
+        ThreeScalePY.xml_fromstring = self.fromstring
+
+    def testImportIsLazy(self):
+        """test that importing the plugin does not load lxml"""
+        code = "import sys, ThreeScalePY; sys.stdout.write(str('lxml' in sys.modules))"
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(ThreeScalePY.__file__)))
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        self.assertEqual(output, b'False')
+
+    def testEtreeBackend(self):
+        """test that the standard library parser gives the same responses"""
+        ThreeScalePY.set_xml_backend('etree')
+        resp = ThreeScalePY.ThreeScaleAuthorizeResponse.parse(USAGE_REPORTS_XML, 409)
+        self.assertEqual((resp.get_plan(), resp.get_reason()), ("Ultimate", "usage limits are exceeded"))
+        self.assertEqual([(r.metric, r.period, r.max_value) for r in resp.get_usage_reports()],
+                         [("hits", "day", 50000), ("hits", "eternity", 150000)])
+        self.assertRaises(ThreeScalePY.ThreeScaleException, ThreeScalePY.parse_xml, b'<status>')
+
+    def testCustomBackend(self):
+        """test that a function can be the backend, and unknown names raise"""
+        bodies = []
+        def fromstring(body):
+            bodies.append(body)
+            return ElementTree.fromstring(body)
+        ThreeScalePY.set_xml_backend(fromstring)
+        self.assertEqual(ThreeScalePY.parse_xml(b'<status/>').tag, 'status')
+        self.assertEqual(bodies, [b'<status/>'])
+        self.assertRaises(ThreeScalePY.ThreeScaleException, ThreeScalePY.set_xml_backend, 'sax')
+
 class TestThreeScaleReport(TestThreeScale):
     """test case for report API call"""
 
@@ -393,6 +2446,251 @@ if __name__ == '__main__':
         if exec_type in ('all', 'report'):
             suite.addTest(TestThreeScaleReport(test))
 
+    pool_tests = [
+                   'testConnectionIsReused',
+                   'testIdleConnectionsAreEvicted',
+                   'testAuthorizeIsSentAgain',
+                   'testAuthRepIsNotSentAgain',
+                   'testForkedProcessOpensItsConnections',
+                   'testHttpProxy',
+                   'testHttpsProxyTunnel',
+                   'testNoProxy',
+                   'testPoolIsShared',
+                   'testRejectedAuthRep',
+                   'testServerError',
+                   'testReportIsPosted',
+                   'testConnectionError'
+                 ]
+    for test in pool_tests:
+        suite.addTest(TestThreeScaleConnectionPool(test))
+
+    cache_tests = [
+                    'testCachedAuthorize',
+                    'testCacheKeyIncludesUsage',
+                    'testRejectionsAreNotCached',
+                    'testEntryExpiresAtPeriodEnd',
+                    'testLeastRecentlyUsedEviction',
+                    'testExtensionHeadersAreCached',
+                    'testEntryExpiresAtLimitReset',
+                    'testParsePeriod'
+                  ]
+    for test in cache_tests:
+        suite.addTest(TestThreeScaleAuthorizeCache(test))
+
+    batch_tests = [
+                    'testFlushInBatches',
+                    'testFlushInterval',
+                    'testDropWhenFull',
+                    'testErrorCallback',
+                    'testRaisingErrorCallback',
+                    'testStoppedThread',
+                    'testClose',
+                    'testForkedProcessReports',
+                    'testInvalidBatchSize'
+                  ]
+    for test in batch_tests:
+        suite.addTest(TestThreeScaleBatchReporter(test))
+
+    async_tests = [
+                    'testAsyncAuthRep',
+                    'testAsyncAuthorizeRejected',
+                    'testAsyncReport',
+                    'testAsyncConnectionError',
+                    'testAsyncOnlyAuthorizeIsSentAgain',
+                    'testAsyncMetrics'
+                  ]
+    for test in async_tests:
+        suite.addTest(TestThreeScaleAsync(test))
+
+    parsing_tests = [
+                      'testParseUsageReports',
+                      'testReasonIsOnlySetOnRejections',
+                      'testParseError',
+                      'testInvalidXml',
+                      'testTypedUsageReports',
+                      'testPeriodsKeepTheirOffset'
+                    ]
+    for test in parsing_tests:
+        suite.addTest(TestThreeScaleResponseParsing(test))
+
+    call_tests = [
+                   'testSharedBetweenThreads',
+                   'testResultIsImmutableAndLazy',
+                   'testCallAuthorizeUsesCache',
+                   'testCallReport',
+                   'testMissingCredentials'
+                 ]
+    for test in call_tests:
+        suite.addTest(TestThreeScaleCallAPI(test))
+
+    encoding_tests = [
+                       'testBuildPostData',
+                       'testGeneratorOfTransactions',
+                       'testEqualValuesOfOtherTypes',
+                       'testInvalidTransactions'
+                     ]
+    for test in encoding_tests:
+        suite.addTest(TestThreeScaleReportEncoding(test))
+
+    query_tests = [
+                    'testQueryString',
+                    'testChangedCredentials',
+                    'testCallCredentials',
+                    'testOtherParamsOverrideCredentials',
+                    'testUsageEncodingIsRemembered',
+                    'testEqualUsagesOfOtherTypes'
+                  ]
+    for test in query_tests:
+        suite.addTest(TestThreeScaleQueryString(test))
+
+    limiter_tests = [
+                      'testRejectLocallyOverLimit',
+                      'testAllowedCallsGoToTheBackend',
+                      'testUsageValuesAreIntegers',
+                      'testCachedAuthorizationsConsumeLocally',
+                      'testResyncWhenPeriodEnds',
+                      'testResyncRejectedAfterTTL'
+                    ]
+    for test in limiter_tests:
+        suite.addTest(TestThreeScaleQuotaLimiter(test))
+
+    single_flight_tests = [
+                            'testIdenticalCallsAreCoalesced',
+                            'testDifferentCallsAreNotCoalesced',
+                            'testAuthRepIsNotCoalesced',
+                            'testErrorsAreShared',
+                            'testWaitersTimeOut'
+                          ]
+    for test in single_flight_tests:
+        suite.addTest(TestThreeScaleSingleFlight(test))
+
+    breaker_tests = [
+                      'testOpensOnErrors',
+                      'testOpensOnSlowCalls',
+                      'testHalfOpenProbe',
+                      'testFailClosed',
+                      'testFailOpen',
+                      'testFailOpenOnServerErrors',
+                      'testAsyncFailOpen'
+                    ]
+    for test in breaker_tests:
+        suite.addTest(TestThreeScaleCircuitBreaker(test))
+
+    hedger_tests = [
+                     'testFastCallIsNotHedged',
+                     'testSlowCallIsHedged',
+                     'testWorkersAreReused',
+                     'testIdleWorkersExit',
+                     'testAuthRepIsSplit',
+                     'testReportErrorIsNotRaised',
+                     'testRejectedAuthRepIsNotReported',
+                     'testDelayFollowsLatencies'
+                   ]
+    for test in hedger_tests:
+        suite.addTest(TestThreeScaleHedger(test))
+
+    balancer_tests = [
+                       'testBaseUrlIsThePrimary',
+                       'testLeastOutstanding',
+                       'testEwma',
+                       'testFailingEndpointIsEjectedAndProbed'
+                     ]
+    for test in balancer_tests:
+        suite.addTest(TestThreeScaleBackendBalancer(test))
+
+    spool_tests = [
+                    'testBatches',
+                    'testBackendOutage',
+                    'testRestart',
+                    'testTornRecord',
+                    'testFullSpool',
+                    'testInvalidBatchIsDropped',
+                    'testRaisingErrorCallback'
+                  ]
+    for test in spool_tests:
+        suite.addTest(TestThreeScaleSpoolReporter(test))
+
+    aggregator_tests = [
+                         'testUsageIsMerged',
+                         'testFlush',
+                         'testBuckets',
+                         'testBackgroundFlush',
+                         'testInvalidTransaction',
+                         'testTimestampsInAnyTimezone',
+                         'testServices',
+                         'testFailures'
+                       ]
+    for test in aggregator_tests:
+        suite.addTest(TestThreeScaleUsageAggregator(test))
+
+    multi_service_tests = [
+                            'testPartitions',
+                            'testParallel',
+                            'testErrors',
+                            'testInvalidTransactions'
+                          ]
+    for test in multi_service_tests:
+        suite.addTest(TestThreeScaleMultiServiceReporter(test))
+
+    shared_cache_tests = [
+                           'testCachedAuthorize',
+                           'testSharedByPath',
+                           'testSharedWithForkedProcesses',
+                           'testEviction',
+                           'testExpiry',
+                           'testExtensionHeaders',
+                           'testInterruptedWrite'
+                         ]
+    for test in shared_cache_tests:
+        suite.addTest(TestThreeScaleSharedAuthorizeCache(test))
+
+    middleware_tests = [
+                         'testAuthorized',
+                         'testRejections',
+                         'testExtraction',
+                         'testDroppedUsage',
+                         'testASGI'
+                       ]
+    for test in middleware_tests:
+        suite.addTest(TestThreeScaleMiddleware(test))
+
+    bulk_tests = [
+                   'testConcurrency',
+                   'testFailures'
+                 ]
+    for test in bulk_tests:
+        suite.addTest(TestThreeScaleBulkAuthorize(test))
+
+    collector_tests = ['testPhases',
+                       'testCacheAndErrors',
+                       'testFailingCollector',
+                       'testProxyTunnel',
+                       'testAdapters'
+                      ]
+    for test in collector_tests:
+        suite.addTest(TestThreeScaleCollector(test))
+
+    options_tests = ['testOptionsHeader',
+                     'testResponseFromHeaders',
+                     'testReasonFromBody'
+                    ]
+    for test in options_tests:
+        suite.addTest(TestThreeScaleBackendOptions(test))
+
+    lazy_tests = ['testNothingParsedUntilAsked',
+                  'testSameAsEager',
+                  'testInvalidBody'
+                 ]
+    for test in lazy_tests:
+        suite.addTest(TestThreeScaleLazyResponse(test))
+
+    xml_backend_tests = ['testImportIsLazy',
+                         'testEtreeBackend',
+                         'testCustomBackend'
+                        ]
+    for test in xml_backend_tests:
+        suite.addTest(TestThreeScaleXMLBackend(test))
+
     suite.addTest(TestThreeScale('testCorrectUrlValidation'))
     suite.addTest(TestThreeScale('testInvalidUrlValidation'))
     suite.addTest(TestThreeScale('testProviderKeyOrServiceTokenMissing'))